@@ -71,7 +71,7 @@ import rangelib
 import sparse_img
 from concurrent.futures import ThreadPoolExecutor
 from apex_utils import GetApexInfoFromTargetFiles
-from common import ZipDelete, PARTITIONS_WITH_CARE_MAP, ExternalError, RunAndCheckOutput, IsSparseImage, MakeTempFile, ZipWrite
+from common import PARTITIONS_WITH_CARE_MAP, ExternalError, RunAndCheckOutput, IsSparseImage, MakeTempFile, ZipWrite
 from build_image import FIXED_FILE_TIMESTAMP
 
 if sys.hexversion < 0x02070000:
@@ -811,15 +811,13 @@ def ReplaceUpdatedFiles(zip_filename, files_list):
   For now the list includes META/care_map.pb, and the related files under
   SYSTEM/ after rebuilding recovery.
   """
-  common.ZipDelete(zip_filename, files_list)
-  output_zip = zipfile.ZipFile(zip_filename, "a",
-                               compression=zipfile.ZIP_DEFLATED,
-                               allowZip64=True)
+  entries_to_replace = {}
   for item in files_list:
     file_path = os.path.join(OPTIONS.input_tmp, item)
     assert os.path.exists(file_path)
-    common.ZipWrite(output_zip, file_path, arcname=item)
-  common.ZipClose(output_zip)
+    entries_to_replace[item] = file_path
+  common.ZipRewrite(zip_filename, zip_filename,
+                    entries_to_replace=entries_to_replace)
 
 
 def HasPartition(partition_name):
@@ -1194,25 +1192,20 @@ def OptimizeCompressedEntries(zipfile_path):
   if not zipfile.is_zipfile(zipfile_path):
     return
   entries_to_store = []
-  with tempfile.TemporaryDirectory() as tmpdir:
-    with zipfile.ZipFile(zipfile_path, "r", allowZip64=True) as zfp:
-      for zinfo in zfp.filelist:
-        if not zinfo.filename.startswith("IMAGES/") and not zinfo.filename.startswith("META"):
-          continue
-        # Don't try to store userdata.img uncompressed, it's usually huge.
-        if zinfo.filename.endswith("userdata.img"):
-          continue
-        if zinfo.compress_size > zinfo.file_size * 0.80 and zinfo.compress_type != zipfile.ZIP_STORED:
-          entries_to_store.append(zinfo)
-          zfp.extract(zinfo, tmpdir)
-    if len(entries_to_store) == 0:
-      return
-    # Remove these entries, then re-add them as ZIP_STORED
-    ZipDelete(zipfile_path, [entry.filename for entry in entries_to_store])
-    with zipfile.ZipFile(zipfile_path, "a", allowZip64=True) as zfp:
-      for entry in entries_to_store:
-        zfp.write(os.path.join(tmpdir, entry.filename),
-                  entry.filename, compress_type=zipfile.ZIP_STORED)
+  with zipfile.ZipFile(zipfile_path, "r", allowZip64=True) as zfp:
+    for zinfo in zfp.filelist:
+      if not zinfo.filename.startswith("IMAGES/") and not zinfo.filename.startswith("META"):
+        continue
+      # Don't try to store userdata.img uncompressed, it's usually huge.
+      if zinfo.filename.endswith("userdata.img"):
+        continue
+      if zinfo.compress_size > zinfo.file_size * 0.80 and zinfo.compress_type != zipfile.ZIP_STORED:
+        entries_to_store.append(zinfo)
+  if len(entries_to_store) == 0:
+    return
+  # Rewrite these entries as ZIP_STORED in place, and copy the rest as is.
+  common.ZipRewrite(zipfile_path, zipfile_path, compress_types={
+      entry.filename: zipfile.ZIP_STORED for entry in entries_to_store})
 
 
 def main(argv):
@@ -15,6 +15,7 @@
 from __future__ import print_function
 
 import array
+import bisect
 import copy
 import functools
 import heapq
@@ -24,12 +25,16 @@ import multiprocessing
 import os
 import os.path
 import re
+import shutil
 import sys
+import tempfile
 import threading
 import zlib
 from collections import deque, namedtuple, OrderedDict
+from hashlib import sha1
 
 import common
+import sparse_img
 from images import EmptyImage
 from rangelib import RangeSet
 
@@ -60,6 +65,238 @@ def compute_patch(srcfile, tgtfile, imgdiff=False):
     return PatchInfo(imgdiff, f.read())
 
 
+def compute_transfer_patch(src, tgt, name, src_ranges, tgt_ranges, imgdiff,
+                           patch_info, compress_target):
+  """Computes the patch and the compressed target size for a transfer.
+
+  Args:
+    src: The source image object.
+    tgt: The target image object.
+    name: The transfer name used in error messages.
+    src_ranges: The source RangeSet of the transfer.
+    tgt_ranges: The target RangeSet of the transfer.
+    imgdiff: Whether to use imgdiff instead of bsdiff.
+    patch_info: The PatchInfo if the patch has been computed already, or None.
+    compress_target: If True, also compresses the target ranges.
+
+  Returns:
+    A tuple of (patch_info, compressed_size, error_messages).
+  """
+  message = []
+  compressed_size = None
+
+  if not patch_info:
+    src_file = common.MakeTempFile(prefix="src-")
+    with open(src_file, "wb") as fd:
+      src.WriteRangeDataToFd(src_ranges, fd)
+
+    tgt_file = common.MakeTempFile(prefix="tgt-")
+    with open(tgt_file, "wb") as fd:
+      tgt.WriteRangeDataToFd(tgt_ranges, fd)
+
+    try:
+      patch_info = compute_patch(src_file, tgt_file, imgdiff)
+    except ValueError as e:
+      message.append(
+          "Failed to generate %s for %s: tgt=%s, src=%s:\n%s" % (
+              "imgdiff" if imgdiff else "bsdiff", name, tgt_ranges,
+              src_ranges, e))
+
+  if compress_target:
+    compressed_size, compress_message = compute_compressed_size(
+        tgt, name, tgt_ranges)
+    message.extend(compress_message)
+
+  return patch_info, compressed_size, message
+
+
+def compute_compressed_size(tgt, name, tgt_ranges):
+  """Compresses the target ranges of a transfer.
+
+  Returns:
+    A tuple of (compressed_size, error_messages).
+  """
+  tgt_data = tgt.ReadRangeSet(tgt_ranges)
+  try:
+    # Compresses with the default level
+    compress_obj = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    compressed_data = (compress_obj.compress(b"".join(tgt_data))
+                       + compress_obj.flush())
+    return len(compressed_data), []
+  except zlib.error as e:
+    return None, [
+        "Failed to compress the data in target range {} for {}:\n"
+        "{}".format(tgt_ranges, name, e)]
+
+
+def GetReopenableImagePath(image):
+  """Returns the path to reopen the image in a worker process.
+
+  Only sparse images can be reopened cheaply (and read via mmap) by the worker
+  processes. Returns '' for an EmptyImage, or None if the image can only be
+  read in-process, e.g. a DataImage or a FileImage.
+  """
+  if isinstance(image, EmptyImage):
+    return ''
+  if isinstance(image, sparse_img.SparseImage):
+    return image.simg_fn
+  return None
+
+
+class PatchCache(object):
+  """An on-disk cache of bsdiff/imgdiff patches, keyed by content.
+
+  Each entry is keyed by the SHA-1 of the source and target data, the patch
+  style, and the SHA-1 of the diff tool binary; so a patch can be reused when
+  the same pair of files is diff'd again, e.g. when generating incrementals
+  from the same source build to different targets. The total size of the
+  cache is bounded by evicting the least recently used entries, as tracked by
+  their mtime. The cache directory can be shared by concurrent processes.
+  """
+
+  def __init__(self, cache_dir, max_size):
+    self.cache_dir = cache_dir
+    self.max_size = max_size
+    self._tool_sha1 = {}
+    # The total size of the entries as of the last scan by Trim(), plus the
+    # sizes of the entries put since; None before the first scan.
+    self._total_size = None
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir, exist_ok=True)
+
+  def _GetToolSha1(self, imgdiff):
+    tool = 'imgdiff' if imgdiff else 'bsdiff'
+    if tool not in self._tool_sha1:
+      tool_sha1 = None
+      tool_path = shutil.which(common.FindHostToolPath(tool))
+      if tool_path:
+        with open(tool_path, 'rb') as f:
+          tool_sha1 = sha1(f.read()).hexdigest()
+      self._tool_sha1[tool] = tool_sha1
+    return self._tool_sha1[tool]
+
+  def _GetEntryPath(self, src_sha1, tgt_sha1, imgdiff):
+    tool_sha1 = self._GetToolSha1(imgdiff)
+    if not tool_sha1:
+      return None
+    key = ':'.join(
+        [tool_sha1, 'imgdiff' if imgdiff else 'bsdiff', src_sha1, tgt_sha1])
+    return os.path.join(self.cache_dir,
+                        sha1(key.encode()).hexdigest() + '.patch')
+
+  def Get(self, src_sha1, tgt_sha1, imgdiff):
+    """Returns the cached PatchInfo, or None on a cache miss."""
+    path = self._GetEntryPath(src_sha1, tgt_sha1, imgdiff)
+    if not path:
+      return None
+    try:
+      with open(path, 'rb') as f:
+        content = f.read()
+      # Mark the entry as recently used.
+      os.utime(path)
+    except (IOError, OSError):
+      return None
+    return PatchInfo(imgdiff, content)
+
+  def Put(self, src_sha1, tgt_sha1, patch_info):
+    """Adds the PatchInfo to the cache."""
+    path = self._GetEntryPath(src_sha1, tgt_sha1, patch_info.imgdiff)
+    if not path:
+      return
+    # Write to a temp file first, so that concurrent readers never see a
+    # partially written entry.
+    fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+      f.write(patch_info.content)
+    os.replace(tmp_path, path)
+    if self._total_size is not None:
+      self._total_size += len(patch_info.content)
+
+  def Trim(self):
+    """Evicts the least recently used entries to fit in max_size.
+
+    The cache directory is scanned on the first call, and then only when the
+    entries put since the last scan may have taken the cache over max_size.
+    """
+    if self._total_size is not None and self._total_size <= self.max_size:
+      return
+    entries = []
+    total_size = 0
+    for entry in os.scandir(self.cache_dir):
+      if not entry.name.endswith('.patch'):
+        continue
+      try:
+        st = entry.stat()
+      except OSError:
+        continue
+      entries.append((st.st_mtime_ns, st.st_size, entry.path))
+      total_size += st.st_size
+
+    entries.sort()
+    for _, size, path in entries:
+      if total_size <= self.max_size:
+        break
+      try:
+        os.remove(path)
+      except OSError:
+        continue
+      total_size -= size
+    self._total_size = total_size
+
+
+# The images opened by each worker process of a patch pool, by their paths.
+_worker_images = {}
+
+
+def _InitPatchWorker():
+  # The worker inherits the temp files of the parent process when forked. Only
+  # track the ones created by the worker itself, which get cleaned up after
+  # each transfer.
+  common.OPTIONS.tempfiles = []
+
+
+def _GetWorkerImage(path):
+  """Returns the image at path, opening it on the first use in the worker."""
+  if path not in _worker_images:
+    _worker_images[path] = (sparse_img.SparseImage(path, use_mmap=True)
+                            if path else EmptyImage())
+  return _worker_images[path]
+
+
+def CreatePatchPool(processes):
+  """Creates a pool of processes to compute the patches of BlockImageDiffs.
+
+  The workers are forked, so the pool must be created before any other threads
+  are started, since forking a multi-threaded process may copy the locks held
+  by the other threads. It can then be shared by the BlockImageDiffs of
+  concurrent threads, as the workers open their images by path.
+  """
+  return multiprocessing.get_context("fork").Pool(
+      processes, initializer=_InitPatchWorker)
+
+
+def _ComputePatchInWorker(job):
+  """Computes a patch, or only compresses the target if has_patch is set.
+
+  A known patch isn't sent to the worker, and None is returned in its place.
+  """
+  patch_index, xf_index, src_path, tgt_path, name, src_ranges, tgt_ranges, \
+      imgdiff, has_patch, compress_target = job
+  tgt = _GetWorkerImage(tgt_path)
+  try:
+    if has_patch:
+      compressed_size, message = compute_compressed_size(
+          tgt, name, tgt_ranges)
+      result = (None, compressed_size, message)
+    else:
+      result = compute_transfer_patch(
+          _GetWorkerImage(src_path), tgt, name, src_ranges, tgt_ranges,
+          imgdiff, None, compress_target)
+  finally:
+    common.Cleanup()
+  return (patch_index, xf_index) + result
+
+
 class Transfer(object):
   def __init__(self, tgt_name, src_name, tgt_ranges, src_ranges, tgt_sha1,
                src_sha1, style, by_id):
@@ -227,7 +464,8 @@ class BlockImageDiff(object):
          data into list/tuple elements in any way that is convenient.
 
      RangeSha1(): a function that returns (as a hex string) the SHA-1 hash of
-         all the data in the specified range.
+         all the data in the specified range. Images derived from
+         images.Image memoize the hashes.
 
      TotalSha1(): a function that returns (as a hex string) the SHA-1 hash of
          all the data in the image (ie, all the blocks in the care_map minus
@@ -239,12 +477,18 @@ class BlockImageDiff(object):
   """
 
   def __init__(self, tgt, src=None, threads=None, version=4,
-               disable_imgdiff=False):
+               disable_imgdiff=False, use_processes=False, patch_cache=None,
+               process_pool=None):
     if threads is None:
       threads = multiprocessing.cpu_count() // 2
       if threads == 0:
         threads = 1
     self.threads = threads
+    self.use_processes = use_processes
+    self.process_pool = process_pool
+    self.patch_cache = patch_cache
+    self.patch_cache_hits = 0
+    self.patch_cache_misses = 0
     self.version = version
     self.transfers = []
     self.src_basenames = {}
@@ -376,6 +620,20 @@ class BlockImageDiff(object):
     if not self.disable_imgdiff:
       self.imgdiff_stats.Report()
 
+    if self.patch_cache:
+      logger.info("Found %d of %d patches in the patch cache.",
+                  self.patch_cache_hits,
+                  self.patch_cache_hits + self.patch_cache_misses)
+
+    # Only the images derived from images.Image count their range hashes.
+    for name, image in (("target", self.tgt), ("source", self.src)):
+      hits = getattr(image, "range_sha1_hits", 0)
+      lookups = hits + getattr(image, "range_sha1_misses", 0)
+      if lookups:
+        logger.info(
+            "Found %d of %d range hashes of the %s image in the cache "
+            "(%.1f%%).", hits, lookups, name, hits * 100.0 / lookups)
+
   def WriteTransfers(self, prefix):
     def WriteSplitTransfers(out, style, target_blocks):
       """Limit the size of operand in command 'new' and 'zero' to 1024 blocks.
@@ -783,12 +1041,14 @@ class BlockImageDiff(object):
     SparseImage.RangeSha1() messed up with the hash calculation in multi-thread
     environment. That specific problem has been fixed by protecting the
     underlying generator function 'SparseImage._GetRangeData()' with lock.
+    The hashes are recomputed from the image data rather than looked up from
+    the cache, which holds the very hashes to be checked.
     """
     for xf in self.transfers:
-      tgt_sha1 = self.tgt.RangeSha1(xf.tgt_ranges)
+      tgt_sha1 = self.tgt.RangeSha1(xf.tgt_ranges, use_cache=False)
       assert xf.tgt_sha1 == tgt_sha1
       if xf.style == "diff":
-        src_sha1 = self.src.RangeSha1(xf.src_ranges)
+        src_sha1 = self.src.RangeSha1(xf.src_ranges, use_cache=False)
         assert xf.src_sha1 == src_sha1
 
   def AssertSequenceGood(self):
@@ -1061,30 +1321,29 @@ class BlockImageDiff(object):
   def GenerateDigraph(self):
     logger.info("Generating digraph...")
 
-    # Each item of source_ranges will be:
-    #   - None, if that block is not used as a source,
-    #   - an ordered set of transfers.
-    source_ranges = []
+    # Split the block space at every source range endpoint, so that each
+    # elementary segment [boundaries[k], boundaries[k+1]) is covered by a fixed
+    # set of transfers. Each item of source_segments will be the list of
+    # transfers that read the segment, in the transfer evaluation order. This
+    # scales with the number of ranges rather than the number of blocks.
+    boundaries = sorted(set(itertools.chain.from_iterable(
+        b.src_ranges.data for b in self.transfers)))
+    source_segments = [[] for _ in range(len(boundaries))]
     for b in self.transfers:
       for s, e in b.src_ranges:
-        if e > len(source_ranges):
-          source_ranges.extend([None] * (e-len(source_ranges)))
-        for i in range(s, e):
-          if source_ranges[i] is None:
-            source_ranges[i] = OrderedDict.fromkeys([b])
-          else:
-            source_ranges[i][b] = None
+        for k in range(bisect.bisect_left(boundaries, s),
+                       bisect.bisect_left(boundaries, e)):
+          source_segments[k].append(b)
 
     for a in self.transfers:
       intersections = OrderedDict()
       for s, e in a.tgt_ranges:
-        for i in range(s, e):
-          if i >= len(source_ranges):
-            break
-          # Add all the Transfers in source_ranges[i] to the (ordered) set.
-          if source_ranges[i] is not None:
-            for j in source_ranges[i]:
-              intersections[j] = None
+        k = max(bisect.bisect_right(boundaries, s) - 1, 0)
+        while k < len(boundaries) - 1 and boundaries[k] < e:
+          # Add all the Transfers in source_segments[k] to the (ordered) set.
+          for j in source_segments[k]:
+            intersections[j] = None
+          k += 1
 
       for b in intersections:
         if a is b:
@@ -1117,22 +1376,107 @@ class BlockImageDiff(object):
     if not diff_queue:
       return []
 
-    if self.threads > 1:
-      logger.info("Computing patches (using %d threads)...", self.threads)
-    else:
-      logger.info("Computing patches...")
-
     diff_total = len(diff_queue)
     patches = [None] * diff_total
     error_messages = []
 
-    # Using multiprocessing doesn't give additional benefits, due to the
-    # pattern of the code. The diffing work is done by subprocess.call, which
-    # already runs in a separate process (not affected much by the GIL -
-    # Global Interpreter Lock). Using multiprocess also requires either a)
-    # writing the diff input files in the main process before forking, or b)
-    # reopening the image file (SparseImage) in the worker processes. Doing
-    # neither of them further improves the performance.
+    # Look up the patches that haven't been computed yet in the patch cache.
+    # The known patches are kept in known_patches, by patch_index. They are
+    # only left in diff_queue when their targets are to be compressed, as
+    # (xf_index, imgdiff, patch_index, True), so that the workers don't have
+    # the patch data passed to them and back.
+    cache_hits = 0
+    cache_misses = set()
+    known_patches = {}
+    queue = []
+    for xf_index, imgdiff, patch_index in diff_queue:
+      xf = self.transfers[xf_index]
+      patch_info = xf.patch_info
+      if not patch_info and self.patch_cache:
+        patch_info = self.patch_cache.Get(xf.src_sha1, xf.tgt_sha1, imgdiff)
+        if patch_info:
+          cache_hits += 1
+        else:
+          cache_misses.add(xf_index)
+      if patch_info:
+        known_patches[patch_index] = patch_info
+        if not compress_target:
+          patches[patch_index] = (xf_index, patch_info, None)
+          continue
+      queue.append((xf_index, imgdiff, patch_index, bool(patch_info)))
+    diff_queue = queue
+
+    if self.patch_cache:
+      logger.info("Patch cache hits: %d, misses: %d", cache_hits,
+                  len(cache_misses))
+      self.patch_cache_hits += cache_hits
+      self.patch_cache_misses += len(cache_misses)
+
+    # The diffing work is done by subprocess.call, which already runs in a
+    # separate process (not affected much by the GIL - Global Interpreter
+    # Lock). But the worker threads still need to dump the src/tgt ranges and
+    # compress the target data in-process. When use_processes is set and both
+    # images can be reopened by path, use a process pool instead, where each
+    # worker reads the images on its own. The pool is the given process_pool
+    # if any, which callers running concurrent threads must provide (see
+    # CreatePatchPool()), or one created for this call otherwise.
+    src_path = GetReopenableImagePath(self.src)
+    tgt_path = GetReopenableImagePath(self.tgt)
+    if not diff_queue:
+      logger.info("All patches are known, no patches to compute.")
+    elif (self.use_processes and
+          (self.process_pool is not None or self.threads > 1) and
+          src_path is not None and tgt_path is not None):
+      jobs = []
+      for xf_index, imgdiff, patch_index, has_patch in diff_queue:
+        xf = self.transfers[xf_index]
+        jobs.append((patch_index, xf_index, src_path, tgt_path,
+                     self._TransferName(xf), xf.src_ranges, xf.tgt_ranges,
+                     imgdiff, has_patch, compress_target))
+
+      if self.process_pool is not None:
+        logger.info("Computing patches (using the process pool)...")
+        self._ComputePatchesWithPool(self.process_pool, jobs, known_patches,
+                                     patches, error_messages)
+      else:
+        logger.info("Computing patches (using %d processes)...", self.threads)
+        with CreatePatchPool(self.threads) as pool:
+          self._ComputePatchesWithPool(pool, jobs, known_patches, patches,
+                                       error_messages)
+    else:
+      if self.threads > 1:
+        logger.info("Computing patches (using %d threads)...", self.threads)
+      else:
+        logger.info("Computing patches...")
+      self._ComputePatchesWithThreads(diff_queue, known_patches,
+                                      compress_target, patches, error_messages)
+
+    if error_messages:
+      logger.error('ERROR:')
+      logger.error('\n'.join(error_messages))
+      logger.error('\n\n\n')
+      sys.exit(1)
+
+    if self.patch_cache:
+      for xf_index, patch_info, _ in patches:
+        if xf_index in cache_misses:
+          xf = self.transfers[xf_index]
+          self.patch_cache.Put(xf.src_sha1, xf.tgt_sha1, patch_info)
+      self.patch_cache.Trim()
+
+    return patches
+
+  @staticmethod
+  def _ComputePatchesWithPool(pool, jobs, known_patches, patches,
+                              error_messages):
+    for (patch_index, xf_index, patch_info, compressed_size,
+         message) in pool.imap_unordered(_ComputePatchInWorker, jobs):
+      error_messages.extend(message)
+      patch_info = known_patches.get(patch_index, patch_info)
+      patches[patch_index] = (xf_index, patch_info, compressed_size)
+
+  def _ComputePatchesWithThreads(self, diff_queue, known_patches,
+                                 compress_target, patches, error_messages):
     lock = threading.Lock()
 
     def diff_worker():
@@ -1140,44 +1484,13 @@ class BlockImageDiff(object):
         with lock:
           if not diff_queue:
             return
-          xf_index, imgdiff, patch_index = diff_queue.pop()
+          xf_index, imgdiff, patch_index, _ = diff_queue.pop()
           xf = self.transfers[xf_index]
+          patch_info = known_patches.get(patch_index)
 
-        message = []
-        compressed_size = None
-
-        patch_info = xf.patch_info
-        if not patch_info:
-          src_file = common.MakeTempFile(prefix="src-")
-          with open(src_file, "wb") as fd:
-            self.src.WriteRangeDataToFd(xf.src_ranges, fd)
-
-          tgt_file = common.MakeTempFile(prefix="tgt-")
-          with open(tgt_file, "wb") as fd:
-            self.tgt.WriteRangeDataToFd(xf.tgt_ranges, fd)
-
-          try:
-            patch_info = compute_patch(src_file, tgt_file, imgdiff)
-          except ValueError as e:
-            message.append(
-                "Failed to generate %s for %s: tgt=%s, src=%s:\n%s" % (
-                    "imgdiff" if imgdiff else "bsdiff",
-                    xf.tgt_name if xf.tgt_name == xf.src_name else
-                    xf.tgt_name + " (from " + xf.src_name + ")",
-                    xf.tgt_ranges, xf.src_ranges, e.message))
-
-        if compress_target:
-          tgt_data = self.tgt.ReadRangeSet(xf.tgt_ranges)
-          try:
-            # Compresses with the default level
-            compress_obj = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
-            compressed_data = (compress_obj.compress(b"".join(tgt_data))
-                               + compress_obj.flush())
-            compressed_size = len(compressed_data)
-          except zlib.error as e:
-            message.append(
-                "Failed to compress the data in target range {} for {}:\n"
-                "{}".format(xf.tgt_ranges, xf.tgt_name, e.message))
+        patch_info, compressed_size, message = compute_transfer_patch(
+            self.src, self.tgt, self._TransferName(xf), xf.src_ranges,
+            xf.tgt_ranges, imgdiff, patch_info, compress_target)
 
         if message:
           with lock:
@@ -1193,13 +1506,11 @@ class BlockImageDiff(object):
     while threads:
       threads.pop().join()
 
-    if error_messages:
-      logger.error('ERROR:')
-      logger.error('\n'.join(error_messages))
-      logger.error('\n\n\n')
-      sys.exit(1)
-
-    return patches
+  @staticmethod
+  def _TransferName(xf):
+    if xf.tgt_name == xf.src_name:
+      return xf.tgt_name
+    return xf.tgt_name + " (from " + xf.src_name + ")"
 
   def SelectAndConvertDiffTransfersToNew(self, violated_stash_blocks):
     """Converts the diff transfers to reduce the max simultaneous stash.
@@ -69,24 +69,23 @@ def GetDiskUsage(path):
   Returns:
     The number of bytes based on a 1K block_size.
   """
-  cmd = ["du", "-b", "-k", "-s", path]
-  output = common.RunAndCheckOutput(cmd, verbose=False)
-  return int(output.split()[0]) * 1024
+  return common.GetTreeUsage(path).disk_usage
 
 
-def GetInodeUsage(path):
+def GetInodeUsage(path, tree_usage=None):
   """Returns the number of inodes that "path" occupies on host.
 
   Args:
     path: The directory or file to calculate inode number on.
+    tree_usage: The common.TreeUsage of path, if it's already been calculated.
 
   Returns:
     The number of inodes used.
   """
-  cmd = ["find", path, "-print"]
-  output = common.RunAndCheckOutput(cmd, verbose=False)
+  if tree_usage is None:
+    tree_usage = common.GetTreeUsage(path)
   # increase by > 6% as number of files and directories is not whole picture.
-  inodes = output.count('\n')
+  inodes = tree_usage.inodes
   spare_inodes = inodes * 6 // 100
   min_spare_inodes = 12
   if spare_inodes < min_spare_inodes:
@@ -550,6 +549,8 @@ def BuildImage(in_dir, prop_dict, out_file, target_out=None):
 
   disable_sparse = "disable_sparse" in prop_dict
   mkfs_output = None
+  # The usage of in_dir, which is scanned at most once per image.
+  in_dir_usage = None
   if (prop_dict.get("use_dynamic_partition_size") == "true" and
           "partition_size" not in prop_dict):
     # If partition_size is not defined, use output of `du' + reserved_size.
@@ -564,7 +565,8 @@ def BuildImage(in_dir, prop_dict, out_file, target_out=None):
       else:
         size = GetDiskUsage(out_file)
     else:
-      size = GetDiskUsage(in_dir)
+      in_dir_usage = common.GetTreeUsage(in_dir)
+      size = in_dir_usage.disk_usage
     logger.info(
         "The tree size of %s is %d MB.", in_dir, size // BYTES_IN_MB)
     size = CalculateSizeAndReserved(prop_dict, size)
@@ -574,7 +576,8 @@ def BuildImage(in_dir, prop_dict, out_file, target_out=None):
       prop_dict["partition_size"] = str(size)
       prop_dict["image_size"] = str(size)
       if "extfs_inode_count" not in prop_dict:
-        prop_dict["extfs_inode_count"] = str(GetInodeUsage(in_dir))
+        prop_dict["extfs_inode_count"] = str(
+            GetInodeUsage(in_dir, in_dir_usage))
       logger.info(
           "First Pass based on estimates of %d MB and %s inodes.",
           size // BYTES_IN_MB, prop_dict["extfs_inode_count"])
@@ -294,44 +294,41 @@ class TargetFiles(object):
     # APKs in the archive. If we do have compressed APKs in the archive, then we
     # must decompress them individually before we perform any analysis.
 
-    # This is the list of wildcards of files we extract from |filename|.
-    apk_extensions = ['*.apk', '*.apex']
+    # This is the list of extensions of files we extract from |filename|.
+    apk_extensions = ('.apk', '.apex')
 
-    with zipfile.ZipFile(filename, "r") as input_zip:
-      self.certmap, compressed_extension = common.ReadApkCerts(input_zip)
-    if compressed_extension:
-      apk_extensions.append('*.apk' + compressed_extension)
-
-    d = common.UnzipTemp(filename, apk_extensions)
     self.apks = {}
     self.apks_by_basename = {}
-    for dirpath, _, filenames in os.walk(d):
-      for fn in filenames:
+    # Only the APKs and APEXes get extracted, one at a time while they are
+    # processed, instead of unzipping them all upfront.
+    with common.LazyTargetFiles(filename) as input_zip:
+      self.certmap, compressed_extension = common.ReadApkCerts(input_zip)
+      if compressed_extension:
+        apk_extensions += ('.apk' + compressed_extension,)
+
+      for info in input_zip.infolist():
+        fn = info.filename
+        if not fn.endswith(apk_extensions):
+          continue
+        fullname = input_zip.Extract(fn)
+
         # Decompress compressed APKs before we begin processing them.
         if compressed_extension and fn.endswith(compressed_extension):
           # First strip the compressed extension from the file.
-          uncompressed_fn = fn[:-len(compressed_extension)]
-
-          # Decompress the compressed file to the output file.
-          common.Gunzip(os.path.join(dirpath, fn),
-                        os.path.join(dirpath, uncompressed_fn))
-
-          # Finally, delete the compressed file and use the uncompressed file
-          # for further processing. Note that the deletion is not strictly
-          # required, but is done here to ensure that we're not using too much
-          # space in the temporary directory.
-          os.remove(os.path.join(dirpath, fn))
-          fn = uncompressed_fn
-
-        if fn.endswith(('.apk', '.apex')):
-          fullname = os.path.join(dirpath, fn)
-          displayname = fullname[len(d)+1:]
-          apk = APK(fullname, displayname)
-          self.apks[apk.filename] = apk
-          self.apks_by_basename[os.path.basename(apk.filename)] = apk
-          if apk.package:
-            self.max_pkg_len = max(self.max_pkg_len, len(apk.package))
-          self.max_fn_len = max(self.max_fn_len, len(apk.filename))
+          fn = fn[:-len(compressed_extension)]
+
+          # Decompress the compressed file to the output file, next to the
+          # extracted one, which is left as is.
+          uncompressed_fullname = fullname[:-len(compressed_extension)]
+          common.Gunzip(fullname, uncompressed_fullname)
+          fullname = uncompressed_fullname
+
+        apk = APK(fullname, fn)
+        self.apks[apk.filename] = apk
+        self.apks_by_basename[os.path.basename(apk.filename)] = apk
+        if apk.package:
+          self.max_pkg_len = max(self.max_pkg_len, len(apk.package))
+        self.max_fn_len = max(self.max_fn_len, len(apk.filename))
 
   def CheckSharedUids(self):
     """Look for any instances where packages signed with different
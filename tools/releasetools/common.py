@@ -23,6 +23,7 @@ import fnmatch
 import getopt
 import getpass
 import gzip
+import heapq
 import imp
 import json
 import logging
@@ -34,19 +35,22 @@ import shlex
 import shutil
 import subprocess
 import stat
+import struct
 import sys
 import tempfile
 import threading
 import time
 import zipfile
+import zlib
 
+from concurrent.futures import ThreadPoolExecutor
 from typing import Iterable, Callable
 from dataclasses import dataclass
 from hashlib import sha1, sha256
 
 import images
 import sparse_img
-from blockimgdiff import BlockImageDiff
+from blockimgdiff import BlockImageDiff, PatchCache
 
 logger = logging.getLogger(__name__)
 
@@ -96,6 +100,12 @@ class Options(object):
     self.source_info_dict = None
     self.target_info_dict = None
     self.worker_threads = None
+    # Whether BlockImageDiff computes the patches in worker processes.
+    self.use_worker_processes = False
+    # The directory and the max size in bytes of the bsdiff/imgdiff patch cache
+    # used by BlockImageDiff. No cache is used if the directory is None.
+    self.patch_cache_dir = None
+    self.patch_cache_size = 10 * 1024 * 1024 * 1024
     # Stash size cannot exceed cache_size * threshold.
     self.cache_size = None
     self.stash_threshold = 0.8
@@ -107,6 +117,9 @@ OPTIONS = Options()
 # The block size that's used across the releasetools scripts.
 BLOCK_SIZE = 4096
 
+# The size of a zip local file header, excluding the filename and extra field.
+ZIP_LOCAL_HEADER_SIZE = 30
+
 # Values for "certificate" in apkcerts that mean special things.
 SPECIAL_CERT_STRINGS = ("PRESIGNED", "EXTERNAL")
 
@@ -336,6 +349,101 @@ def RoundUpTo4K(value):
   return rounded_up - (rounded_up % 4096)
 
 
+@dataclass
+class TreeUsage:
+  """The host usage of a file or a directory tree."""
+  # The apparent size in bytes, counting each hard-linked file once.
+  size: int
+  # The size rounded up to 1K, as given by `du -b -k -s`.
+  disk_usage: int
+  # The number of files and directories, as listed by `find -print`.
+  inodes: int
+
+
+def _ScanDirEntries(entries, dirs):
+  """Adds up the usage of directory entries, without following symlinks.
+
+  Args:
+    entries: The os.DirEntry's to scan.
+    dirs: A list, to which the paths of the subdirectories are appended.
+
+  Returns:
+    (size, linked files, number of entries), where the size excludes the files
+    with more than one hard link. These are in a dict of {(st_dev, st_ino):
+    st_size} instead, so that each of them is counted once.
+  """
+  size = 0
+  linked = {}
+  count = 0
+  for entry in entries:
+    count += 1
+    entry_stat = entry.stat(follow_symlinks=False)
+    if entry.is_dir(follow_symlinks=False):
+      dirs.append(entry.path)
+    elif entry_stat.st_nlink > 1:
+      linked[(entry_stat.st_dev, entry_stat.st_ino)] = entry_stat.st_size
+      continue
+    size += entry_stat.st_size
+  return size, linked, count
+
+
+def _ScanTree(path):
+  """Returns the _ScanDirEntries() result for all the entries under path."""
+  size = 0
+  linked = {}
+  count = 0
+  dirs = [path]
+  while dirs:
+    with os.scandir(dirs.pop()) as entries:
+      dir_size, dir_linked, dir_count = _ScanDirEntries(entries, dirs)
+    size += dir_size
+    linked.update(dir_linked)
+    count += dir_count
+  return size, linked, count
+
+
+def GetTreeUsage(path, num_workers=None):
+  """Returns the TreeUsage of a file or a directory tree on host.
+
+  The tree is scanned in one pass, with its top-level subdirectories scanned in
+  parallel. Symlinks aren't followed.
+
+  Args:
+    path: The file or directory to calculate the usage of.
+    num_workers: The number of threads to scan the subdirectories with, which
+        defaults to OPTIONS.worker_threads, or the CPU count if that's not set.
+
+  Returns:
+    A TreeUsage.
+  """
+  path_stat = os.lstat(path)
+  if not stat.S_ISDIR(path_stat.st_mode):
+    size = path_stat.st_size
+    return TreeUsage(size, (size + 1023) // 1024 * 1024, 1)
+
+  subdirs = []
+  with os.scandir(path) as entries:
+    size, linked, count = _ScanDirEntries(entries, subdirs)
+  size += path_stat.st_size
+  count += 1
+
+  if num_workers is None:
+    num_workers = OPTIONS.worker_threads or os.cpu_count() or 1
+  num_workers = max(1, min(num_workers, len(subdirs)))
+  if num_workers == 1:
+    results = map(_ScanTree, subdirs)
+  else:
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+      results = list(executor.map(_ScanTree, subdirs))
+  for subdir_size, subdir_linked, subdir_count in results:
+    size += subdir_size
+    linked.update(subdir_linked)
+    count += subdir_count
+  size += sum(linked.values())
+
+  return TreeUsage(size, (size + 1023) // 1024 * 1024, count)
+
+
 def CloseInheritedPipes():
   """ Gmake in MAC OS has file descriptor (PIPE) leak. We close those fds
   before doing other work."""
@@ -810,8 +918,15 @@ def WriteToInputFile(input_file, fn, str: str):
 
 
 def ExtractFromInputFile(input_file, fn):
-  """Extracts the contents of fn from input zipfile or directory into a file."""
-  if isinstance(input_file, zipfile.ZipFile):
+  """Extracts the contents of fn from input zipfile or directory into a file.
+
+  The returned file must be treated as read-only. For an input directory, it's
+  the file in that directory, and for a LazyTargetFiles, it's the extracted
+  file shared by all callers. Copy it before modifying it.
+  """
+  if isinstance(input_file, LazyTargetFiles):
+    return input_file.Extract(fn)
+  elif isinstance(input_file, zipfile.ZipFile):
     tmp_file = MakeTempFile(os.path.basename(fn))
     with open(tmp_file, 'wb') as f:
       f.write(input_file.read(fn))
@@ -2176,56 +2291,239 @@ def UnzipSingleFile(input_zip: zipfile.ZipFile, info: zipfile.ZipInfo, dirname:
   return target
 
 
-def UnzipToDir(filename, dirname, patterns=None):
+def FixZip64HeaderOffsets(entries):
+  """Fixes up the local header offsets of the given zip64 entries in place.
+
+  b/283033491
+  Per the central directory file header in
+  https://en.wikipedia.org/wiki/ZIP_(file_format)#Central_directory_file_header,
+  in zip64 mode, central directory record's header_offset field might be
+  set to 0xFFFFFFFF if header offset is > 2^32. In this case, the extra
+  fields will contain an 8 byte little endian integer at offset 20
+  to indicate the actual local header offset.
+  As of python3.11, python does not handle zip64 central directories
+  correctly, so we will manually do the parsing here.
+
+  Args:
+    entries: A list of zipfile.ZipInfo, as returned by ZipFile.infolist().
+  """
+  # ZIP64 central directory extra field has two required fields:
+  # 2 bytes header ID and 2 bytes size field. Thes two require fields have
+  # a total size of 4 bytes. Then it has three other 8 bytes field, followed
+  # by a 4 byte disk number field. The last disk number field is not required
+  # to be present, but if it is present, the total size of extra field will be
+  # divisible by 8(because 2+2+4+8*n is always going to be multiple of 8)
+  # Most extra fields are optional, but when they appear, their must appear
+  # in the order defined by zip64 spec. Since file header offset is the 2nd
+  # to last field in zip64 spec, it will only be at last 8 bytes or last 12-4
+  # bytes, depending on whether disk number is present.
+  for entry in entries:
+    if entry.header_offset == 0xFFFFFFFF:
+      if len(entry.extra) % 8 == 0:
+        entry.header_offset = int.from_bytes(entry.extra[-12:-4], "little")
+      else:
+        entry.header_offset = int.from_bytes(entry.extra[-8:], "little")
+
+
+def ReadZipEntryDataOffset(zip_fp, info):
+  """Returns the offset of the data of the given entry in the zip file.
+
+  Args:
+    zip_fp: The zip file, opened in binary mode.
+    info: The zipfile.ZipInfo of the entry, with the zip64 header offset fixed.
+  """
+  # The lengths of the filename and extra field in the local header may
+  # differ from the ones in the central directory.
+  zip_fp.seek(info.header_offset)
+  header = zip_fp.read(ZIP_LOCAL_HEADER_SIZE)
+  if len(header) != ZIP_LOCAL_HEADER_SIZE or header[:4] != b"PK\x03\x04":
+    raise ValueError("Bad local file header for {}".format(info.filename))
+  name_len, extra_len = struct.unpack("<HH", header[26:30])
+  return info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_len + extra_len
+
+
+def CopyFileRange(src_fd, dst_fd, offset, size):
+  """Copies size bytes at offset of src_fd to the current position of dst_fd.
+
+  The data is copied in the kernel with copy_file_range(2) or sendfile(2) where
+  available, falling back to plain reads and writes otherwise.
+  """
+  copy_funcs = []
+  if hasattr(os, "copy_file_range"):
+    copy_funcs.append(
+        lambda count, pos: os.copy_file_range(src_fd, dst_fd, count, pos))
+  if hasattr(os, "sendfile") and sys.platform.startswith("linux"):
+    copy_funcs.append(
+        lambda count, pos: os.sendfile(dst_fd, src_fd, pos, count))
+  copy_funcs.append(lambda count, pos: os.write(
+      dst_fd, os.pread(src_fd, min(count, 1024 * 1024), pos)))
+
+  end = offset + size
+  while offset < end:
+    try:
+      copied = copy_funcs[0](end - offset, offset)
+    except OSError as e:
+      # E.g. copy_file_range(2) doesn't support cross-filesystem copies on
+      # older kernels.
+      if len(copy_funcs) == 1 or e.errno not in (
+          errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+        raise
+      copy_funcs.pop(0)
+      continue
+    if copied == 0:
+      raise ExternalError(
+          "Unexpected EOF when copying {} bytes at {}".format(end - offset,
+                                                               offset))
+    offset += copied
+
+
+def _UnzipStoredEntry(zip_fp, info, dirname):
+  """Extracts a stored regular file by copying its data in the kernel.
+
+  The copied data is then read back to check its CRC, like ZipFile.extract()
+  does.
+
+  Returns False if the entry can't take the fast path, in which case the caller
+  should extract it with UnzipSingleFile().
+
+  Raises:
+    zipfile.BadZipFile: If the extracted data doesn't match the entry's CRC.
+  """
+  unix_filetype = info.external_attr >> 16
+  if (info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1 or
+      info.is_dir() or stat.S_ISLNK(unix_filetype)):
+    return False
+  # Leave the names that need sanitizing to ZipFile.extract().
+  if (info.filename.startswith("/") or
+      ".." in info.filename.split("/") or "\\" in info.filename):
+    return False
+
+  target = os.path.join(dirname, info.filename)
+  data_offset = ReadZipEntryDataOffset(zip_fp, info)
+  with open(target, "w+b") as output_fp:
+    CopyFileRange(zip_fp.fileno(), output_fp.fileno(), data_offset,
+                  info.file_size)
+    output_fp.seek(0)
+    crc = 0
+    while True:
+      data = output_fp.read(1024 * 1024)
+      if not data:
+        break
+      crc = zlib.crc32(data, crc)
+  if crc != info.CRC:
+    raise zipfile.BadZipFile("Bad CRC-32 for file {}".format(info.filename))
+  os.chmod(target, (unix_filetype & 0o777) | 0o644)
+  return True
+
+
+def _UnzipEntries(filename, entries, dirname):
+  """Extracts the given entries, with a ZipFile handle of its own."""
+  with zipfile.ZipFile(filename, allowZip64=True, mode="r") as input_zip, \
+          open(filename, "rb") as zip_fp:
+    for info in entries:
+      if not _UnzipStoredEntry(zip_fp, info, dirname):
+        UnzipSingleFile(input_zip, info, dirname)
+
+
+def UnzipToDir(filename, dirname, patterns=None, num_workers=None,
+               names=None):
   """Unzips the archive to the given directory.
 
+  The entries are extracted in parallel, with the work split by compressed size
+  across num_workers threads. Stored entries are copied in the kernel.
+
   Args:
     filename: The name of the zip file to unzip.
     dirname: Where the unziped files will land.
     patterns: Files to unzip from the archive. If omitted, will unzip the entire
         archvie. Non-matching patterns will be filtered out. If there's no match
         after the filtering, no file will be unzipped.
+    num_workers: The number of worker threads. Defaults to
+        OPTIONS.worker_threads, or the CPU count if that's not set.
+    names: A set of the exact names of the entries to unzip, which are further
+        filtered by patterns if given.
   """
   with zipfile.ZipFile(filename, allowZip64=True, mode="r") as input_zip:
     # Filter out non-matching patterns. unzip will complain otherwise.
     entries = input_zip.infolist()
-    # b/283033491
-    # Per https://en.wikipedia.org/wiki/ZIP_(file_format)#Central_directory_file_header
-    # In zip64 mode, central directory record's header_offset field might be
-    # set to 0xFFFFFFFF if header offset is > 2^32. In this case, the extra
-    # fields will contain an 8 byte little endian integer at offset 20
-    # to indicate the actual local header offset.
-    # As of python3.11, python does not handle zip64 central directories
-    # correctly, so we will manually do the parsing here.
-
-    # ZIP64 central directory extra field has two required fields:
-    # 2 bytes header ID and 2 bytes size field. Thes two require fields have
-    # a total size of 4 bytes. Then it has three other 8 bytes field, followed
-    # by a 4 byte disk number field. The last disk number field is not required
-    # to be present, but if it is present, the total size of extra field will be
-    # divisible by 8(because 2+2+4+8*n is always going to be multiple of 8)
-    # Most extra fields are optional, but when they appear, their must appear
-    # in the order defined by zip64 spec. Since file header offset is the 2nd
-    # to last field in zip64 spec, it will only be at last 8 bytes or last 12-4
-    # bytes, depending on whether disk number is present.
-    for entry in entries:
-      if entry.header_offset == 0xFFFFFFFF:
-        if len(entry.extra) % 8 == 0:
-          entry.header_offset = int.from_bytes(entry.extra[-12:-4], "little")
-        else:
-          entry.header_offset = int.from_bytes(entry.extra[-8:], "little")
+    FixZip64HeaderOffsets(entries)
+    if names is not None:
+      entries = [info for info in entries if info.filename in names]
+      if not entries:
+        return
     if patterns is not None:
-      filtered = [info for info in entries if any(
-          [fnmatch.fnmatch(info.filename, p) for p in patterns])]
-
       # There isn't any matching files. Don't unzip anything.
-      if not filtered:
+      if not patterns:
         return
-      for info in filtered:
-        UnzipSingleFile(input_zip, info, dirname)
-    else:
-      for info in entries:
+      matcher = re.compile("|".join(fnmatch.translate(p) for p in patterns))
+      entries = [info for info in entries if matcher.match(info.filename)]
+      if not entries:
+        return
+
+    # Create the directories upfront, so that the workers don't race on them.
+    files = []
+    for info in entries:
+      if info.is_dir():
         UnzipSingleFile(input_zip, info, dirname)
+      else:
+        files.append(info)
+    for parent in {os.path.dirname(info.filename) for info in files}:
+      if parent:
+        os.makedirs(os.path.join(dirname, parent), exist_ok=True)
+
+  if num_workers is None:
+    num_workers = OPTIONS.worker_threads or os.cpu_count() or 1
+  num_workers = max(1, min(num_workers, len(files)))
+
+  # Assign the largest entries first, each to the least loaded worker.
+  workloads = [(0, i, []) for i in range(num_workers)]
+  for info in sorted(files, key=lambda info: info.compress_size,
+                     reverse=True):
+    load, i, worker_entries = heapq.heappop(workloads)
+    worker_entries.append(info)
+    heapq.heappush(workloads, (load + info.compress_size, i, worker_entries))
+
+  if num_workers == 1:
+    _UnzipEntries(filename, files, dirname)
+    return
+  with ThreadPoolExecutor(max_workers=num_workers) as executor:
+    for future in [executor.submit(_UnzipEntries, filename, worker_entries,
+                                   dirname)
+                   for _, _, worker_entries in workloads]:
+      future.result()
+
+
+class LazyTargetFiles(zipfile.ZipFile):
+  """A read-only target-files zip that materializes entries on demand.
+
+  Instead of extracting the whole archive upfront (e.g. with UnzipTemp()),
+  entries are extracted into a temp dir on their first access to Extract().
+  Being a zipfile.ZipFile, it can be passed to the functions that take an
+  input zip, such as ReadFromInputFile(), ExtractFromInputFile() and
+  LoadInfoDict(). The extracted files are shared by all callers, and must not
+  be modified.
+  """
+
+  def __init__(self, filename):
+    super(LazyTargetFiles, self).__init__(filename, "r", allowZip64=True)
+    FixZip64HeaderOffsets(self.infolist())
+    self._extract_lock = threading.Lock()
+    self._extract_dir = None
+    self._extracted = {}
+
+  def Extract(self, fn):
+    """Returns the path to the entry fn, extracting it on first access.
+
+    Raises:
+      KeyError: If the entry doesn't exist.
+    """
+    info = self.getinfo(fn)
+    with self._extract_lock:
+      if fn not in self._extracted:
+        if self._extract_dir is None:
+          self._extract_dir = MakeTempDir(prefix="targetfiles-")
+        self._extracted[fn] = UnzipSingleFile(self, info, self._extract_dir)
+      return self._extracted[fn]
 
 
 def UnzipTemp(filename, patterns=None):
@@ -2317,7 +2615,7 @@ def GetNonSparseImage(which, tmpdir):
   # ota_from_target_files.py (since LMP).
   assert os.path.exists(path) and os.path.exists(mappath)
 
-  return images.FileImage(path)
+  return images.FileImage(path, use_mmap=True)
 
 
 def GetSparseImage(which, tmpdir, input_zip, allow_shared_blocks):
@@ -2349,7 +2647,8 @@ def GetSparseImage(which, tmpdir, input_zip, allow_shared_blocks):
   clobbered_blocks = "0"
 
   image = sparse_img.SparseImage(
-      path, mappath, clobbered_blocks, allow_shared_blocks=allow_shared_blocks)
+      path, mappath, clobbered_blocks, allow_shared_blocks=allow_shared_blocks,
+      use_mmap=True)
 
   # block.map may contain less blocks, because mke2fs may skip allocating blocks
   # if they contain all zeros. We can't reconstruct such a file from its block
@@ -3056,6 +3355,296 @@ def ZipWriteStr(zip_file, zinfo_or_arcname, data, perms=None,
   zip_file.writestr(zinfo, data)
   zipfile.ZIP64_LIMIT = saved_zip64_limit
 
+
+def _StripZip64Extra(extra):
+  """Returns the extra field without the zip64 extended information."""
+  stripped = b""
+  i = 0
+  while i + 4 <= len(extra):
+    header_id, size = struct.unpack("<HH", extra[i:i + 4])
+    if header_id != 0x0001:
+      stripped += extra[i:i + 4 + size]
+    i += 4 + size
+  return stripped
+
+
+# The header ID of the extra field that aligns the data of the stored entries,
+# as added by signapk.jar and zipalign.
+ZIP_ALIGNMENT_EXTRA_ID = 0xd935
+
+
+def _SplitZipExtraPadding(extra):
+  """Splits the alignment padding off the local extra field of an entry.
+
+  Returns:
+    A tuple of (extra, alignment, padded), where extra is the extra field
+    without the zip64 field, the alignment field and the padding; alignment is
+    the value of the alignment field (ZIP_ALIGNMENT_EXTRA_ID), or None if there
+    isn't one; and padded tells whether the extra field had zero padding, as
+    added by zipalign.
+  """
+  stripped = b""
+  alignment = None
+  padded = False
+  i = 0
+  while i + 4 <= len(extra):
+    header_id, size = struct.unpack("<HH", extra[i:i + 4])
+    if header_id == ZIP_ALIGNMENT_EXTRA_ID and size >= 2:
+      alignment = struct.unpack("<H", extra[i + 4:i + 6])[0]
+    elif header_id == 0 and size == 0:
+      padded = True
+    elif header_id != 0x0001:
+      stripped += extra[i:i + 4 + size]
+    i += 4 + size
+  if i < len(extra):
+    padded = True
+  return stripped, alignment, padded
+
+
+class _RawZipWriter(object):
+  """Writes a ZIP file out of the entries of other ZIP files.
+
+  The compressed data of the entries is copied verbatim, without being
+  decompressed. The stored entries keep the alignment of their data, as given
+  by signapk.jar or zipalign, by padding their local extra fields again at
+  their new offsets.
+  """
+
+  def __init__(self, output_fp):
+    self.output_fp = output_fp
+    self.entries = []
+
+  def CopyEntry(self, input_fp, info):
+    """Appends an entry of the ZIP file input_fp.
+
+    Args:
+      input_fp: The input ZIP file, opened in binary mode.
+      info: The zipfile.ZipInfo of the entry, with the zip64 header offset
+          fixed.
+    """
+    input_fp.seek(info.header_offset)
+    header = input_fp.read(ZIP_LOCAL_HEADER_SIZE)
+    if len(header) != ZIP_LOCAL_HEADER_SIZE or header[:4] != b"PK\x03\x04":
+      raise ValueError("Bad local file header for {}".format(info.filename))
+    name_len, extra_len = struct.unpack("<HH", header[26:30])
+    input_fp.seek(name_len, os.SEEK_CUR)
+    local_extra = input_fp.read(extra_len)
+    data_offset = info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_len + \
+        extra_len
+
+    zinfo = copy.copy(info)
+    # The sizes and CRC go to the local header, so there's no need for a data
+    # descriptor. The zip64 extra fields are added back as needed.
+    zinfo.flag_bits &= ~0x08
+    zinfo.extra = _StripZip64Extra(info.extra)
+    zinfo.header_offset = self.output_fp.tell()
+    zip64 = (zinfo.file_size > zipfile.ZIP64_LIMIT or
+             zinfo.compress_size > zipfile.ZIP64_LIMIT)
+
+    extra, alignment, padded = _SplitZipExtraPadding(local_extra)
+    has_alignment_field = alignment is not None
+    # zipalign pads the extra field with zeros, to 4 bytes by default. The
+    # zip64 field would come after the padding, so such zip64 entries are left
+    # unaligned.
+    if not has_alignment_field and not zip64:
+      if padded:
+        alignment = min(data_offset & -data_offset, 4096)
+      elif data_offset % 4 == 0:
+        alignment = 4
+
+    def GetLocalExtra(padding):
+      if has_alignment_field:
+        return extra + struct.pack("<HHH", ZIP_ALIGNMENT_EXTRA_ID,
+                                   2 + padding, alignment) + b"\0" * padding
+      return extra + b"\0" * padding
+
+    local_info = copy.copy(zinfo)
+    local_info.extra = GetLocalExtra(0)
+    if info.compress_type == zipfile.ZIP_STORED and alignment:
+      new_data_offset = zinfo.header_offset + len(
+          local_info.FileHeader(zip64))
+      local_info.extra = GetLocalExtra(-new_data_offset % alignment)
+
+    self.output_fp.write(local_info.FileHeader(zip64))
+    self.output_fp.flush()
+    CopyFileRange(input_fp.fileno(), self.output_fp.fileno(), data_offset,
+                  zinfo.compress_size)
+    # Resync the buffered file object with the fd that has been written to.
+    self.output_fp.seek(0, os.SEEK_END)
+    self.entries.append(zinfo)
+
+  def Finish(self, comment=b""):
+    """Writes the central directory, in the same way as zipfile."""
+    central_dir_offset = self.output_fp.tell()
+    for zinfo in self.entries:
+      dt = zinfo.date_time
+      dosdate = (dt[0] - 1980) << 9 | dt[1] << 5 | dt[2]
+      dostime = dt[3] << 11 | dt[4] << 5 | (dt[5] // 2)
+      zip64_fields = []
+      file_size = zinfo.file_size
+      compress_size = zinfo.compress_size
+      if (file_size > zipfile.ZIP64_LIMIT or
+              compress_size > zipfile.ZIP64_LIMIT):
+        zip64_fields += [file_size, compress_size]
+        file_size = compress_size = 0xffffffff
+      header_offset = zinfo.header_offset
+      if header_offset > zipfile.ZIP64_LIMIT:
+        zip64_fields.append(header_offset)
+        header_offset = 0xffffffff
+      extra = zinfo.extra
+      extract_version = zinfo.extract_version
+      create_version = zinfo.create_version
+      if zip64_fields:
+        extra = struct.pack("<HH" + "Q" * len(zip64_fields), 0x0001,
+                            8 * len(zip64_fields), *zip64_fields) + extra
+        extract_version = max(zipfile.ZIP64_VERSION, extract_version)
+        create_version = max(zipfile.ZIP64_VERSION, create_version)
+      flag_bits = zinfo.flag_bits
+      try:
+        filename = zinfo.filename.encode("ascii")
+      except UnicodeEncodeError:
+        filename = zinfo.filename.encode("utf-8")
+        flag_bits |= 0x800
+      self.output_fp.write(struct.pack(
+          zipfile.structCentralDir, zipfile.stringCentralDir, create_version,
+          zinfo.create_system, extract_version, zinfo.reserved, flag_bits,
+          zinfo.compress_type, dostime, dosdate, zinfo.CRC, compress_size,
+          file_size, len(filename), len(extra), len(zinfo.comment), 0,
+          zinfo.internal_attr, zinfo.external_attr, header_offset))
+      self.output_fp.write(filename + extra + zinfo.comment)
+
+    end_offset = self.output_fp.tell()
+    count = len(self.entries)
+    size = end_offset - central_dir_offset
+    offset = central_dir_offset
+    if (count > 0xffff or size > zipfile.ZIP64_LIMIT or
+            offset > zipfile.ZIP64_LIMIT):
+      self.output_fp.write(struct.pack(
+          zipfile.structEndArchive64, zipfile.stringEndArchive64, 44,
+          zipfile.ZIP64_VERSION, zipfile.ZIP64_VERSION, 0, 0, count, count,
+          size, offset))
+      self.output_fp.write(struct.pack(
+          zipfile.structEndArchive64Locator, zipfile.stringEndArchive64Locator,
+          0, end_offset, 1))
+      count = min(count, 0xffff)
+      size = min(size, 0xffffffff)
+      offset = min(offset, 0xffffffff)
+    self.output_fp.write(struct.pack(
+        zipfile.structEndArchive, zipfile.stringEndArchive, 0, 0, count,
+        count, size, offset, len(comment)))
+    self.output_fp.write(comment)
+    self.output_fp.flush()
+
+
+def _RecompressZipEntry(input_zip, info, output_zip, compress_type):
+  """Appends the entry to output_zip, recompressed with compress_type."""
+  zinfo = copy.copy(info)
+  zinfo.extra = _StripZip64Extra(info.extra)
+  zinfo.compress_type = compress_type
+  with input_zip.open(info) as input_fp, \
+          output_zip.open(zinfo, "w", force_zip64=(
+              info.file_size > zipfile.ZIP64_LIMIT)) as output_fp:
+    shutil.copyfileobj(input_fp, output_fp, 1024 * 1024)
+
+
+def ZipRewrite(input_zip, output_zip, entries_to_delete=None,
+               entries_to_replace=None, compress_types=None):
+  """Rewrites a ZIP file.
+
+  Entries that aren't touched have their compressed data copied verbatim,
+  without being decompressed, and the stored ones keep their alignment. The
+  order of the entries is kept, with the new entries from entries_to_replace
+  appended at the end.
+
+  Args:
+    input_zip: The name of the input ZIP file.
+    output_zip: The name of the output ZIP file, which may be input_zip.
+    entries_to_delete: The list of names of the entries to be deleted.
+    entries_to_replace: A dict that maps the names of the entries to the paths
+        of the files to replace their contents, which are written with
+        ZipWrite(). Entries that don't exist yet get added.
+    compress_types: A dict that maps the names of the entries to the new
+        compress types, e.g. zipfile.ZIP_STORED.
+  """
+  entries_to_delete = set(entries_to_delete or [])
+  entries_to_replace = entries_to_replace or {}
+  compress_types = compress_types or {}
+
+  # http://b/18015246
+  saved_zip64_limit = zipfile.ZIP64_LIMIT
+  zipfile.ZIP64_LIMIT = (1 << 32) - 1
+
+  output_dir = os.path.dirname(os.path.abspath(output_zip))
+  fd, new_zipfile = tempfile.mkstemp(dir=output_dir)
+  os.close(fd)
+  fd, staging_zipfile = tempfile.mkstemp(dir=output_dir)
+  os.close(fd)
+  try:
+    with zipfile.ZipFile(input_zip, "r", allowZip64=True) as zin:
+      entries = zin.infolist()
+      comment = zin.comment
+    FixZip64HeaderOffsets(entries)
+    existing = set(info.filename for info in entries)
+    new_entries = [name for name in entries_to_replace if name not in existing]
+
+    # The replaced and recompressed entries are written with zipfile to a
+    # staging ZIP file first, in the order that they go to the output.
+    with zipfile.ZipFile(input_zip, "r", allowZip64=True) as zin, \
+            zipfile.ZipFile(staging_zipfile, "w",
+                            compression=zipfile.ZIP_DEFLATED,
+                            allowZip64=True) as staging_zip:
+      for info in entries:
+        if info.filename in entries_to_delete:
+          continue
+        if info.filename in entries_to_replace:
+          ZipWrite(staging_zip, entries_to_replace[info.filename],
+                   info.filename,
+                   compress_type=compress_types.get(info.filename))
+        elif compress_types.get(info.filename, info.compress_type) != \
+                info.compress_type:
+          _RecompressZipEntry(zin, info, staging_zip,
+                              compress_types[info.filename])
+      for name in new_entries:
+        ZipWrite(staging_zip, entries_to_replace[name], name,
+                 compress_type=compress_types.get(name))
+    with zipfile.ZipFile(staging_zipfile, "r", allowZip64=True) as staging_zip:
+      staged_entries = staging_zip.infolist()
+    FixZip64HeaderOffsets(staged_entries)
+    staged_entries = iter(staged_entries)
+
+    with open(input_zip, "rb") as input_fp, \
+            open(staging_zipfile, "rb") as staging_fp, \
+            open(new_zipfile, "wb") as output_fp:
+      writer = _RawZipWriter(output_fp)
+      for info in entries:
+        if info.filename in entries_to_delete:
+          continue
+        if (info.filename in entries_to_replace or
+                compress_types.get(info.filename, info.compress_type) !=
+                info.compress_type):
+          writer.CopyEntry(staging_fp, next(staged_entries))
+        else:
+          writer.CopyEntry(input_fp, info)
+      for _ in new_entries:
+        writer.CopyEntry(staging_fp, next(staged_entries))
+      writer.Finish(comment)
+    # mkstemp() creates the file as 0600. Keep the mode of an existing output,
+    # e.g. when rewriting in place, or give a new one the default mode.
+    if os.path.exists(output_zip):
+      mode = stat.S_IMODE(os.stat(output_zip).st_mode)
+    else:
+      umask = os.umask(0)
+      os.umask(umask)
+      mode = 0o666 & ~umask
+    os.chmod(new_zipfile, mode)
+    os.replace(new_zipfile, output_zip)
+  finally:
+    zipfile.ZIP64_LIMIT = saved_zip64_limit
+    for filename in (new_zipfile, staging_zipfile):
+      if os.path.exists(filename):
+        os.remove(filename)
+
+
 def ZipExclude(input_zip, output_zip, entries, force=False):
   """Deletes entries from a ZIP file.
 
@@ -3075,14 +3664,7 @@ def ZipExclude(input_zip, output_zip, entries, force=False):
       raise ExternalError(
           "Failed to delete zip entries, name not matched: %s" % entries)
 
-    fd, new_zipfile = tempfile.mkstemp(dir=os.path.dirname(input_zip))
-    os.close(fd)
-    cmd = ["zip2zip", "-i", input_zip, "-o", new_zipfile]
-    for entry in entries:
-      cmd.append("-x")
-      cmd.append(entry)
-    RunAndCheckOutput(cmd)
-  os.replace(new_zipfile, output_zip)
+  ZipRewrite(input_zip, output_zip, entries_to_delete=entries)
 
 
 def ZipDelete(zip_filename, entries, force=False):
@@ -3375,7 +3957,8 @@ def ComputeDifferences(diffs):
 
 class BlockDifference(object):
   def __init__(self, partition, tgt, src=None, check_first_block=False,
-               version=None, disable_imgdiff=False):
+               version=None, disable_imgdiff=False, threads=None,
+               process_pool=None):
     self.tgt = tgt
     self.src = src
     self.partition = partition
@@ -3389,9 +3972,19 @@ class BlockDifference(object):
     assert version >= 3
     self.version = version
 
-    b = BlockImageDiff(tgt, src, threads=OPTIONS.worker_threads,
+    patch_cache = None
+    if OPTIONS.patch_cache_dir:
+      patch_cache = PatchCache(OPTIONS.patch_cache_dir,
+                               OPTIONS.patch_cache_size)
+
+    if threads is None:
+      threads = OPTIONS.worker_threads
+    b = BlockImageDiff(tgt, src, threads=threads,
                        version=self.version,
-                       disable_imgdiff=self.disable_imgdiff)
+                       disable_imgdiff=self.disable_imgdiff,
+                       use_processes=OPTIONS.use_worker_processes,
+                       patch_cache=patch_cache,
+                       process_pool=process_pool)
     self.path = os.path.join(MakeTempDir(), partition)
     b.Compute(self.path)
     self._required_cache = b.max_stashed_size
@@ -3433,6 +4026,17 @@ class BlockDifference(object):
   def required_cache(self):
     return self._required_cache
 
+  def Close(self):
+    """Closes the images, which must not be used afterwards.
+
+    This releases the mappings of the images opened by GetUserImage(), instead
+    of leaving them until the images are garbage collected. The images that
+    don't have a Close() method are left as is.
+    """
+    for image in (self.tgt, self.src):
+      if hasattr(image, "Close"):
+        image.Close()
+
   def WriteScript(self, script, output_zip, progress=None,
                   write_verify_script=False):
     if not self.src:
@@ -11,6 +11,8 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific
 
+import collections
+import mmap
 import os
 import threading
 from hashlib import sha1
@@ -19,9 +21,86 @@ from rangelib import RangeSet
 
 __all__ = ["EmptyImage", "DataImage", "FileImage"]
 
+# The number of blocks to read at a time when classifying the blocks of a
+# FileImage, or when reading its ranges from the file.
+FILE_READ_BLOCKS = 256
+
+
+def CloseMappedView(view):
+  """Releases a memoryview of an mmap, and closes the mapping.
+
+  If slices of the view are still in use, closing the mapping raises a
+  BufferError. The mapping is then left to be unmapped once they are freed.
+  """
+  mapping = view.obj
+  view.release()
+  try:
+    mapping.close()
+  except BufferError:
+    pass
+
 
 class Image(object):
-  def RangeSha1(self, ranges):
+  """The interface of the images that BlockImageDiff works on.
+
+  The same ranges are hashed several times when generating a block-based OTA,
+  e.g. when finding the transfers, revising the stash size and writing the
+  transfer list. RangeSha1() memoizes the hashes by the ranges, in a cache
+  that evicts the least recently used hash past RANGE_SHA1_CACHE_SIZE hashes.
+  The subclasses call Image.__init__(), and implement _RangeSha1() to hash the
+  image data.
+
+  range_sha1_hits and range_sha1_misses count the hashes that are found in
+  and missing from the cache, respectively.
+  """
+
+  # The maximum number of the memoized range hashes of an image.
+  RANGE_SHA1_CACHE_SIZE = 8192
+
+  def __init__(self):
+    self.range_sha1_cache = collections.OrderedDict()
+    self.range_sha1_lock = threading.Lock()
+    self.range_sha1_hits = 0
+    self.range_sha1_misses = 0
+
+  def RangeSha1(self, ranges, use_cache=True):
+    """Returns the SHA-1 hash of the data in ranges, as a hex string.
+
+    Args:
+      ranges: A RangeSet, or an iterable of the (start, end) block pairs.
+      use_cache: Whether to look up and memoize the hash in the cache. The
+          hash is always computed from the image data if False.
+    """
+    if not use_cache:
+      return self._RangeSha1(ranges)
+
+    if isinstance(ranges, RangeSet):
+      key = ranges.data
+    else:
+      key = tuple(block for pair in ranges for block in pair)
+    with self.range_sha1_lock:
+      digest = self.range_sha1_cache.get(key)
+      if digest is not None:
+        self.range_sha1_cache.move_to_end(key)
+        self.range_sha1_hits += 1
+        return digest
+      self.range_sha1_misses += 1
+
+    # Hash the data outside the lock, so that different ranges can be hashed
+    # concurrently.
+    digest = self._RangeSha1(ranges)
+    with self.range_sha1_lock:
+      self.range_sha1_cache[key] = digest
+      while len(self.range_sha1_cache) > self.RANGE_SHA1_CACHE_SIZE:
+        self.range_sha1_cache.popitem(last=False)
+    return digest
+
+  def ClearRangeSha1Cache(self):
+    """Forgets the memoized hashes, e.g. after the image data is changed."""
+    with self.range_sha1_lock:
+      self.range_sha1_cache.clear()
+
+  def _RangeSha1(self, ranges):
     raise NotImplementedError
 
   def ReadRangeSet(self, ranges):
@@ -38,6 +117,7 @@ class EmptyImage(Image):
   """A zero-length image."""
 
   def __init__(self):
+    Image.__init__(self)
     self.blocksize = 4096
     self.care_map = RangeSet()
     self.clobbered_blocks = RangeSet()
@@ -46,7 +126,7 @@ class EmptyImage(Image):
     self.file_map = {}
     self.hashtree_info = None
 
-  def RangeSha1(self, ranges):
+  def _RangeSha1(self, ranges):
     return sha1().hexdigest()
 
   def ReadRangeSet(self, ranges):
@@ -66,6 +146,7 @@ class DataImage(Image):
   """An image wrapped around a single string of data."""
 
   def __init__(self, data, trim=False, pad=False):
+    Image.__init__(self)
     self.data = data
     self.blocksize = 4096
 
@@ -127,7 +208,7 @@ class DataImage(Image):
     for s, e in ranges:
       yield self.data[s*self.blocksize:e*self.blocksize]
 
-  def RangeSha1(self, ranges):
+  def _RangeSha1(self, ranges):
     h = sha1()
     for data in self._GetRangeData(ranges): # pylint: disable=not-an-iterable
       h.update(data)
@@ -147,9 +228,16 @@ class DataImage(Image):
 
 
 class FileImage(Image):
-  """An image wrapped around a raw image file."""
+  """An image wrapped around a raw image file.
+
+  If use_mmap is True, the image is mapped read-only into memory. Range data
+  is then returned as memoryview slices of the mapping instead of being read
+  under generator_lock, so that multiple threads can read the image
+  concurrently without extra copies.
+  """
 
-  def __init__(self, path):
+  def __init__(self, path, use_mmap=False):
+    Image.__init__(self)
     self.path = path
     self.blocksize = 4096
     self._file_size = os.path.getsize(self.path)
@@ -157,7 +245,7 @@ class FileImage(Image):
 
     if self._file_size % self.blocksize != 0:
       raise ValueError("Size of file %s must be multiple of %d bytes, but is %d"
-                       % self.path, self.blocksize, self._file_size)
+                       % (self.path, self.blocksize, self._file_size))
 
     self.total_blocks = self._file_size // self.blocksize
     self.care_map = RangeSet(data=(0, self.total_blocks))
@@ -166,18 +254,19 @@ class FileImage(Image):
 
     self.generator_lock = threading.Lock()
 
+    self._mmap = None
+    if use_mmap and self._file_size:
+      self._mmap = memoryview(
+          mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ))
+
     zero_blocks = []
     nonzero_blocks = []
-    reference = '\0' * self.blocksize
-
-    for i in range(self.total_blocks):
-      d = self._file.read(self.blocksize)
-      if d == reference:
-        zero_blocks.append(i)
-        zero_blocks.append(i+1)
+    for start, end, is_zero in self._GetZeroBlockRuns():
+      blocks = zero_blocks if is_zero else nonzero_blocks
+      if blocks and blocks[-1] == start:
+        blocks[-1] = end
       else:
-        nonzero_blocks.append(i)
-        nonzero_blocks.append(i+1)
+        blocks.extend((start, end))
 
     assert zero_blocks or nonzero_blocks
 
@@ -190,16 +279,62 @@ class FileImage(Image):
   def __del__(self):
     self._file.close()
 
+  def Close(self):
+    """Closes the image file, and unmaps it in mmap mode.
+
+    The image must not be used afterwards, but the data already returned from
+    the mapping stays valid.
+    """
+    try:
+      if self._mmap is not None:
+        mapped_view, self._mmap = self._mmap, None
+        CloseMappedView(mapped_view)
+    finally:
+      self._file.close()
+
+  def _GetZeroBlockRuns(self):
+    """Generator that classifies the blocks of the image as zero or nonzero.
+
+    Yields (start, end, is_zero) for runs of blocks, in order. The image is
+    read in large buffers that are only checked block by block if they aren't
+    all zeros.
+    """
+    zero_block = b'\0' * self.blocksize
+    zero_buffer = zero_block * FILE_READ_BLOCKS
+    ranges = [(b, min(b + FILE_READ_BLOCKS, self.total_blocks))
+              for b in range(0, self.total_blocks, FILE_READ_BLOCKS)]
+    # Each range is returned as a single piece, from the file or the mapping.
+    for (s, e), data in zip(ranges, self._GetRangeData(ranges)):
+      if zero_buffer.startswith(data):
+        yield s, e, True
+        continue
+      data = memoryview(data)
+      for i in range(e - s):
+        yield s + i, s + i + 1, zero_block.startswith(
+            data[i * self.blocksize:(i + 1) * self.blocksize])
+
   def _GetRangeData(self, ranges):
-    # Use a lock to protect the generator so that we will not run two
-    # instances of this generator on the same object simultaneously.
+    """Generator that produces all the image data in ranges.
+
+    In mmap mode, each range is returned as one memoryview slice, and no lock
+    is needed. Otherwise the data is read in pieces of up to FILE_READ_BLOCKS
+    blocks, under a lock so that we will not run two instances of this
+    generator on the same object simultaneously.
+    """
+    if self._mmap is not None:
+      for s, e in ranges:
+        yield self._mmap[s * self.blocksize:e * self.blocksize]
+      return
+
     with self.generator_lock:
       for s, e in ranges:
         self._file.seek(s * self.blocksize)
-        for _ in range(s, e):
-          yield self._file.read(self.blocksize)
+        while s < e:
+          n = min(FILE_READ_BLOCKS, e - s)
+          yield self._file.read(n * self.blocksize)
+          s += n
 
-  def RangeSha1(self, ranges):
+  def _RangeSha1(self, ranges):
     h = sha1()
     for data in self._GetRangeData(ranges): # pylint: disable=not-an-iterable
       h.update(data)
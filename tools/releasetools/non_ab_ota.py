@@ -13,12 +13,17 @@
 # limitations under the License.
 
 import collections
+import concurrent.futures
+import contextlib
 import logging
 import os
+import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 import common
 import edify_generator
+from blockimgdiff import CreatePatchPool
 import verity_utils
 from check_target_files_vintf import CheckVintfIfTrebleEnabled, HasPartition
 from common import OPTIONS
@@ -28,14 +33,54 @@ import subprocess
 logger = logging.getLogger(__name__)
 
 
+def SplitThreads(weights, num_threads):
+  """Splits a number of threads in proportion to the weights.
+
+  Each weight gets one thread, and the rest of the threads are split in
+  proportion to the weights, with the threads left over from the proportional
+  shares going to the largest fractions.
+
+  Args:
+    weights: A list of non-negative weights, no more than num_threads.
+    num_threads: The number of threads to split.
+
+  Returns:
+    A list of the numbers of threads, in the order of the weights.
+  """
+  assert len(weights) <= num_threads
+  if not any(weights):
+    weights = [1] * len(weights)
+  total = sum(weights)
+  shares = [(num_threads - len(weights)) * weight / total
+            for weight in weights]
+  threads = [1 + int(share) for share in shares]
+  spare = num_threads - sum(threads)
+  by_fraction = sorted(range(len(shares)),
+                       key=lambda i: int(shares[i]) - shares[i])
+  for i in by_fraction[:spare]:
+    threads[i] += 1
+  return threads
+
+
 def GetBlockDifferences(target_zip, source_zip, target_info, source_info,
                         device_specific):
-  """Returns a ordered dict of block differences with partition name as key."""
+  """Returns a ordered dict of block differences with partition name as key.
 
-  def GetIncrementalBlockDifferenceForPartition(name):
-    if not HasPartition(source_zip, name):
-      raise RuntimeError(
-          "can't generate incremental that adds {}".format(name))
+  The block differences of the partitions are computed concurrently, up to one
+  per worker thread (OPTIONS.worker_threads), starting from the largest
+  images. The worker threads are split between the running ones in proportion
+  to the sizes of their images, and a partition that starts later takes over
+  the threads of the one that is done.
+  """
+
+  def GetImagesForPartition(name):
+    """Returns the (target image, source image) of a partition."""
+    # Full OTA update.
+    if not source_zip:
+      tgt = common.GetUserImage(name, OPTIONS.input_tmp, target_zip,
+                                info_dict=target_info,
+                                reset_file_map=True)
+      return tgt, None
 
     partition_src = common.GetUserImage(name, OPTIONS.source_tmp, source_zip,
                                         info_dict=source_info,
@@ -44,17 +89,34 @@ def GetBlockDifferences(target_zip, source_zip, target_info, source_info,
     partition_tgt = common.GetUserImage(name, OPTIONS.target_tmp, target_zip,
                                         info_dict=target_info,
                                         allow_shared_blocks=allow_shared_blocks)
+    return partition_tgt, partition_src
 
-    # Check the first block of the source system partition for remount R/W only
-    # if the filesystem is ext4.
-    partition_source_info = source_info["fstab"]["/" + name]
-    check_first_block = partition_source_info.fs_type == "ext4"
-    # Disable imgdiff because it relies on zlib to produce stable output
-    # across different versions, which is often not the case.
-    return common.BlockDifference(name, partition_tgt, partition_src,
-                                  check_first_block,
-                                  version=blockimgdiff_version,
-                                  disable_imgdiff=True)
+  def GetBlockDifferenceForPartition(name, images, threads, process_pool):
+    start = time.time()
+    partition_tgt, partition_src = images
+    # Full OTA update.
+    if not source_zip:
+      block_diff = common.BlockDifference(name, partition_tgt, src=None,
+                                          threads=threads,
+                                          process_pool=process_pool)
+    # Incremental OTA update.
+    else:
+      # Check the first block of the source system partition for remount R/W
+      # only if the filesystem is ext4.
+      partition_source_info = source_info["fstab"]["/" + name]
+      check_first_block = partition_source_info.fs_type == "ext4"
+      # Disable imgdiff because it relies on zlib to produce stable output
+      # across different versions, which is often not the case.
+      block_diff = common.BlockDifference(name, partition_tgt, partition_src,
+                                          check_first_block,
+                                          version=blockimgdiff_version,
+                                          disable_imgdiff=True,
+                                          threads=threads,
+                                          process_pool=process_pool)
+    logger.info(
+        "Computed the block difference of %s in %.1f seconds, with %d "
+        "threads.", name, time.time() - start, threads)
+    return name, block_diff
 
   if source_zip:
     # See notes in common.GetUserImage()
@@ -65,23 +127,60 @@ def GetBlockDifferences(target_zip, source_zip, target_info, source_info,
             "blockimgdiff_versions", "1").split(","))
     assert blockimgdiff_version >= 3
 
-  block_diff_dict = collections.OrderedDict()
   partition_names = ["system", "vendor", "product", "odm", "system_ext",
                      "vendor_dlkm", "odm_dlkm", "system_dlkm"]
+  partitions = []
   for partition in partition_names:
     if not HasPartition(target_zip, partition):
       continue
-    # Full OTA update.
-    if not source_zip:
-      tgt = common.GetUserImage(partition, OPTIONS.input_tmp, target_zip,
-                                info_dict=target_info,
-                                reset_file_map=True)
-      block_diff_dict[partition] = common.BlockDifference(partition, tgt,
-                                                          src=None)
-    # Incremental OTA update.
-    else:
-      block_diff_dict[partition] = GetIncrementalBlockDifferenceForPartition(
-          partition)
+    if source_zip and not HasPartition(source_zip, partition):
+      raise RuntimeError(
+          "can't generate incremental that adds {}".format(partition))
+    partitions.append(partition)
+
+  start = time.time()
+  num_threads = max(1, OPTIONS.worker_threads or 1)
+  max_running = max(1, min(len(partitions), num_threads))
+  block_diffs = {}
+  # With --use_worker_processes, the patches of all the partitions are computed
+  # by one pool of processes, which is forked before the partition threads are
+  # started.
+  if OPTIONS.use_worker_processes and num_threads > 1:
+    process_pool_context = CreatePatchPool(num_threads)
+  else:
+    process_pool_context = contextlib.nullcontext()
+  with process_pool_context as process_pool, \
+          ThreadPoolExecutor(max_workers=max_running) as executor:
+    images = dict(zip(partitions,
+                      executor.map(GetImagesForPartition, partitions)))
+    weights = {name: sum(image.total_blocks for image in images[name]
+                         if image is not None)
+               for name in partitions}
+    pending = sorted(partitions, key=lambda name: weights[name], reverse=True)
+    first = pending[:max_running]
+    del pending[:max_running]
+    running = {}
+    for name, threads in zip(
+        first, SplitThreads([weights[name] for name in first], num_threads)):
+      future = executor.submit(GetBlockDifferenceForPartition, name,
+                               images[name], threads, process_pool)
+      running[future] = threads
+    while running:
+      done, _ = concurrent.futures.wait(
+          running, return_when=concurrent.futures.FIRST_COMPLETED)
+      for future in done:
+        threads = running.pop(future)
+        name, block_diff = future.result()
+        block_diffs[name] = block_diff
+        if pending:
+          name = pending.pop(0)
+          future = executor.submit(GetBlockDifferenceForPartition, name,
+                                   images[name], threads, process_pool)
+          running[future] = threads
+  logger.info("Computed the block differences of %d partitions in %.1f "
+              "seconds.", len(partitions), time.time() - start)
+  block_diff_dict = collections.OrderedDict(
+      (name, block_diffs[name]) for name in partitions)
   assert "system" in block_diff_dict
 
   # Get the block diffs from the device specific script. If there is a
@@ -275,6 +374,10 @@ endif;
   # FinalizeMetadata.
   common.ZipClose(output_zip)
 
+  # The images of the partitions aren't needed once the package is written.
+  for block_diff in block_diff_dict.values():
+    block_diff.Close()
+
   needed_property_files = (
       NonAbOtaPropertyFiles(),
   )
@@ -530,6 +633,10 @@ endif;
   # FinalizeMetadata().
   common.ZipClose(output_zip)
 
+  # The images of the partitions aren't needed once the package is written.
+  for block_diff in block_diff_dict.values():
+    block_diff.Close()
+
   # Sign the generated zip package unless no_signing is specified.
   needed_property_files = (
       NonAbOtaPropertyFiles(),
@@ -19,6 +19,7 @@ Given a target-files zipfile, produces an OTA package that installs that build.
 An incremental OTA is produced if -i is given, otherwise a full OTA is produced.
 
 Usage:  ota_from_target_files [options] input_target_files output_ota_package
+        ota_from_target_files [options] --batch <manifest>
 
 Common options that apply to both of non-A/B and A/B OTAs
 
@@ -135,6 +136,22 @@ Non-A/B OTA specific options
       Specify the number of worker-threads that will be used when generating
       patches for incremental updates (defaults to 3).
 
+  --use_worker_processes
+      Use worker processes instead of threads when generating the block-based
+      patches for non-A/B incremental updates. The workers reopen the sparse
+      images on their own, and the number of workers is given by
+      --worker_threads. Falls back to threads for non-sparse images.
+
+  --patch_cache_dir <dir>
+      Use the given directory to cache the bsdiff/imgdiff patches for non-A/B
+      incremental updates, keyed by the source and target data. The directory
+      can be shared across runs, e.g. when generating incrementals from the
+      same source build to multiple targets.
+
+  --patch_cache_size <int>
+      The max size in bytes of the patch cache (defaults to 10 GiB). The least
+      recently used patches are evicted when exceeded.
+
   --verify
       Verify the checksums of the updated system and vendor (if any) partitions.
       Non-A/B incremental OTAs only.
@@ -264,18 +281,51 @@ A/B OTA specific options
 
   --compression_factor
       Specify the maximum block size to be compressed at once during OTA. supported options: 4k, 8k, 16k, 32k, 64k, 128k, 256k
+
+Batch options
+
+  --batch <manifest>
+      Generate all the OTA packages listed in the given JSON manifest, instead
+      of the one for the input_target_files and output_ota_package arguments,
+      which are then omitted. The manifest is a list of jobs, e.g.
+
+        [{"target": "target_files.zip", "output": "full_ota.zip"},
+         {"target": "target_files.zip", "source": "old_target_files.zip",
+          "output": "incremental_ota.zip",
+          "args": ["--partial", "system vendor"]}]
+
+      where "args" holds the options of the job, on top of the ones given on
+      the command line. Each distinct target-files zip of an A/B build is
+      extracted, and its info dict loaded, only once for all the jobs, which
+      then run concurrently.
+
+  --batch_cpu_budget <int>
+      The number of CPUs that the concurrent jobs of --batch share (default:
+      the number of CPUs). At most that many jobs run at a time, and each one
+      gets an equal share as its --max_threads and --worker_threads, unless its
+      args set them.
+
+  --batch_workspace <dir>
+      Extract the target-files zips of --batch into the given dir, in subdirs
+      named by their contents, and keep them there. Later runs with the same
+      workspace reuse them. Defaults to a temp dir.
 """
 
 from __future__ import print_function
 
+import hashlib
+import json
 import logging
 import multiprocessing
+import multiprocessing.connection
 import os
 import os.path
 import re
-import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+import traceback
 import zipfile
 
 import care_map_pb2
@@ -283,7 +333,7 @@ import common
 import ota_utils
 import payload_signer
 from ota_utils import (VABC_COMPRESSION_PARAM_SUPPORT, FinalizeMetadata, GetPackageMetadata,
-                       PayloadGenerator, SECURITY_PATCH_LEVEL_PROP_NAME, ExtractTargetFiles, CopyTargetFilesDir)
+                       PayloadGenerator, SECURITY_PATCH_LEVEL_PROP_NAME, ExtractTargetFiles, TargetFilesOverlay)
 from common import DoesInputFileContain, IsSparseImage
 import target_files_diff
 from non_ab_ota import GenerateNonAbOtaPackage
@@ -337,6 +387,9 @@ OPTIONS.security_patch_level = None
 OPTIONS.max_threads = None
 OPTIONS.vabc_cow_version = None
 OPTIONS.compression_factor = None
+OPTIONS.batch_manifest = None
+OPTIONS.batch_cpu_budget = None
+OPTIONS.batch_workspace = None
 
 
 POSTINSTALL_CONFIG = 'META/postinstall_config.txt'
@@ -535,67 +588,58 @@ def GetTargetFilesZipForSecondaryImages(input_file, skip_postinstall=False):
 
 
 def GetTargetFilesZipWithoutPostinstallConfig(input_file):
-  """Returns a target-files.zip that's not containing postinstall_config.txt.
+  """Returns a target-files that's not containing postinstall_config.txt.
 
   This allows brillo_update_payload script to skip writing all the postinstall
-  hooks in the generated payload. The input target-files.zip file will be
-  duplicated, with 'META/postinstall_config.txt' skipped. If input_file doesn't
-  contain the postinstall_config.txt entry, the input file will be returned.
+  hooks in the generated payload. 'META/postinstall_config.txt' is deleted from
+  the overlay, if input_file contains it.
 
   Args:
-    input_file: The input target-files.zip filename.
+    input_file: The TargetFilesOverlay of the input target-files.
 
   Returns:
-    The filename of target-files.zip that doesn't contain postinstall config.
+    The TargetFilesOverlay that doesn't contain postinstall config.
   """
-  config_path = os.path.join(input_file, POSTINSTALL_CONFIG)
-  if os.path.exists(config_path):
-    os.unlink(config_path)
+  if input_file.Exists(POSTINSTALL_CONFIG):
+    input_file.Delete(POSTINSTALL_CONFIG)
   return input_file
 
 
+# The info dicts loaded upfront by GenerateOtaPackagesInBatch(), by input path.
+# Each job runs in its own forked process, which gets its own copy.
+_preloaded_info_dicts = {}
+
+
 def ParseInfoDict(target_file_path):
+  info_dict = _preloaded_info_dicts.get(target_file_path)
+  if info_dict is not None:
+    return info_dict
   return common.LoadInfoDict(target_file_path)
 
 def ModifyTargetFilesDynamicPartitionInfo(input_file, key, value):
-  """Returns a target-files.zip with a custom VABC compression param.
+  """Returns a target-files with a custom dynamic partition info value.
   Args:
-    input_file: The input target-files.zip path
-    vabc_compression_param: Custom Virtual AB Compression algorithm
+    input_file: The TargetFilesOverlay of the input target-files
+    key: The key to set in META/dynamic_partitions_info.txt
+    value: The value to set the key to
 
   Returns:
-    The path to modified target-files.zip
+    The modified TargetFilesOverlay
   """
-  if os.path.isdir(input_file):
-    dynamic_partition_info_path = os.path.join(
-        input_file, *DYNAMIC_PARTITION_INFO.split("/"))
-    with open(dynamic_partition_info_path, "r") as fp:
-      dynamic_partition_info = fp.read()
-    dynamic_partition_info = ModifyKeyvalueList(
-        dynamic_partition_info, key, value)
-    with open(dynamic_partition_info_path, "w") as fp:
-      fp.write(dynamic_partition_info)
-    return input_file
-
-  target_file = common.MakeTempFile(prefix="targetfiles-", suffix=".zip")
-  shutil.copyfile(input_file, target_file)
-  common.ZipDelete(target_file, DYNAMIC_PARTITION_INFO)
-  with zipfile.ZipFile(input_file, 'r', allowZip64=True) as zfp:
-    dynamic_partition_info = zfp.read(DYNAMIC_PARTITION_INFO).decode()
-    dynamic_partition_info = ModifyKeyvalueList(
-        dynamic_partition_info, key, value)
-    with zipfile.ZipFile(target_file, "a", allowZip64=True) as output_zip:
-      output_zip.writestr(DYNAMIC_PARTITION_INFO, dynamic_partition_info)
-  return target_file
+  dynamic_partition_info = input_file.Read(DYNAMIC_PARTITION_INFO)
+  dynamic_partition_info = ModifyKeyvalueList(
+      dynamic_partition_info, key, value)
+  input_file.Write(DYNAMIC_PARTITION_INFO, dynamic_partition_info)
+  return input_file
 
 def GetTargetFilesZipForCustomVABCCompression(input_file, vabc_compression_param):
   """Returns a target-files.zip with a custom VABC compression param.
   Args:
-    input_file: The input target-files.zip path
+    input_file: The TargetFilesOverlay of the input target-files
     vabc_compression_param: Custom Virtual AB Compression algorithm
 
   Returns:
-    The path to modified target-files.zip
+    The modified TargetFilesOverlay
   """
   return ModifyTargetFilesDynamicPartitionInfo(input_file, "virtual_ab_compression_method", vabc_compression_param)
 
@@ -608,14 +652,14 @@ def GetTargetFilesZipForPartialUpdates(input_file, ab_partitions):
   the excluded partitions in the info file, e.g. misc_info.txt.
 
   Args:
-    input_file: The input target-files.zip filename.
+    input_file: The TargetFilesOverlay of the input target-files.
     ab_partitions: A list of partitions to include in the partial update
 
   Returns:
-    The filename of target-files.zip used for partial ota update.
+    The TargetFilesOverlay used for partial ota update.
   """
 
-  original_ab_partitions = common.ReadFromInputFile(input_file, AB_PARTITIONS)
+  original_ab_partitions = input_file.Read(AB_PARTITIONS)
 
   unrecognized_partitions = [partition for partition in ab_partitions if
                              partition not in original_ab_partitions]
@@ -625,42 +669,35 @@ def GetTargetFilesZipForPartialUpdates(input_file, ab_partitions):
 
   logger.info("Generating partial updates for %s", ab_partitions)
   for subdir in ["IMAGES", "RADIO", "PREBUILT_IMAGES"]:
-    image_dir = os.path.join(subdir)
-    if not os.path.exists(image_dir):
-      continue
-    for filename in os.listdir(image_dir):
-      filepath = os.path.join(image_dir, filename)
+    for filename in input_file.List(subdir):
       if filename.endswith(".img"):
         partition_name = filename.removesuffix(".img")
         if partition_name not in ab_partitions:
-          os.unlink(filepath)
+          input_file.Delete(subdir + "/" + filename)
 
-  common.WriteToInputFile(input_file, 'META/ab_partitions.txt',
-                          '\n'.join(ab_partitions))
+  input_file.Write('META/ab_partitions.txt', '\n'.join(ab_partitions))
   CARE_MAP_ENTRY = "META/care_map.pb"
-  if DoesInputFileContain(input_file, CARE_MAP_ENTRY):
+  if input_file.Exists(CARE_MAP_ENTRY):
     caremap = care_map_pb2.CareMap()
-    caremap.ParseFromString(
-        common.ReadBytesFromInputFile(input_file, CARE_MAP_ENTRY))
+    caremap.ParseFromString(input_file.ReadBytes(CARE_MAP_ENTRY))
     filtered = [
         part for part in caremap.partitions if part.name in ab_partitions]
     del caremap.partitions[:]
     caremap.partitions.extend(filtered)
-    common.WriteBytesToInputFile(input_file, CARE_MAP_ENTRY,
-                                 caremap.SerializeToString())
+    input_file.WriteBytes(CARE_MAP_ENTRY, caremap.SerializeToString())
 
   for info_file in ['META/misc_info.txt', DYNAMIC_PARTITION_INFO]:
-    if not DoesInputFileContain(input_file, info_file):
+    if not input_file.Exists(info_file):
       logger.warning('Cannot find %s in input zipfile', info_file)
       continue
 
-    content = common.ReadFromInputFile(input_file, info_file)
+    content = input_file.Read(info_file)
     modified_info = UpdatesInfoForSpecialUpdates(
         content, lambda p: p in ab_partitions)
     if OPTIONS.vabc_compression_param and info_file == DYNAMIC_PARTITION_INFO:
       modified_info = ModifyVABCCompressionParam(
           modified_info, OPTIONS.vabc_compression_param)
-    common.WriteToInputFile(input_file, info_file, modified_info)
+    input_file.Write(info_file, modified_info)
 
   def IsInPartialList(postinstall_line: str):
     idx = postinstall_line.find("=")
@@ -673,17 +710,15 @@ def GetTargetFilesZipForPartialUpdates(input_file, ab_partitions):
         return True
     return False
 
-  if common.DoesInputFileContain(input_file, POSTINSTALL_CONFIG):
-    postinstall_config = common.ReadFromInputFile(
-        input_file, POSTINSTALL_CONFIG)
+  if input_file.Exists(POSTINSTALL_CONFIG):
+    postinstall_config = input_file.Read(POSTINSTALL_CONFIG)
     postinstall_config = [
         line for line in postinstall_config.splitlines() if IsInPartialList(line)]
     if postinstall_config:
       postinstall_config = "\n".join(postinstall_config)
-      common.WriteToInputFile(
-          input_file, POSTINSTALL_CONFIG, postinstall_config)
+      input_file.Write(POSTINSTALL_CONFIG, postinstall_config)
     else:
-      os.unlink(os.path.join(input_file, POSTINSTALL_CONFIG))
+      input_file.Delete(POSTINSTALL_CONFIG)
 
   return input_file
 
@@ -697,13 +732,13 @@ def GetTargetFilesZipForRetrofitDynamicPartitions(input_file,
   bits on the block devices. Postinstall is disabled.
 
   Args:
-    input_file: The input target-files.zip filename.
+    input_file: The TargetFilesOverlay of the input target-files.
     super_block_devices: The list of super block devices
     dynamic_partition_list: The list of dynamic partitions
 
   Returns:
-    The filename of target-files.zip with *.img replaced with super_*.img for
-    each block device in super_block_devices.
+    The TargetFilesOverlay with *.img replaced with super_*.img for each block
+    device in super_block_devices.
   """
   assert super_block_devices, "No super_block_devices are specified."
 
@@ -713,8 +748,7 @@ def GetTargetFilesZipForRetrofitDynamicPartitions(input_file,
   # Remove partitions from META/ab_partitions.txt that is in
   # dynamic_partition_list but not in super_block_devices so that
   # brillo_update_payload won't generate update for those logical partitions.
-  ab_partitions_lines = common.ReadFromInputFile(
-      input_file, AB_PARTITIONS).split("\n")
+  ab_partitions_lines = input_file.Read(AB_PARTITIONS).split("\n")
   ab_partitions = [line.strip() for line in ab_partitions_lines]
   # Assert that all super_block_devices are in ab_partitions
   super_device_not_updated = [partition for partition in super_block_devices
@@ -736,25 +770,24 @@ def GetTargetFilesZipForRetrofitDynamicPartitions(input_file,
   to_delete += list(replace.values())
   to_delete += ['IMAGES/{}.map'.format(dev) for dev in super_block_devices]
   for item in to_delete:
-    os.unlink(os.path.join(input_file, item))
+    input_file.Delete(item)
 
   # Write super_{foo}.img as {foo}.img.
   for src, dst in replace.items():
-    assert DoesInputFileContain(input_file, src), \
-        'Missing {} in {}; {} cannot be written'.format(src, input_file, dst)
-    source_path = os.path.join(input_file, *src.split("/"))
-    target_path = os.path.join(input_file, *dst.split("/"))
-    os.rename(source_path, target_path)
+    assert input_file.Exists(src), \
+        'Missing {} in {}; {} cannot be written'.format(
+            src, input_file.base, dst)
+    input_file.Rename(src, dst)
 
   # Write new ab_partitions.txt file
-  new_ab_partitions = os.path.join(input_file, AB_PARTITIONS)
-  with open(new_ab_partitions, 'w') as f:
-    for partition in ab_partitions:
-      if (partition in dynamic_partition_list and
-              partition not in super_block_devices):
-        logger.info("Dropping %s from ab_partitions.txt", partition)
-        continue
-      f.write(partition + "\n")
+  new_ab_partitions = []
+  for partition in ab_partitions:
+    if (partition in dynamic_partition_list and
+            partition not in super_block_devices):
+      logger.info("Dropping %s from ab_partitions.txt", partition)
+      continue
+    new_ab_partitions.append(partition + "\n")
+  input_file.Write(AB_PARTITIONS, "".join(new_ab_partitions))
 
   return input_file
 
@@ -766,24 +799,23 @@ def GetTargetFilesZipForCustomImagesUpdates(input_file, custom_images: dict):
   and puts the custom images into the target target-files.zip.
 
   Args:
-    input_file: The input target-files extracted directory
+    input_file: The TargetFilesOverlay of the input target-files
     custom_images: A map of custom partitions and custom images.
 
   Returns:
-    The extracted dir of a target-files.zip which has renamed the custom images
-    in the IMAGES/ to their partition names.
+    The TargetFilesOverlay which has renamed the custom images in the IMAGES/
+    to their partition names.
   """
   for custom_image in custom_images.values():
-    if not os.path.exists(os.path.join(input_file, "IMAGES", custom_image)):
+    if not input_file.Exists("IMAGES/" + custom_image):
       raise ValueError("Specified custom image {} not found in target files {}, available images are {}",
-                       custom_image, input_file, os.listdir(os.path.join(input_file, "IMAGES")))
+                       custom_image, input_file.base, input_file.List("IMAGES"))
 
   for custom_partition, custom_image in custom_images.items():
     default_custom_image = '{}.img'.format(custom_partition)
     if default_custom_image != custom_image:
-      src = os.path.join(input_file, 'IMAGES', custom_image)
-      dst = os.path.join(input_file, 'IMAGES', default_custom_image)
-      os.rename(src, dst)
+      input_file.Rename('IMAGES/' + custom_image,
+                        'IMAGES/' + default_custom_image)
 
   return input_file
 
@@ -828,15 +860,18 @@ def SupportsMainlineGkiUpdates(target_file):
   if target_file is None:
     return False
   if os.path.isfile(target_file):
-    target_file = common.UnzipTemp(target_file, ["IMAGES/product.img"])
-  if not os.path.isdir(target_file):
+    with common.LazyTargetFiles(target_file) as input_zip:
+      if not common.DoesInputFileContain(input_zip, "IMAGES/product.img"):
+        return False
+      image_file = input_zip.Extract("IMAGES/product.img")
+  else:
     assert os.path.isdir(target_file), \
         "{} must be a path to zip archive or dir containing extracted"\
         " target_files".format(target_file)
-  image_file = os.path.join(target_file, "IMAGES", "product.img")
+    image_file = os.path.join(target_file, "IMAGES", "product.img")
 
-  if not os.path.isfile(image_file):
-    return False
+    if not os.path.isfile(image_file):
+      return False
 
   if IsSparseImage(image_file):
     # Unsparse the image
@@ -851,13 +886,6 @@ def SupportsMainlineGkiUpdates(target_file):
   return pattern.search(output) is not None
 
 
-def ExtractOrCopyTargetFiles(target_file):
-  if os.path.isdir(target_file):
-    return CopyTargetFilesDir(target_file)
-  else:
-    return ExtractTargetFiles(target_file)
-
-
 def ValidateCompressionParam(target_info):
   vabc_compression_param = OPTIONS.vabc_compression_param
   if vabc_compression_param:
@@ -869,8 +897,6 @@ def ValidateCompressionParam(target_info):
 
 def GenerateAbOtaPackage(target_file, output_file, source_file=None):
   """Generates an Android OTA package that has A/B update payload."""
-  # If input target_files are directories, create a copy so that we can modify
-  # them directly
   target_info = common.BuildInfo(OPTIONS.info_dict, OPTIONS.oem_dicts)
   if OPTIONS.disable_vabc and target_info.is_release_key:
     raise ValueError("Disabling VABC on release-key builds is not supported.")
@@ -878,9 +904,12 @@ def GenerateAbOtaPackage(target_file, output_file, source_file=None):
   ValidateCompressionParam(target_info)
   vabc_compression_param = target_info.vabc_compression_param
 
-  target_file = ExtractOrCopyTargetFiles(target_file)
+  # The input target_files are never modified. The target is edited through a
+  # copy-on-write overlay instead, which is materialized once all the edits
+  # below are made.
+  target_files = TargetFilesOverlay(target_file)
   if source_file is not None:
-    source_file = ExtractOrCopyTargetFiles(source_file)
+    source_file = TargetFilesOverlay(source_file).Materialize()
   # Stage the output zip package for package signing.
   if not OPTIONS.no_signing:
     staging_file = common.MakeTempFile(suffix='.zip')
@@ -1026,28 +1055,32 @@ def GenerateAbOtaPackage(target_file, output_file, source_file=None):
 
   # Prepare custom images.
   if OPTIONS.custom_images:
-    target_file = GetTargetFilesZipForCustomImagesUpdates(
-        target_file, OPTIONS.custom_images)
+    target_files = GetTargetFilesZipForCustomImagesUpdates(
+        target_files, OPTIONS.custom_images)
 
   if OPTIONS.retrofit_dynamic_partitions:
-    target_file = GetTargetFilesZipForRetrofitDynamicPartitions(
-        target_file, target_info.get("super_block_devices").strip().split(),
+    target_files = GetTargetFilesZipForRetrofitDynamicPartitions(
+        target_files, target_info.get("super_block_devices").strip().split(),
         target_info.get("dynamic_partition_list").strip().split())
   elif OPTIONS.partial:
-    target_file = GetTargetFilesZipForPartialUpdates(target_file,
-                                                     OPTIONS.partial)
+    target_files = GetTargetFilesZipForPartialUpdates(target_files,
+                                                      OPTIONS.partial)
   if vabc_compression_param != target_info.vabc_compression_param:
-    target_file = GetTargetFilesZipForCustomVABCCompression(
-        target_file, vabc_compression_param)
+    target_files = GetTargetFilesZipForCustomVABCCompression(
+        target_files, vabc_compression_param)
   if OPTIONS.vabc_cow_version:
-    target_file = ModifyTargetFilesDynamicPartitionInfo(target_file, "virtual_ab_cow_version", OPTIONS.vabc_cow_version)
+    target_files = ModifyTargetFilesDynamicPartitionInfo(target_files, "virtual_ab_cow_version", OPTIONS.vabc_cow_version)
   if OPTIONS.compression_factor:
-    target_file = ModifyTargetFilesDynamicPartitionInfo(target_file, "virtual_ab_compression_factor", OPTIONS.compression_factor)
+    target_files = ModifyTargetFilesDynamicPartitionInfo(target_files, "virtual_ab_compression_factor", OPTIONS.compression_factor)
   if OPTIONS.skip_postinstall:
-    target_file = GetTargetFilesZipWithoutPostinstallConfig(target_file)
+    target_files = GetTargetFilesZipWithoutPostinstallConfig(target_files)
   # Target_file may have been modified, reparse ab_partitions
-  target_info.info_dict['ab_partitions'] = common.ReadFromInputFile(target_file,
-                                                                    AB_PARTITIONS).strip().split("\n")
+  target_info.info_dict['ab_partitions'] = target_files.Read(
+      AB_PARTITIONS).strip().split("\n")
+
+  # All the edits are made. Link (or extract) the rest of the input
+  # target_files, which the checks below and delta_generator read from disk.
+  target_file = target_files.Materialize()
 
   from check_target_files_vintf import CheckVintfIfTrebleEnabled
   CheckVintfIfTrebleEnabled(target_file, target_info)
@@ -1191,6 +1224,194 @@ def GenerateAbOtaPackage(target_file, output_file, source_file=None):
                    package_key=OPTIONS.package_key)
 
 
+def GetTargetFilesDigest(target_file):
+  """Returns a digest of the entries of a target-files zip.
+
+  The digest covers the names, CRCs and sizes of the entries, which tell the
+  content of a target-files apart without reading all of it.
+  """
+  digest = hashlib.sha256()
+  with zipfile.ZipFile(target_file, allowZip64=True) as zfp:
+    for info in zfp.infolist():
+      digest.update("{} {:08x} {}\n".format(
+          info.filename, info.CRC, info.file_size).encode())
+  return digest.hexdigest()
+
+
+def ExtractBatchInput(target_file, workspace):
+  """Extracts a target-files zip into the workspace, unless it already is.
+
+  The extracted dir is named by the digest of the zip, so that the same build
+  is only extracted once, whatever its path.
+
+  Returns:
+    The path to the extracted dir.
+  """
+  extracted_dir = os.path.join(workspace, GetTargetFilesDigest(target_file))
+  if os.path.isdir(extracted_dir):
+    logger.info("Reusing %s extracted in %s", target_file, extracted_dir)
+    return extracted_dir
+  # Extract into a temp dir first, so that an interrupted extraction is never
+  # reused.
+  tmp_dir = tempfile.mkdtemp(prefix="extracting-", dir=workspace)
+  ExtractTargetFiles(target_file, tmp_dir)
+  os.rename(tmp_dir, extracted_dir)
+  return extracted_dir
+
+
+def LoadBatchManifest(manifest):
+  """Loads the jobs of a --batch manifest, and checks their fields."""
+  with open(manifest) as f:
+    jobs = json.load(f)
+  if not isinstance(jobs, list):
+    raise ValueError("Expected a list of jobs in {}".format(manifest))
+  for job in jobs:
+    unknown_fields = set(job) - {"target", "source", "output", "args"}
+    if unknown_fields or "target" not in job or "output" not in job:
+      raise ValueError("Invalid job {} in {}; a job has a target, an output, "
+                       "and an optional source and args".format(job, manifest))
+  return jobs
+
+
+def _UsesTargetFilesZip(job_args):
+  """Returns whether a job reads more of its inputs than an A/B OTA does."""
+  if OPTIONS.force_non_ab or OPTIONS.log_diff or OPTIONS.extracted_input:
+    return True
+  return any(arg.split("=")[0] in ("--force_non_ab", "--log_diff",
+                                   "--extracted_input_target_files")
+             for arg in job_args)
+
+
+def _RunBatchJob(job_argv, result_conn):
+  """Runs main() on job_argv in a batch job process.
+
+  Sends the traceback of the error that failed the job, or None, to
+  result_conn.
+  """
+  # The process is forked for this job only. It inherits the options from the
+  # batch command line, and the temp files of the batch, such as the extracted
+  # inputs. Only clean up the ones created by the job.
+  OPTIONS.batch_manifest = None
+  OPTIONS.tempfiles = []
+  error = None
+  try:
+    main(job_argv)
+  except (Exception, SystemExit):  # pylint: disable=broad-except
+    error = traceback.format_exc()
+  finally:
+    common.Cleanup()
+  result_conn.send(error)
+  result_conn.close()
+
+
+def GenerateOtaPackagesInBatch(manifest):
+  """Generates the OTA packages of the jobs in a --batch manifest.
+
+  Each distinct target-files zip of an A/B build is extracted once, and its
+  info dict is loaded once, for all the jobs. The jobs then run concurrently in
+  forked processes, with the CPUs in OPTIONS.batch_cpu_budget shared among
+  them, e.g. for the threads of delta_generator.
+
+  Raises:
+    ExternalError: If any of the jobs failed.
+  """
+  jobs = LoadBatchManifest(manifest)
+  if not jobs:
+    return
+  workspace = OPTIONS.batch_workspace
+  if workspace is None:
+    workspace = common.MakeTempDir(prefix="ota_batch-")
+  else:
+    os.makedirs(workspace, exist_ok=True)
+
+  # Map each input to the path that its jobs should read, i.e. to the
+  # extracted dir of an A/B build, unless a job needs the zip itself.
+  ab_inputs = set()
+  checked_inputs = set()
+  for job in jobs:
+    if _UsesTargetFilesZip(job.get("args", [])):
+      continue
+    for input_file in (job["target"], job.get("source")):
+      if (input_file is None or input_file in checked_inputs or
+              os.path.isdir(input_file)):
+        continue
+      checked_inputs.add(input_file)
+      misc_info = common.LoadDictionaryFromLines(
+          common.ReadFromInputFile(input_file, MISC_INFO).split("\n"))
+      if misc_info.get("ab_update") == "true":
+        ab_inputs.add(input_file)
+  input_paths = {input_file: ExtractBatchInput(input_file, workspace)
+                 for input_file in sorted(ab_inputs)}
+
+  job_argvs = []
+  for job in jobs:
+    job_args = job.get("args", [])
+    if _UsesTargetFilesZip(job_args):
+      paths = {}
+    else:
+      paths = input_paths
+    target = paths.get(job["target"], job["target"])
+    argv = list(job_args)
+    source = job.get("source")
+    if source is not None:
+      source = paths.get(source, source)
+      argv = ["--incremental_from", source] + argv
+    job_argvs.append(argv + [target, job["output"]])
+
+    for input_file in (target, source):
+      if input_file is not None and input_file not in _preloaded_info_dicts:
+        _preloaded_info_dicts[input_file] = common.LoadInfoDict(input_file)
+
+  cpu_budget = OPTIONS.batch_cpu_budget or multiprocessing.cpu_count()
+  num_processes = max(1, min(len(jobs), cpu_budget))
+  threads = str(max(1, cpu_budget // num_processes))
+  logger.info("Generating %d OTA packages, %d at a time with %s threads each",
+              len(jobs), num_processes, threads)
+  # The options given to a job come after the shares of the CPU budget, so they
+  # take precedence.
+  job_argvs = [["--max_threads", threads, "--worker_threads", threads] + argv
+               for argv in job_argvs]
+
+  # Each job runs in its own forked process, as a job modifies the global
+  # OPTIONS. The processes aren't daemonic (unlike those of a Pool), so a job
+  # may start worker processes of its own, e.g. for --use_worker_processes.
+  # A job takes one of the num_processes slots to run, so that the jobs stay
+  # within the CPU budget.
+  context = multiprocessing.get_context("fork")
+  slots = threading.BoundedSemaphore(num_processes)
+  pending_argvs = list(job_argvs)
+  running_jobs = {}
+  failures = []
+  while pending_argvs or running_jobs:
+    while pending_argvs and slots.acquire(blocking=False):
+      argv = pending_argvs.pop(0)
+      receiver, sender = context.Pipe(duplex=False)
+      process = context.Process(target=_RunBatchJob, args=(argv, sender))
+      process.start()
+      sender.close()
+      running_jobs[receiver] = (argv, process)
+
+    for receiver in multiprocessing.connection.wait(list(running_jobs)):
+      argv, process = running_jobs.pop(receiver)
+      try:
+        error = receiver.recv()
+      except EOFError:
+        error = None
+      receiver.close()
+      process.join()
+      slots.release()
+      if error is None and process.exitcode != 0:
+        error = "The job process exited with code {}".format(process.exitcode)
+      if error is not None:
+        logger.error("Failed to generate %s:\n%s", argv[-1], error)
+        failures.append(argv[-1])
+      else:
+        logger.info("Generated %s", argv[-1])
+  if failures:
+    raise common.ExternalError(
+        "Failed to generate OTA packages: {}".format(", ".join(failures)))
+
+
 def main(argv):
 
   def option_handler(o, a):
@@ -1219,6 +1440,16 @@ def main(argv):
       else:
         raise ValueError("Cannot parse value %r for option %r - only "
                          "integers are allowed." % (a, o))
+    elif o == "--use_worker_processes":
+      OPTIONS.use_worker_processes = True
+    elif o == "--patch_cache_dir":
+      OPTIONS.patch_cache_dir = a
+    elif o == "--patch_cache_size":
+      if a.isdigit():
+        OPTIONS.patch_cache_size = int(a)
+      else:
+        raise ValueError("Cannot parse value %r for option %r - only "
+                         "integers are allowed." % (a, o))
     elif o in ("-2", "--two_step"):
       OPTIONS.two_step = True
     elif o == "--include_secondary":
@@ -1320,6 +1551,16 @@ def main(argv):
       else:
         raise ValueError("Cannot parse value %r for option %r - only "
                          "integers are allowed." % (a, o))
+    elif o == "--batch":
+      OPTIONS.batch_manifest = a
+    elif o == "--batch_cpu_budget":
+      if a.isdigit() and int(a) > 0:
+        OPTIONS.batch_cpu_budget = int(a)
+      else:
+        raise ValueError("Cannot parse value %r for option %r - only "
+                         "positive integers are allowed." % (a, o))
+    elif o == "--batch_workspace":
+      OPTIONS.batch_workspace = a
     else:
       return False
     return True
@@ -1335,6 +1576,9 @@ def main(argv):
                                  "override_timestamp",
                                  "extra_script=",
                                  "worker_threads=",
+                                 "use_worker_processes",
+                                 "patch_cache_dir=",
+                                 "patch_cache_size=",
                                  "two_step",
                                  "include_secondary",
                                  "no_signing",
@@ -1370,9 +1614,19 @@ def main(argv):
                                  "max_threads=",
                                  "vabc_cow_version=",
                                  "compression_factor=",
+                                 "batch=",
+                                 "batch_cpu_budget=",
+                                 "batch_workspace=",
                              ], extra_option_handler=[option_handler, payload_signer.signer_options])
   common.InitLogging()
 
+  if OPTIONS.batch_manifest is not None:
+    if args:
+      common.Usage(__doc__)
+      sys.exit(1)
+    GenerateOtaPackagesInBatch(OPTIONS.batch_manifest)
+    return
+
   if len(args) != 2:
     common.Usage(__doc__)
     sys.exit(1)
@@ -1387,7 +1641,7 @@ def main(argv):
   if OPTIONS.extracted_input is not None:
     OPTIONS.info_dict = common.LoadInfoDict(OPTIONS.extracted_input)
   else:
-    OPTIONS.info_dict = common.LoadInfoDict(args[0])
+    OPTIONS.info_dict = ParseInfoDict(args[0])
 
   if OPTIONS.wipe_user_data:
     if not OPTIONS.vabc_downgrade:
@@ -16,6 +16,7 @@ import copy
 import itertools
 import logging
 import os
+import re
 import shutil
 import struct
 import zipfile
@@ -77,6 +78,12 @@ def FinalizeMetadata(metadata, input_file, output_file, needed_property_files=No
   system update client. System update client can then fetch individual ZIP
   entries (ZIP_STORED) directly at the given offset of the URL.
 
+  The offsets are computed from the planned layout of the output package (see
+  PackageZipLayout), so that the METADATA entry is written once and the
+  package is signed once. The output is then verified with
+  PropertyFiles.Verify(). Should the planned layout not match the output, the
+  package is finalized again with preliminary signings instead.
+
   Args:
     metadata: The metadata dict for the package.
     input_file: The input ZIP filename that doesn't contain the package METADATA
@@ -86,8 +93,6 @@ def FinalizeMetadata(metadata, input_file, output_file, needed_property_files=No
     package_key: The key used to sign this OTA package
     pw: Password for the package_key
   """
-  no_signing = package_key is None
-
   if needed_property_files is None:
     # AbOtaPropertyFiles intends to replace StreamingPropertyFiles, as it covers
     # all the info of the latter. However, system updaters and OTA servers need to
@@ -98,6 +103,107 @@ def FinalizeMetadata(metadata, input_file, output_file, needed_property_files=No
         StreamingPropertyFiles(),
     )
 
+  try:
+    FinalizeMetadataInOnePass(metadata, input_file, output_file,
+                              needed_property_files, package_key, pw)
+  except (PackageZipLayout.UnplannedEntryException,
+          PropertyFiles.InsufficientSpaceException, AssertionError) as e:
+    logger.warning(
+        "Failed to finalize %s with a planned layout (%s), signing it in "
+        "passes instead", output_file, e)
+    FinalizeMetadataInPasses(metadata, input_file, output_file,
+                             needed_property_files, package_key, pw)
+
+  # If requested, dump the metadata to a separate file.
+  output_metadata_path = OPTIONS.output_metadata_path
+  if output_metadata_path:
+    WriteMetadata(metadata, output_metadata_path)
+
+
+def FinalizeMetadataInOnePass(metadata, input_file, output_file,
+                              needed_property_files, package_key=None, pw=None):
+  """Finalizes the metadata from the planned layout, and signs the package.
+
+  Args:
+    metadata: The metadata dict for the package.
+    input_file: The input ZIP filename. The METADATA entries are written to it.
+    output_file: The final output ZIP filename.
+    needed_property_files: The list of PropertyFiles' to be generated.
+    package_key: The key used to sign this OTA package, or None to not sign it.
+    pw: Password for the package_key
+
+  Raises:
+    PackageZipLayout.UnplannedEntryException: If a property-files entry isn't
+        a ZIP_STORED one, whose offset can be planned for the signed package.
+    PropertyFiles.InsufficientSpaceException: If the property-files strings
+        don't converge to a fixed length.
+    AssertionError: If the output doesn't match the planned layout.
+  """
+  no_signing = package_key is None
+
+  # METADATA entries left from an earlier attempt are to be replaced.
+  with zipfile.ZipFile(input_file, allowZip64=True) as input_zip:
+    stale_entries = [name for name in (METADATA_NAME, METADATA_PROTO_NAME)
+                     if name in input_zip.namelist()]
+  if stale_entries:
+    ZipDelete(input_file, stale_entries)
+
+  with zipfile.ZipFile(input_file, allowZip64=True) as input_zip:
+    # The METADATA entries are of the reserved length of the property-files
+    # strings, which in turn may depend on the entry offsets. The placeholders
+    # are recomputed from the last planned layout until the final strings fit.
+    layout = None
+    for attempt in range(3):
+      for property_files in needed_property_files:
+        metadata.property_files[property_files.name] = property_files.Compute(
+            input_zip, layout)
+      metadata_entries = [(name, len(data))
+                          for name, data in GetMetadataEntries(metadata)]
+      layout = PackageZipLayout(input_zip, metadata_entries,
+                                signed=not no_signing)
+      try:
+        for property_files in needed_property_files:
+          metadata.property_files[property_files.name] = (
+              property_files.Finalize(
+                  input_zip, len(metadata.property_files[property_files.name]),
+                  layout))
+        break
+      except PropertyFiles.InsufficientSpaceException:
+        if attempt == 2:
+          raise
+
+  with zipfile.ZipFile(input_file, 'a', allowZip64=True) as output_zip:
+    WriteMetadata(metadata, output_zip)
+
+  if no_signing:
+    logger.info(f"Signing disabled for output file {output_file}")
+    shutil.copy(input_file, output_file)
+  else:
+    logger.info(
+        f"Signing the output file {output_file} with key {package_key}")
+    SignOutput(input_file, output_file, package_key, pw)
+
+  # Reopen the final zip to check the planned layout.
+  with zipfile.ZipFile(output_file, allowZip64=True) as output_zip:
+    for property_files in needed_property_files:
+      property_files.Verify(
+          output_zip, metadata.property_files[property_files.name].strip())
+
+
+def FinalizeMetadataInPasses(metadata, input_file, output_file,
+                             needed_property_files, package_key=None, pw=None):
+  """Finalizes the metadata with preliminary signings, and signs the package.
+
+  Args:
+    metadata: The metadata dict for the package.
+    input_file: The input ZIP filename.
+    output_file: The final output ZIP filename.
+    needed_property_files: The list of PropertyFiles' to be generated.
+    package_key: The key used to sign this OTA package, or None to not sign it.
+    pw: Password for the package_key
+  """
+  no_signing = package_key is None
+
   def ComputeAllPropertyFiles(input_file, needed_property_files):
     # Write the current metadata entry with placeholders.
     with zipfile.ZipFile(input_file, 'r', allowZip64=True) as input_zip:
@@ -161,10 +267,22 @@ def FinalizeMetadata(metadata, input_file, output_file, needed_property_files=No
       property_files.Verify(
           output_zip, metadata.property_files[property_files.name].strip())
 
-  # If requested, dump the metadata to a separate file.
-  output_metadata_path = OPTIONS.output_metadata_path
-  if output_metadata_path:
-    WriteMetadata(metadata, output_metadata_path)
+
+def GetMetadataEntries(metadata_proto):
+  """Returns the METADATA entries of the package.
+
+  Args:
+    metadata_proto: The metadata protobuf for the package.
+
+  Returns:
+    A list of (entry name, entry data in bytes), in the order they are written
+    to the package.
+  """
+  metadata_dict = BuildLegacyOtaMetadata(metadata_proto)
+  legacy_metadata = "".join(["%s=%s\n" % kv for kv in
+                             sorted(metadata_dict.items())])
+  return [(METADATA_PROTO_NAME, metadata_proto.SerializeToString()),
+          (METADATA_NAME, legacy_metadata.encode())]
 
 
 def WriteMetadata(metadata_proto, output):
@@ -177,20 +295,17 @@ def WriteMetadata(metadata_proto, output):
       {output}.pb, e.g. ota_metadata.pb
   """
 
-  metadata_dict = BuildLegacyOtaMetadata(metadata_proto)
-  legacy_metadata = "".join(["%s=%s\n" % kv for kv in
-                             sorted(metadata_dict.items())])
+  metadata_entries = GetMetadataEntries(metadata_proto)
   if isinstance(output, zipfile.ZipFile):
-    ZipWriteStr(output, METADATA_PROTO_NAME, metadata_proto.SerializeToString(),
-                compress_type=zipfile.ZIP_STORED)
-    ZipWriteStr(output, METADATA_NAME, legacy_metadata,
-                compress_type=zipfile.ZIP_STORED)
+    for name, data in metadata_entries:
+      ZipWriteStr(output, name, data, compress_type=zipfile.ZIP_STORED)
     return
 
+  metadata_data = dict(metadata_entries)
   with open('{}.pb'.format(output), 'wb') as f:
-    f.write(metadata_proto.SerializeToString())
-  with open(output, 'w') as f:
-    f.write(legacy_metadata)
+    f.write(metadata_data[METADATA_PROTO_NAME])
+  with open(output, 'wb') as f:
+    f.write(metadata_data[METADATA_NAME])
 
 
 def UpdateDeviceState(device_state, build_info, boot_variable_values,
@@ -505,6 +620,113 @@ def GetZipEntryOffset(zfp, entry_info):
   return (offset, size)
 
 
+class PackageZipLayout(object):
+  """Plans the offsets of the ZIP entries in a finalized OTA package.
+
+  The package is the input ZIP file with the given ZIP_STORED entries (i.e.
+  the METADATA entries) appended. If it's not signed, the appended entries
+  follow the existing ones, which stay in place.
+
+  If it's signed, signapk.jar rewrites the package when signing the whole file
+  (see copyFiles() and signWholeFile() in SignApk.java). It drops the existing
+  signature entries, sorts the entries by name, and writes all the ZIP_STORED
+  entries ahead of the others. The local file header of each ZIP_STORED entry
+  has an alignment extra field, without padding as whole-file signing doesn't
+  align the entries. The first one has the JAR magic extra field in addition,
+  and a large one has a ZIP64 extra field. The offsets of the other entries,
+  which signapk.jar compresses again, aren't known in advance.
+  """
+
+  # The entries that signapk.jar doesn't copy to a whole-file signed package.
+  SIGNAPK_STRIPPED_ENTRIES = re.compile(
+      r'^(META-INF/((.*)[.](SF|RSA|DSA|EC)|com/android/otacert))|'
+      r'(META-INF/MANIFEST\.MF)$')
+  SIGNAPK_PIN_BYTE_RANGE_ENTRY = 'pinlist.meta'
+
+  # The sizes of the extra fields in the local file headers by signapk.jar.
+  JAR_MAGIC_SIZE = 4
+  ALIGNMENT_EXTRA_SIZE = 6
+  ZIP64_EXTRA_SIZE = 20
+  ZIP64_MAGIC = 0xffffffff
+
+  class UnplannedEntryException(Exception):
+    pass
+
+  def __init__(self, input_zip, appended_entries, signed):
+    """Plans the layout of a package.
+
+    Args:
+      input_zip: The input ZipFile, which must stay open while the layout is
+          used.
+      appended_entries: A list of (name, size) of the ZIP_STORED entries to be
+          appended to input_zip, in the order they are written.
+      signed: Whether the package is to be signed by signapk.jar.
+    """
+    self.input_zip = input_zip
+    self.signed = signed
+    # Maps each entry name to the (offset, size) of its data, or to None if
+    # the offset isn't planned.
+    self.entries = {}
+    if self.signed:
+      self._PlanSignedPackage(appended_entries)
+    else:
+      self._PlanPackage(appended_entries)
+
+  def _PlanPackage(self, appended_entries):
+    for name in self.input_zip.namelist():
+      self.entries[name] = None
+    offset = self.input_zip.start_dir
+    for name, size in appended_entries:
+      offset += zipfile.sizeFileHeader + len(name.encode())
+      self.entries[name] = (offset, size)
+      offset += size
+
+  def _PlanSignedPackage(self, appended_entries):
+    stored_sizes = {}
+    for info in self.input_zip.infolist():
+      name = info.filename
+      if (info.is_dir() or self.SIGNAPK_STRIPPED_ENTRIES.match(name) or
+              name == self.SIGNAPK_PIN_BYTE_RANGE_ENTRY):
+        continue
+      if info.compress_type == zipfile.ZIP_STORED:
+        stored_sizes[name] = info.file_size
+      else:
+        self.entries[name] = None
+    stored_sizes.update(appended_entries)
+
+    offset = self.JAR_MAGIC_SIZE
+    for name in sorted(stored_sizes):
+      size = stored_sizes[name]
+      offset += (zipfile.sizeFileHeader + len(name.encode()) +
+                 self.ALIGNMENT_EXTRA_SIZE)
+      if size >= self.ZIP64_MAGIC:
+        offset += self.ZIP64_EXTRA_SIZE
+      self.entries[name] = (offset, size)
+      offset += size
+
+  def namelist(self):
+    """Returns the names of the entries in the package."""
+    return list(self.entries)
+
+  def GetEntryOffset(self, name):
+    """Returns the (offset, size) of the data of an entry in the package.
+
+    Raises:
+      KeyError: If the entry isn't in the package.
+      UnplannedEntryException: If the entry is to be compressed by
+          signapk.jar, which leaves its offset unknown.
+    """
+    offset_size = self.entries[name]
+    if offset_size is not None:
+      return offset_size
+    if self.signed:
+      raise self.UnplannedEntryException(
+          'Unknown offset of {}, which is compressed by signapk.jar'.format(
+              name))
+    # The existing entries stay where they are in the input ZIP file.
+    return GetZipEntryOffset(self.input_zip, self.input_zip.getinfo(name))
+
+
 class PropertyFiles(object):
   """A class that computes the property-files string for an OTA package.
 
@@ -532,6 +754,13 @@ class PropertyFiles(object):
     property_files.Finalize()
     SignOutput()
 
+  Alternatively, both passes take the offsets from a PackageZipLayout planned
+  for the signed package, which saves the initial signing.
+
+    property_files.Compute(input_zip, layout)
+    property_files.Finalize(input_zip, reserved_length, layout)
+    SignOutput()
+
   And the caller can additionally verify the final result.
 
     property_files.Verify()
@@ -542,7 +771,7 @@ class PropertyFiles(object):
     self.required = ()
     self.optional = ()
 
-  def Compute(self, input_zip):
+  def Compute(self, input_zip, layout=None):
     """Computes and returns a property-files string with placeholders.
 
     We reserve extra space for the offset and size of the metadata entry itself,
@@ -550,17 +779,20 @@ class PropertyFiles(object):
 
     Args:
       input_zip: The input ZIP file.
+      layout: An optional PackageZipLayout to take the ZIP entry offsets from,
+          instead of input_zip.
 
     Returns:
       A string with placeholders for the metadata offset/size info, e.g.
       "payload.bin:679:343,payload_properties.txt:378:45,metadata:        ".
     """
-    return self.GetPropertyFilesString(input_zip, reserve_space=True)
+    return self.GetPropertyFilesString(input_zip, reserve_space=True,
+                                       layout=layout)
 
   class InsufficientSpaceException(Exception):
     pass
 
-  def Finalize(self, input_zip, reserved_length):
+  def Finalize(self, input_zip, reserved_length, layout=None):
     """Finalizes a property-files string with actual METADATA offset/size info.
 
     The input ZIP file has been signed, with the ZIP entries in the desired
@@ -575,6 +807,8 @@ class PropertyFiles(object):
       reserved_length: The reserved length of the property-files string during
           the call to Compute(). The final string must be no more than this
           size.
+      layout: An optional PackageZipLayout of the signed package to take the
+          ZIP entry offsets from, instead of input_zip.
 
     Returns:
       A property-files string including the metadata offset/size info, e.g.
@@ -584,7 +818,8 @@ class PropertyFiles(object):
       InsufficientSpaceException: If the reserved length is insufficient to hold
           the final string.
     """
-    result = self.GetPropertyFilesString(input_zip, reserve_space=False)
+    result = self.GetPropertyFilesString(input_zip, reserve_space=False,
+                                         layout=layout)
     if len(result) > reserved_length:
       raise self.InsufficientSpaceException(
           'Insufficient reserved space: reserved={}, actual={}'.format(
@@ -607,13 +842,15 @@ class PropertyFiles(object):
     assert actual == expected, \
         "Mismatching streaming metadata: {} vs {}.".format(actual, expected)
 
-  def GetPropertyFilesString(self, zip_file, reserve_space=False):
+  def GetPropertyFilesString(self, zip_file, reserve_space=False, layout=None):
     """
     Constructs the property-files string per request.
 
     Args:
       zip_file: The input ZIP file.
       reserved_length: The reserved length of the property-files string.
+      layout: An optional PackageZipLayout to take the ZIP entry offsets from,
+          instead of zip_file.
 
     Returns:
       A property-files string including the metadata offset/size info, e.g.
@@ -622,16 +859,20 @@ class PropertyFiles(object):
 
     def ComputeEntryOffsetSize(name):
       """Computes the zip entry offset and size."""
-      info = zip_file.getinfo(name)
-      (offset, size) = GetZipEntryOffset(zip_file, info)
+      if layout is not None:
+        (offset, size) = layout.GetEntryOffset(name)
+      else:
+        info = zip_file.getinfo(name)
+        (offset, size) = GetZipEntryOffset(zip_file, info)
       return '%s:%d:%d' % (os.path.basename(name), offset, size)
 
+    namelist = (zip_file if layout is None else layout).namelist()
     tokens = []
-    tokens.extend(self._GetPrecomputed(zip_file))
+    tokens.extend(self._GetPrecomputed(zip_file, layout))
     for entry in self.required:
       tokens.append(ComputeEntryOffsetSize(entry))
     for entry in self.optional:
-      if entry in zip_file.namelist():
+      if entry in namelist:
         tokens.append(ComputeEntryOffsetSize(entry))
 
     # 'META-INF/com/android/metadata' is required. We don't know its actual
@@ -645,12 +886,12 @@ class PropertyFiles(object):
       tokens.append('metadata.pb:' + ' ' * 15)
     else:
       tokens.append(ComputeEntryOffsetSize(METADATA_NAME))
-      if METADATA_PROTO_NAME in zip_file.namelist():
+      if METADATA_PROTO_NAME in namelist:
         tokens.append(ComputeEntryOffsetSize(METADATA_PROTO_NAME))
 
     return ','.join(tokens)
 
-  def _GetPrecomputed(self, input_zip):
+  def _GetPrecomputed(self, input_zip, layout=None):
     """Computes the additional tokens to be included into the property-files.
 
     This applies to tokens without actual ZIP entries, such as
@@ -659,6 +900,8 @@ class PropertyFiles(object):
 
     Args:
       input_zip: The input zip file.
+      layout: An optional PackageZipLayout to take the ZIP entry offsets from,
+          instead of input_zip.
 
     Returns:
       A list of strings (tokens) to be added to the property-files string.
@@ -775,11 +1018,14 @@ def IsZucchiniCompatible(source_file: str, target_file: str):
   return sourceEntry and targetEntry and sourceEntry == targetEntry
 
 
-def ExtractTargetFiles(path: str):
+def ExtractTargetFiles(path: str, extracted_dir=None):
+  if isinstance(path, TargetFilesOverlay):
+    return path.Materialize()
   if os.path.isdir(path):
     logger.info("target files %s is already extracted", path)
     return path
-  extracted_dir = common.MakeTempDir("target_files")
+  if extracted_dir is None:
+    extracted_dir = common.MakeTempDir("target_files")
   logger.info(f"Extracting target files {path} to {extracted_dir}")
   common.UnzipToDir(path, extracted_dir, UNZIP_PATTERN + [""])
   for subdir in TARGET_FILES_IMAGES_SUBDIR:
@@ -1017,12 +1263,12 @@ class AbOtaPropertyFiles(StreamingPropertyFiles):
     super(AbOtaPropertyFiles, self).__init__()
     self.name = 'ota-property-files'
 
-  def _GetPrecomputed(self, input_zip):
-    offset, size = self._GetPayloadMetadataOffsetAndSize(input_zip)
+  def _GetPrecomputed(self, input_zip, layout=None):
+    offset, size = self._GetPayloadMetadataOffsetAndSize(input_zip, layout)
     return ['payload_metadata.bin:{}:{}'.format(offset, size)]
 
   @staticmethod
-  def _GetPayloadMetadataOffsetAndSize(input_zip):
+  def _GetPayloadMetadataOffsetAndSize(input_zip, layout=None):
     """Computes the offset and size of the payload metadata for a given package.
 
     (From system/update_engine/update_metadata.proto)
@@ -1059,6 +1305,9 @@ class AbOtaPropertyFiles(StreamingPropertyFiles):
 
     'payload-metadata.bin' contains all the bytes from the beginning of the
     payload, till the end of 'medatada_signature_message'.
+
+    The payload is read from input_zip, while its offset is taken from the
+    optional PackageZipLayout if given.
     """
     payload_info = input_zip.getinfo('payload.bin')
     (payload_offset, payload_size) = GetZipEntryOffset(input_zip, payload_info)
@@ -1081,6 +1330,8 @@ class AbOtaPropertyFiles(StreamingPropertyFiles):
     metadata_total = 24 + manifest_size + metadata_signature_size
     assert metadata_total <= payload_size
 
+    if layout is not None:
+      (payload_offset, _) = layout.GetEntryOffset('payload.bin')
     return (payload_offset, metadata_total)
 
 
@@ -1118,3 +1369,192 @@ def CopyTargetFilesDir(input_dir):
       os.makedirs(os.path.dirname(target_path), exist_ok=True)
       shutil.copy(path, target_path)
   return output_dir
+
+
+class TargetFilesOverlay(object):
+  """A copy-on-write view of a target-files zip or extracted directory.
+
+  The edits that prepare a target-files for delta_generator (e.g. for partial
+  or custom images updates) are kept in a temp dir, in front of the base
+  target-files, which is never modified. Entries are named by their paths in
+  the target-files, e.g. "META/ab_partitions.txt", and only the entries that
+  ExtractTargetFiles() would extract from a zip, or CopyTargetFilesDir() would
+  copy from a directory, are visible.
+
+  Materialize() completes the temp dir with the base entries that haven't been
+  edited, so however many edits are made, the base is copied at most once. The
+  images of an extracted directory are linked to instead of copied, except for
+  the sparse images, which delta_generator can't read.
+  """
+
+  def __init__(self, base):
+    self.base = base
+    self.overlay_dir = common.MakeTempDir(prefix="targetfiles-")
+    # The base entries that are deleted, or replaced by an overlay entry.
+    self._hidden = set()
+    self._materialized = False
+    if os.path.isdir(base):
+      self._base_zip = None
+    else:
+      self._base_zip = common.LazyTargetFiles(base)
+      self._base_names = {info.filename for info in self._base_zip.infolist()
+                          if not info.is_dir() and
+                          self._IsTargetFilesEntry(info.filename)}
+
+  def _IsTargetFilesEntry(self, fn):
+    if (self._base_zip is None and
+        fn.split("/")[0] in TARGET_FILES_IMAGES_SUBDIR):
+      return True
+    return Fnmatch(fn, UNZIP_PATTERN)
+
+  def _OverlayPath(self, fn):
+    return os.path.join(self.overlay_dir, *fn.split("/"))
+
+  def _BasePath(self, fn):
+    return os.path.join(self.base, *fn.split("/"))
+
+  def _InBase(self, fn):
+    if self._materialized or fn in self._hidden:
+      return False
+    if self._base_zip is not None:
+      return fn in self._base_names
+    return (self._IsTargetFilesEntry(fn) and
+            os.path.isfile(self._BasePath(fn)))
+
+  def _PlaceBaseEntry(self, fn, path):
+    """Makes the base entry fn available at path in the overlay dir."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if self._base_zip is not None:
+      extracted = common.UnzipSingleFile(
+          self._base_zip, self._base_zip.getinfo(fn), self.overlay_dir)
+      if extracted != path:
+        os.rename(extracted, path)
+      common.UnsparseImage(path)
+    elif fn.split("/")[0] not in TARGET_FILES_IMAGES_SUBDIR:
+      # Copied, as the entries may be written to a zip with common.ZipWrite(),
+      # which would change the permissions of the base files through a link.
+      shutil.copy(self._BasePath(fn), path)
+    elif common.IsSparseImage(self._BasePath(fn)):
+      common.UnsparseImage(self._BasePath(fn), path)
+    else:
+      os.symlink(os.path.realpath(self._BasePath(fn)), path)
+
+  def Exists(self, fn):
+    return os.path.lexists(self._OverlayPath(fn)) or self._InBase(fn)
+
+  def ReadBytes(self, fn):
+    """Reads the bytes of the entry fn.
+
+    Raises:
+      KeyError: If the entry doesn't exist.
+    """
+    path = self._OverlayPath(fn)
+    if not os.path.lexists(path):
+      if not self._InBase(fn):
+        raise KeyError(fn)
+      if self._base_zip is not None:
+        return self._base_zip.read(fn)
+      path = self._BasePath(fn)
+    with open(path, "rb") as f:
+      return f.read()
+
+  def Read(self, fn):
+    return self.ReadBytes(fn).decode()
+
+  def WriteBytes(self, fn, data):
+    """Writes data to the entry fn, creating or replacing it."""
+    path = self._OverlayPath(fn)
+    if os.path.lexists(path):
+      # Don't write through a symlink into the base.
+      os.unlink(path)
+    else:
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+      f.write(data)
+    self._hidden.add(fn)
+
+  def Write(self, fn, content: str):
+    self.WriteBytes(fn, content.encode())
+
+  def Delete(self, fn):
+    """Deletes the entry fn.
+
+    Raises:
+      KeyError: If the entry doesn't exist.
+    """
+    path = self._OverlayPath(fn)
+    if os.path.lexists(path):
+      os.unlink(path)
+    elif not self._InBase(fn):
+      raise KeyError(fn)
+    self._hidden.add(fn)
+
+  def Rename(self, src, dst):
+    """Renames the entry src to dst, replacing dst if it exists.
+
+    A base entry is materialized under its new name, as delta_generator will
+    read it anyway.
+
+    Raises:
+      KeyError: If the entry src doesn't exist.
+    """
+    src_path = self._OverlayPath(src)
+    dst_path = self._OverlayPath(dst)
+    if os.path.lexists(src_path):
+      os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+      os.replace(src_path, dst_path)
+    elif self._InBase(src):
+      if os.path.lexists(dst_path):
+        os.unlink(dst_path)
+      self._PlaceBaseEntry(src, dst_path)
+    else:
+      raise KeyError(src)
+    self._hidden.update((src, dst))
+
+  def List(self, dirname):
+    """Returns the sorted names of the entries directly under dirname."""
+    names = set()
+    overlay_dir = self._OverlayPath(dirname)
+    if os.path.isdir(overlay_dir):
+      with os.scandir(overlay_dir) as it:
+        names.update(entry.name for entry in it
+                     if not entry.is_dir(follow_symlinks=False))
+    prefix = dirname + "/"
+    if self._base_zip is not None:
+      names.update(fn[len(prefix):] for fn in self._base_names
+                   if fn.startswith(prefix) and "/" not in fn[len(prefix):] and
+                   self._InBase(fn))
+    elif os.path.isdir(self._BasePath(dirname)):
+      with os.scandir(self._BasePath(dirname)) as it:
+        names.update(entry.name for entry in it
+                     if self._InBase(prefix + entry.name))
+    return sorted(names)
+
+  def Materialize(self):
+    """Returns an extracted target-files directory with all the entries.
+
+    The overlay dir is completed in place, so it should only be read, or edited
+    through this object, afterwards.
+    """
+    if self._materialized:
+      return self.overlay_dir
+    if self._base_zip is not None:
+      names = self._base_names - self._hidden
+      if names:
+        common.UnzipToDir(self.base, self.overlay_dir, names=names)
+      for fn in names:
+        if (fn.split("/")[0] in TARGET_FILES_IMAGES_SUBDIR and
+                fn.endswith(".img")):
+          common.UnsparseImage(self._OverlayPath(fn))
+      self._base_zip.close()
+    else:
+      for (dirpath, _, filenames) in os.walk(self.base):
+        relative_dir = os.path.relpath(dirpath, self.base)
+        for filename in filenames:
+          fn = filename if relative_dir == "." else "/".join(
+              relative_dir.split(os.sep) + [filename])
+          path = self._OverlayPath(fn)
+          if self._InBase(fn) and not os.path.lexists(path):
+            self._PlaceBaseEntry(fn, path)
+    self._materialized = True
+    return self.overlay_dir
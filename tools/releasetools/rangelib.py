@@ -165,13 +165,29 @@ class RangeSet(object):
     >>> RangeSet("10-19 30-34").union(RangeSet("22 32"))
     <RangeSet("10-19 22 30-34")>
     """
+    a, b = self.data, other.data
+    if not a:
+      return RangeSet(data=b)
+    if not b:
+      return RangeSet(data=a)
+
+    # Walk the two sorted lists of ranges, always picking the one that starts
+    # first, and coalesce it with the last output range when they touch.
     out = []
-    z = 0
-    for p, d in heapq.merge(zip(self.data, itertools.cycle((+1, -1))),
-                            zip(other.data, itertools.cycle((+1, -1)))):
-      if (z == 0 and d == 1) or (z == 1 and d == -1):
-        out.append(p)
-      z += d
+    i = j = 0
+    while i < len(a) or j < len(b):
+      if j >= len(b) or (i < len(a) and a[i] <= b[j]):
+        s, e = a[i], a[i+1]
+        i += 2
+      else:
+        s, e = b[j], b[j+1]
+        j += 2
+      if out and s <= out[-1]:
+        if e > out[-1]:
+          out[-1] = e
+      else:
+        out.append(s)
+        out.append(e)
     return RangeSet(data=out)
 
   def intersect(self, other):
@@ -183,13 +199,21 @@ class RangeSet(object):
     >>> RangeSet("10-19 30-34").intersect(RangeSet("22-28"))
     <RangeSet("")>
     """
+    a, b = self.data, other.data
     out = []
-    z = 0
-    for p, d in heapq.merge(zip(self.data, itertools.cycle((+1, -1))),
-                            zip(other.data, itertools.cycle((+1, -1)))):
-      if (z == 1 and d == 1) or (z == 2 and d == -1):
-        out.append(p)
-      z += d
+    i = j = 0
+    while i < len(a) and j < len(b):
+      s = a[i] if a[i] > b[j] else b[j]
+      # Advance whichever range ends first.
+      if a[i+1] < b[j+1]:
+        e = a[i+1]
+        i += 2
+      else:
+        e = b[j+1]
+        j += 2
+      if s < e:
+        out.append(s)
+        out.append(e)
     return RangeSet(data=out)
 
   def subtract(self, other):
@@ -202,13 +226,24 @@ class RangeSet(object):
     <RangeSet("10-19 30-34")>
     """
 
+    a, b = self.data, other.data
     out = []
-    z = 0
-    for p, d in heapq.merge(zip(self.data, itertools.cycle((+1, -1))),
-                            zip(other.data, itertools.cycle((-1, +1)))):
-      if (z == 0 and d == 1) or (z == 1 and d == -1):
-        out.append(p)
-      z += d
+    j = 0
+    for i in range(0, len(a), 2):
+      s, e = a[i], a[i+1]
+      # Skip the ranges in 'other' that end before this range starts.
+      while j < len(b) and b[j+1] <= s:
+        j += 2
+      k = j
+      while k < len(b) and b[k] < e:
+        if b[k] > s:
+          out.append(s)
+          out.append(b[k])
+        s = max(s, b[k+1])
+        k += 2
+      if s < e:
+        out.append(s)
+        out.append(e)
     return RangeSet(data=out)
 
   def overlaps(self, other):
@@ -223,12 +258,15 @@ class RangeSet(object):
 
     # This is like intersect, but we can stop as soon as we discover the
     # output is going to be nonempty.
-    z = 0
-    for _, d in heapq.merge(zip(self.data, itertools.cycle((+1, -1))),
-                            zip(other.data, itertools.cycle((+1, -1)))):
-      if (z == 1 and d == 1) or (z == 2 and d == -1):
+    a, b = self.data, other.data
+    i = j = 0
+    while i < len(a) and j < len(b):
+      if a[i+1] <= b[j]:
+        i += 2
+      elif b[j+1] <= a[i]:
+        j += 2
+      else:
         return True
-      z += d
     return False
 
   def size(self):
@@ -239,13 +277,7 @@ class RangeSet(object):
     15
     """
 
-    total = 0
-    for i, p in enumerate(self.data):
-      if i % 2:
-        total += p
-      else:
-        total -= p
-    return total
+    return sum(self.data[1::2]) - sum(self.data[0::2])
 
   def map_within(self, other):
     """'other' should be a subset of 'self'.  Returns a RangeSet
@@ -290,13 +322,18 @@ class RangeSet(object):
     >>> RangeSet("10-19 30-39").extend(10)
     <RangeSet("0-49")>
     """
-    out = self
+    # The extended ranges still start in increasing order, so they can be
+    # coalesced in a single pass.
+    out = []
     for i in range(0, len(self.data), 2):
-      s, e = self.data[i:i+2]
-      s1 = max(0, s - n)
-      e1 = e + n
-      out = out.union(RangeSet(str(s1) + "-" + str(e1-1)))
-    return out
+      s = max(0, self.data[i] - n)
+      e = self.data[i+1] + n
+      if out and s <= out[-1]:
+        out[-1] = max(out[-1], e)
+      else:
+        out.append(s)
+        out.append(e)
+    return RangeSet(data=out)
 
   def first(self, n):
     """Return the RangeSet that contains at most the first 'n' integers.
@@ -141,6 +141,11 @@ Usage:  sign_target_files_apks [flags] input_target_files output_target_files
   --override_apex_keys <path>
       Replace all APEX keys with this private key
 
+  --worker_threads <int>
+      Number of APKs and APEXes to sign concurrently (default: half the number
+      of CPUs, up to 4). Each signing runs its own JVM, so raising this also
+      raises the memory needed.
+
   -k  (--package_key) <key>
       Key to use to sign the package (default is the value of
       default_system_dev_certificate from the input target-files's
@@ -173,6 +178,7 @@ Usage:  sign_target_files_apks [flags] input_target_files output_target_files
 from __future__ import print_function
 
 import base64
+import collections
 import copy
 import errno
 import gzip
@@ -186,6 +192,7 @@ import stat
 import sys
 import tempfile
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from xml.etree import ElementTree
 
 import add_img_to_target_files
@@ -221,7 +228,13 @@ OPTIONS.vendor_otatools = None
 OPTIONS.allow_gsi_debug_sepolicy = False
 OPTIONS.override_apk_keys = None
 OPTIONS.override_apex_keys = None
+OPTIONS.worker_threads = None
 
+# The default number of concurrent signings, and the number of signings that
+# may be read ahead of them. Both bound the memory held by the JVMs and by the
+# APKs and APEXes being signed.
+MAX_DEFAULT_SIGNING_WORKERS = 4
+MAX_QUEUED_SIGNINGS = 2
 
 AVB_FOOTER_ARGS_BY_PARTITION = {
     'boot': 'avb_boot_add_hash_footer_args',
@@ -579,6 +592,57 @@ def IsBuildPropFile(filename):
         filename.endswith("/prop.default")
 
 
+def GetSigningWorkers():
+  """Returns the number of APKs and APEXes to sign concurrently.
+
+  Unless set with --worker_threads, it's kept low, since each signing runs a
+  JVM with the heap size given by OPTIONS.java_args.
+  """
+  if OPTIONS.worker_threads:
+    return OPTIONS.worker_threads
+  return max(1, min(MAX_DEFAULT_SIGNING_WORKERS, (os.cpu_count() or 1) // 2))
+
+
+def ReadAheadSignings(entries, submit_signing, num_workers,
+                      max_queued_signings=MAX_QUEUED_SIGNINGS):
+  """Yields (entry, decision, signing) in order, while the signings run ahead.
+
+  The signings are run by a pool of num_workers threads, with at most
+  num_workers + max_queued_signings of them started but not yet yielded. This
+  bounds the memory held by their inputs and outputs, regardless of the number
+  of entries.
+
+  Args:
+    entries: The entries to be processed in order.
+    submit_signing: A function that takes the executor and an entry, and
+        returns a tuple of its decision on the entry and the future of the
+        signing it has started, or None if the entry doesn't need signing.
+    num_workers: The number of signing threads.
+    max_queued_signings: The number of signings that may wait for a thread, or
+        for their entries to be yielded, beyond the num_workers running ones.
+
+  Yields:
+    A tuple of the entry, and the decision and the signing returned by
+    submit_signing for it.
+  """
+  max_pending_signings = num_workers + max_queued_signings
+  with ThreadPoolExecutor(max_workers=num_workers) as executor:
+    pending = collections.deque()
+    num_pending_signings = 0
+    for entry in entries:
+      while num_pending_signings >= max_pending_signings:
+        pending_entry, decision, signing = pending.popleft()
+        if signing is not None:
+          num_pending_signings -= 1
+        yield pending_entry, decision, signing
+      decision, signing = submit_signing(executor, entry)
+      pending.append((entry, decision, signing))
+      if signing is not None:
+        num_pending_signings += 1
+    while pending:
+      yield pending.popleft()
+
+
 def ProcessTargetFiles(input_tf_zip: zipfile.ZipFile, output_tf_zip, misc_info,
                        apk_keys, apex_keys, key_passwords,
                        platform_api_level, codename_to_api_level_map,
@@ -593,22 +657,71 @@ def ProcessTargetFiles(input_tf_zip: zipfile.ZipFile, output_tf_zip, misc_info,
     # Sets this to zero for targets without APK files.
     maxsize = 0
 
-  for info in input_tf_zip.infolist():
+  # Skip OTA-specific images (e.g. split super images), which will be
+  # re-generated during signing.
+  entries = [info for info in input_tf_zip.infolist()
+             if not info.filename.startswith("IMAGES/") and
+             not (info.filename.startswith("OTA/") and
+                  info.filename.endswith(".img"))]
+
+  def SubmitSigning(executor, info):
+    """Classifies the entry, and starts signing it if it's to be signed.
+
+    Returns:
+      A tuple of the decision on the entry and the future of its signing, or
+      None if it's not to be signed. The decision is a tuple of the kind of the
+      entry ("skipped_apk", "apk", "apex" or None for the others), its name and
+      its key, or (payload_key, container_key) for APEXes.
+    """
     filename = info.filename
-    if filename.startswith("IMAGES/"):
-      continue
-
-    # Skip OTA-specific images (e.g. split super images), which will be
-    # re-generated during signing.
-    if filename.startswith("OTA/") and filename.endswith(".img"):
-      continue
-
-    data = input_tf_zip.read(filename)
-    out_info = copy.copy(info)
     (is_apk, is_compressed, should_be_skipped) = GetApkFileInfo(
         filename, compressed_extension, OPTIONS.skip_apks_with_path_prefix)
+    if is_apk:
+      if should_be_skipped:
+        return ("skipped_apk", None, None), None
+      name = os.path.basename(filename)
+      if is_compressed:
+        name = name[:-len(compressed_extension)]
+      key = apk_keys[name]
+      decision = ("apk", name, key)
+      if key in common.SPECIAL_CERT_STRINGS:
+        return decision, None
+      return decision, executor.submit(
+          SignApk, input_tf_zip.read(filename), key, key_passwords[key],
+          platform_api_level, codename_to_api_level_map, is_compressed, name)
+
+    if IsApexFile(filename):
+      name = GetApexFilename(filename)
+      payload_key, container_key, sign_tool = apex_keys[name]
+      decision = ("apex", name, (payload_key, container_key))
+      # We've asserted not having a case with only one of them PRESIGNED.
+      if (payload_key in common.SPECIAL_CERT_STRINGS or
+              container_key in common.SPECIAL_CERT_STRINGS):
+        return decision, None
+      return decision, executor.submit(
+          apex_utils.SignApex,
+          misc_info['avb_avbtool'],
+          input_tf_zip.read(filename),
+          payload_key,
+          container_key,
+          key_passwords,
+          apk_keys,
+          codename_to_api_level_map,
+          no_hashtree=None,  # Let apex_util determine if hash tree is needed
+          signing_args=OPTIONS.avb_extra_args.get('apex'),
+          sign_tool=sign_tool)
+    return (None, None, None), None
+
+  # APKs and APEXes are signed concurrently and ahead of the loop, which writes
+  # the entries to output_tf_zip in order.
+  for info, (kind, name, key), signing in ReadAheadSignings(
+      entries, SubmitSigning, GetSigningWorkers()):
+    filename = info.filename
+    # The signed entries don't need their unsigned data from here.
+    data = input_tf_zip.read(filename) if signing is None else None
+    out_info = copy.copy(info)
 
-    if is_apk and should_be_skipped:
+    if kind == "skipped_apk":
       # Copy skipped APKs verbatim.
       print(
           "NOT signing: %s\n"
@@ -616,17 +729,10 @@ def ProcessTargetFiles(input_tf_zip: zipfile.ZipFile, output_tf_zip, misc_info,
       common.ZipWriteStr(output_tf_zip, out_info, data)
 
     # Sign APKs.
-    elif is_apk:
-      name = os.path.basename(filename)
-      if is_compressed:
-        name = name[:-len(compressed_extension)]
-
-      key = apk_keys[name]
-      if key not in common.SPECIAL_CERT_STRINGS:
+    elif kind == "apk":
+      if signing is not None:
         print("    signing: %-*s (%s)" % (maxsize, name, key))
-        signed_data = SignApk(data, key, key_passwords[key], platform_api_level,
-                              codename_to_api_level_map, is_compressed, name)
-        common.ZipWriteStr(output_tf_zip, out_info, signed_data)
+        common.ZipWriteStr(output_tf_zip, out_info, signing.result())
       else:
         # an APK we're not supposed to sign.
         print(
@@ -635,31 +741,15 @@ def ProcessTargetFiles(input_tf_zip: zipfile.ZipFile, output_tf_zip, misc_info,
         common.ZipWriteStr(output_tf_zip, out_info, data)
 
     # Sign bundled APEX files on all partitions
-    elif IsApexFile(filename):
-      name = GetApexFilename(filename)
-
-      payload_key, container_key, sign_tool = apex_keys[name]
-
-      # We've asserted not having a case with only one of them PRESIGNED.
-      if (payload_key not in common.SPECIAL_CERT_STRINGS and
-              container_key not in common.SPECIAL_CERT_STRINGS):
+    elif kind == "apex":
+      payload_key, container_key = key
+      if signing is not None:
         print("    signing: %-*s container (%s)" % (
             maxsize, name, container_key))
         print("           : %-*s payload   (%s)" % (
             maxsize, name, payload_key))
 
-        signed_apex = apex_utils.SignApex(
-            misc_info['avb_avbtool'],
-            data,
-            payload_key,
-            container_key,
-            key_passwords,
-            apk_keys,
-            codename_to_api_level_map,
-            no_hashtree=None,  # Let apex_util determine if hash tree is needed
-            signing_args=OPTIONS.avb_extra_args.get('apex'),
-            sign_tool=sign_tool)
-        common.ZipWrite(output_tf_zip, signed_apex, filename)
+        common.ZipWrite(output_tf_zip, signing.result(), filename)
 
       else:
         print(
@@ -762,7 +852,7 @@ def ProcessTargetFiles(input_tf_zip: zipfile.ZipFile, output_tf_zip, misc_info,
       else:
         print("Replacing %s embedded key with %s key" % (filename, virt_apex))
         # Get the current and new embedded keys.
-        payload_key, container_key, sign_tool = apex_keys[virt_apex]
+        payload_key, _, _ = apex_keys[virt_apex]
         new_pubkey_path = common.ExtractAvbPublicKey(
             misc_info['avb_avbtool'], payload_key)
         with open(new_pubkey_path, 'rb') as f:
@@ -1570,6 +1660,12 @@ def main(argv):
       OPTIONS.override_apk_keys = a
     elif o == "--override_apex_keys":
       OPTIONS.override_apex_keys = a
+    elif o == "--worker_threads":
+      if a.isdigit() and int(a) > 0:
+        OPTIONS.worker_threads = int(a)
+      else:
+        raise ValueError("Cannot parse value %r for option %r - only "
+                         "positive integers are allowed." % (a, o))
     elif o in ("--gki_signing_key",  "--gki_signing_algorithm",  "--gki_signing_extra_args"):
       print(f"{o} is deprecated and does nothing")
     else:
@@ -1633,6 +1729,7 @@ def main(argv):
           "allow_gsi_debug_sepolicy",
           "override_apk_keys=",
           "override_apex_keys=",
+          "worker_threads=",
       ],
       extra_option_handler=[option_handler, payload_signer.signer_options])
 
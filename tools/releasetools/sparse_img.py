@@ -19,17 +19,27 @@ from __future__ import print_function
 import argparse
 import bisect
 import logging
+import mmap
 import os
 import struct
 import threading
 from hashlib import sha1
 
+import images
 import rangelib
 
 logger = logging.getLogger(__name__)
 
+# The number of blocks in the shared buffer for each fill value, which is
+# sliced when returning the data of fill chunks in mmap mode.
+FILL_BUFFER_BLOCKS = 256
 
-class SparseImage(object):
+# The number of blocks to read at a time when looking for zero blocks in raw
+# chunks.
+ZERO_SCAN_BLOCKS = 256
+
+
+class SparseImage(images.Image):
   """Wraps a sparse image file into an image object.
 
   Wraps a sparse image file (and optional file map and clobbered_blocks) into
@@ -38,10 +48,18 @@ class SparseImage(object):
   of blocks that should be always written to the target regardless of the old
   contents (i.e. copying instead of patching). clobbered_blocks should be in
   the form of a string like "0" or "0 1-5 8".
+
+  If use_mmap is True, the image is mapped read-only into memory. Range data
+  is then returned as memoryview slices of the mapping (or of a shared buffer
+  for fill chunks) instead of being read under generator_lock, so that multiple
+  threads can read the image concurrently without extra copies.
   """
 
   def __init__(self, simg_fn, file_map_fn=None, clobbered_blocks=None,
-               mode="rb", build_map=True, allow_shared_blocks=False):
+               mode="rb", build_map=True, allow_shared_blocks=False,
+               use_mmap=False):
+    images.Image.__init__(self)
+    self.simg_fn = simg_fn
     self.simg_f = f = open(simg_fn, mode)
 
     header_bin = f.read(28)
@@ -123,6 +141,13 @@ class SparseImage(object):
 
     self.generator_lock = threading.Lock()
 
+    self.simg_mmap = None
+    self.fill_buffers = {}
+    if use_mmap:
+      assert mode == "rb", "mmap is only supported for read-only images"
+      self.simg_mmap = memoryview(
+          mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
     self.care_map = rangelib.RangeSet(care_data)
     self.offset_index = [i[0] for i in offset_map]
 
@@ -143,6 +168,20 @@ class SparseImage(object):
     else:
       self.file_map = {"__DATA": self.care_map}
 
+  def Close(self):
+    """Closes the image file, and unmaps it in mmap mode.
+
+    The image must not be used afterwards, but the data already returned from
+    the mapping stays valid.
+    """
+    try:
+      if self.simg_mmap is not None:
+        mapped_view, self.simg_mmap = self.simg_mmap, None
+        self.fill_buffers = {}
+        images.CloseMappedView(mapped_view)
+    finally:
+      self.simg_f.close()
+
   def AppendFillChunk(self, data, blocks):
     f = self.simg_f
 
@@ -156,8 +195,9 @@ class SparseImage(object):
 
     f.seek(16, os.SEEK_SET)
     f.write(struct.pack("<2I", self.total_blocks, self.total_chunks))
+    self.ClearRangeSha1Cache()
 
-  def RangeSha1(self, ranges):
+  def _RangeSha1(self, ranges):
     h = sha1()
     for data in self._GetRangeData(ranges):
       h.update(data)
@@ -192,38 +232,68 @@ class SparseImage(object):
     'ranges'.
 
     Use a lock to protect the generator so that we will not run two
-    instances of this generator on the same object simultaneously."""
+    instances of this generator on the same object simultaneously. In mmap
+    mode, the pieces are memoryview slices and no lock is needed."""
+
+    if self.simg_mmap is not None:
+      yield from self._GetMappedRangeData(ranges)
+      return
 
     f = self.simg_f
     with self.generator_lock:
-      for s, e in ranges:
-        to_read = e-s
-        idx = bisect.bisect_right(self.offset_index, s) - 1
-        chunk_start, chunk_len, filepos, fill_data = self.offset_map[idx]
-
-        # for the first chunk we may be starting partway through it.
-        remain = chunk_len - (s - chunk_start)
-        this_read = min(remain, to_read)
+      for filepos, fill_data, num_blocks in self._GetRangeChunks(ranges):
         if filepos is not None:
-          p = filepos + ((s - chunk_start) * self.blocksize)
-          f.seek(p, os.SEEK_SET)
-          yield f.read(this_read * self.blocksize)
+          f.seek(filepos, os.SEEK_SET)
+          yield f.read(num_blocks * self.blocksize)
         else:
-          yield fill_data * (this_read * (self.blocksize >> 2))
+          yield fill_data * (num_blocks * (self.blocksize >> 2))
+
+  def _GetMappedRangeData(self, ranges):
+    """Generator that produces the data in 'ranges' from the mmap'd image."""
+    for filepos, fill_data, num_blocks in self._GetRangeChunks(ranges):
+      size = num_blocks * self.blocksize
+      if filepos is not None:
+        yield self.simg_mmap[filepos:filepos + size]
+        continue
+
+      fill_buffer = self.fill_buffers.get(fill_data)
+      if fill_buffer is None:
+        fill_buffer = memoryview(
+            fill_data * (FILL_BUFFER_BLOCKS * (self.blocksize >> 2)))
+        self.fill_buffers[fill_data] = fill_buffer
+      while size > 0:
+        this_size = min(size, len(fill_buffer))
+        yield fill_buffer[:this_size]
+        size -= this_size
+
+  def _GetRangeChunks(self, ranges):
+    """Generator that maps 'ranges' onto the chunks of the sparse image.
+
+    Yields a tuple of (filepos, fill_data, num_blocks) for each piece, where
+    filepos is the offset of the raw data in the image file, or None for a
+    fill chunk.
+    """
+    for s, e in ranges:
+      to_read = e-s
+      idx = bisect.bisect_right(self.offset_index, s) - 1
+      chunk_start, chunk_len, filepos, fill_data = self.offset_map[idx]
+
+      # for the first chunk we may be starting partway through it.
+      remain = chunk_len - (s - chunk_start)
+      this_read = min(remain, to_read)
+      if filepos is not None:
+        filepos += (s - chunk_start) * self.blocksize
+      yield filepos, fill_data, this_read
+      to_read -= this_read
+
+      while to_read > 0:
+        # continue with following chunks if this range spans multiple chunks.
+        idx += 1
+        chunk_start, chunk_len, filepos, fill_data = self.offset_map[idx]
+        this_read = min(chunk_len, to_read)
+        yield filepos, fill_data, this_read
         to_read -= this_read
 
-        while to_read > 0:
-          # continue with following chunks if this range spans multiple chunks.
-          idx += 1
-          chunk_start, chunk_len, filepos, fill_data = self.offset_map[idx]
-          this_read = min(chunk_len, to_read)
-          if filepos is not None:
-            f.seek(filepos, os.SEEK_SET)
-            yield f.read(this_read * self.blocksize)
-          else:
-            yield fill_data * (this_read * (self.blocksize >> 2))
-          to_read -= this_read
-
   def LoadFileBlockMap(self, fn, clobbered_blocks, allow_shared_blocks):
     """Loads the given block map file.
 
@@ -284,7 +354,6 @@ class SparseImage(object):
 
     zero_blocks = []
     nonzero_blocks = []
-    reference = '\0' * self.blocksize
 
     # Workaround for bug 23227672. For squashfs, we don't have a system.map. So
     # the whole system image will be treated as a single file. But for some
@@ -296,32 +365,20 @@ class SparseImage(object):
     MAX_BLOCKS_PER_GROUP = 1024
     nonzero_groups = []
 
-    f = self.simg_f
-    for s, e in remaining:
-      for b in range(s, e):
-        idx = bisect.bisect_right(self.offset_index, b) - 1
-        chunk_start, _, filepos, fill_data = self.offset_map[idx]
-        if filepos is not None:
-          filepos += (b-chunk_start) * self.blocksize
-          f.seek(filepos, os.SEEK_SET)
-          data = f.read(self.blocksize)
-        else:
-          if fill_data == reference[:4]:   # fill with all zeros
-            data = reference
-          else:
-            data = None
+    for s, e, is_zero in self._GetZeroBlockRuns(remaining):
+      if is_zero:
+        zero_blocks.append(s)
+        zero_blocks.append(e)
+        continue
 
-        if data == reference:
-          zero_blocks.append(b)
-          zero_blocks.append(b+1)
-        else:
-          nonzero_blocks.append(b)
-          nonzero_blocks.append(b+1)
+      for b in range(s, e):
+        nonzero_blocks.append(b)
+        nonzero_blocks.append(b+1)
 
-          if len(nonzero_blocks) >= MAX_BLOCKS_PER_GROUP:
-            nonzero_groups.append(nonzero_blocks)
-            # Clear the list.
-            nonzero_blocks = []
+        if len(nonzero_blocks) >= MAX_BLOCKS_PER_GROUP:
+          nonzero_groups.append(nonzero_blocks)
+          # Clear the list.
+          nonzero_blocks = []
 
     if nonzero_blocks:
       nonzero_groups.append(nonzero_blocks)
@@ -337,6 +394,44 @@ class SparseImage(object):
     if clobbered_blocks:
       out["__COPY"] = clobbered_blocks
 
+  def _GetZeroBlockRuns(self, ranges):
+    """Generator that classifies the blocks in 'ranges' as zero or nonzero.
+
+    Yields (start, end, is_zero) for runs of blocks in 'ranges', in order.
+    Fill chunks are classified as a whole, while raw chunks are read in large
+    buffers that are only checked block by block if they aren't all zeros.
+    """
+    zero_fill = b'\0' * 4
+    zero_block = b'\0' * self.blocksize
+    zero_buffer = zero_block * ZERO_SCAN_BLOCKS
+
+    f = self.simg_f
+    for s, e in ranges:
+      b = s
+      for filepos, fill_data, num_blocks in self._GetRangeChunks([(s, e)]):
+        if filepos is None:
+          yield b, b + num_blocks, fill_data == zero_fill
+          b += num_blocks
+          continue
+
+        f.seek(filepos, os.SEEK_SET)
+        end = b + num_blocks
+        while b < end:
+          n = min(ZERO_SCAN_BLOCKS, end - b)
+          data = f.read(n * self.blocksize)
+          if len(data) != n * self.blocksize:
+            raise ValueError(
+                "Short read of %d bytes at offset %d of %s, expecting %d" % (
+                    len(data), f.tell() - len(data), self.simg_fn,
+                    n * self.blocksize))
+          if zero_buffer.startswith(data):
+            yield b, b + n, True
+          else:
+            for i in range(n):
+              yield b + i, b + i + 1, data.startswith(
+                  zero_block, i * self.blocksize)
+          b += n
+
   def ResetFileMap(self):
     """Throw away the file map and treat the entire image as
     undifferentiated data."""
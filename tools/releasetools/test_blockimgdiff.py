@@ -15,13 +15,18 @@
 #
 
 import os
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha1
 
 import common
-from blockimgdiff import BlockImageDiff, HeapItem, ImgdiffStats, Transfer
+import blockimgdiff
+from blockimgdiff import (
+    BlockImageDiff, CreatePatchPool, GetReopenableImagePath, HeapItem,
+    ImgdiffStats, PatchCache, PatchInfo, Transfer)
 from images import DataImage, EmptyImage, FileImage
 from rangelib import RangeSet
-from test_utils import ReleaseToolsTestCase
+from sparse_img import SparseImage
+from test_utils import ReleaseToolsTestCase, construct_sparse_image
 
 
 class HealpItemTest(ReleaseToolsTestCase):
@@ -107,6 +112,45 @@ class BlockImageDiffTest(ReleaseToolsTestCase):
     self.assertEqual(t0, elements[1])
     self.assertEqual(t1, elements[2])
 
+  def test_GenerateDigraph_overlappingSourceRanges(self):
+    """GenerateDigraph should handle partially overlapping source ranges.
+
+    t0: <0-9 20-29> => <100-119>
+    t1: <5-24>      => <120-139>
+    t2: <50-59>     => <140-149>
+    t3: <...>       => <22-60>
+    t4: <...>       => <0-4 1000-1009>
+    """
+
+    src = EmptyImage()
+    tgt = EmptyImage()
+    block_image_diff = BlockImageDiff(tgt, src)
+
+    transfers = block_image_diff.transfers
+    t0 = Transfer("t0", "t0", RangeSet("100-119"), RangeSet("0-9 20-29"),
+                  "t0hash", "t0hash", "move", transfers)
+    t1 = Transfer("t1", "t1", RangeSet("120-139"), RangeSet("5-24"),
+                  "t1hash", "t1hash", "move", transfers)
+    t2 = Transfer("t2", "t2", RangeSet("140-149"), RangeSet("50-59"),
+                  "t2hash", "t2hash", "move", transfers)
+    t3 = Transfer("t3", "t3", RangeSet("22-60"), RangeSet("200-238"),
+                  "t3hash", "t3hash", "move", transfers)
+    t4 = Transfer("t4", "t4", RangeSet("0-4 1000-1009"), RangeSet("300-314"),
+                  "t4hash", "t4hash", "move", transfers)
+
+    block_image_diff.GenerateDigraph()
+
+    # t0 and t1 both start overlapping t3's target at block 22, so they should
+    # follow the transfer order.
+    self.assertEqual([t0, t1, t2], list(t3.goes_after))
+    self.assertEqual({t0: 8, t1: 3, t2: 10}, dict(t3.goes_after))
+    self.assertEqual([t0], list(t4.goes_after))
+    self.assertEqual({t0: 5}, dict(t4.goes_after))
+    self.assertEqual({t3: 8, t4: 5}, dict(t0.goes_before))
+    self.assertEqual({t3: 3}, dict(t1.goes_before))
+    self.assertFalse(t0.goes_after)
+    self.assertFalse(t3.goes_before)
+
   def test_ReviseStashSize(self):
     """ReviseStashSize should convert transfers to 'new' commands as needed.
 
@@ -244,6 +288,218 @@ class BlockImageDiffTest(ReleaseToolsTestCase):
         },
         block_image_diff.imgdiff_stats.stats)
 
+  @staticmethod
+  def _ComputeKnownPatches(src, tgt, **kwargs):
+    block_image_diff = BlockImageDiff(tgt, src, **kwargs)
+    transfers = block_image_diff.transfers
+    diff_queue = []
+    for i, (tgt_ranges, src_ranges) in enumerate(
+        (("0-4", "0-9"), ("5-12", "10-19"), ("13-19", "3-6"))):
+      xf = Transfer("t%d" % i, "t%d" % i, RangeSet(tgt_ranges),
+                    RangeSet(src_ranges), "tgthash", "srchash", "diff",
+                    transfers)
+      # Provide the patches, so that no bsdiff/imgdiff is needed.
+      xf.patch_info = PatchInfo(False, b'patch%d' % i)
+      diff_queue.append((i, False, i))
+    return block_image_diff.ComputePatchesForInputList(diff_queue, True)
+
+  @staticmethod
+  def _CreateImagesForPatches():
+    src = SparseImage(construct_sparse_image([
+        (0xCAC1, 10, os.urandom(4096 * 10)),
+        (0xCAC2, 10, b'\0' * 4)], append_footer=False))
+    tgt = SparseImage(construct_sparse_image([
+        (0xCAC1, 5, os.urandom(4096 * 5)),
+        (0xCAC2, 15, b'\0\0\0\1')], append_footer=False))
+    return src, tgt
+
+  def test_ComputePatchesForInputList_processes(self):
+    src, tgt = self._CreateImagesForPatches()
+
+    results = []
+    for use_processes in (False, True):
+      results.append(self._ComputeKnownPatches(
+          src, tgt, threads=2, use_processes=use_processes))
+
+    self.assertEqual(results[0], results[1])
+    self.assertEqual([0, 1, 2], [index for index, _, _ in results[1]])
+    self.assertEqual(b'patch1', results[1][1][1].content)
+    for _, _, compressed_size in results[1]:
+      self.assertGreater(compressed_size, 0)
+
+  def test_ComputePatchesForInputList_processPool(self):
+    images = [self._CreateImagesForPatches() for _ in range(3)]
+    expected = [self._ComputeKnownPatches(src, tgt, threads=1)
+                for src, tgt in images]
+
+    # The pool is forked before the threads start, and computes the patches
+    # of the images of all of them.
+    with CreatePatchPool(2) as pool, ThreadPoolExecutor(3) as executor:
+      results = list(executor.map(
+          lambda images: self._ComputeKnownPatches(
+              *images, threads=1, use_processes=True, process_pool=pool),
+          images))
+
+    self.assertEqual(expected, results)
+    for result in results:
+      for _, _, compressed_size in result:
+        self.assertGreater(compressed_size, 0)
+
+  def test_ComputePatchesForInputList_knownPatchesNotDispatched(self):
+    src = SparseImage(construct_sparse_image([
+        (0xCAC1, 10, os.urandom(4096 * 10))], append_footer=False))
+    tgt = SparseImage(construct_sparse_image([
+        (0xCAC1, 10, os.urandom(4096 * 10))], append_footer=False))
+
+    calls = []
+    orig_compute_transfer_patch = blockimgdiff.compute_transfer_patch
+
+    def compute_transfer_patch(*args):
+      calls.append(args)
+      return orig_compute_transfer_patch(*args)
+
+    blockimgdiff.compute_transfer_patch = compute_transfer_patch
+    try:
+      for compress_target in (False, True):
+        del calls[:]
+        block_image_diff = BlockImageDiff(tgt, src, threads=2)
+        transfers = block_image_diff.transfers
+        xf = Transfer("t", "t", RangeSet("0-9"), RangeSet("0-9"), "tgthash",
+                      "srchash", "diff", transfers)
+        xf.patch_info = PatchInfo(False, b'patch')
+        patches = block_image_diff.ComputePatchesForInputList(
+            [(0, False, 0)], compress_target)
+
+        self.assertEqual(1, len(patches))
+        self.assertEqual(b'patch', patches[0][1].content)
+        if compress_target:
+          # The target still needs to be compressed for its size.
+          self.assertEqual(1, len(calls))
+          self.assertGreater(patches[0][2], 0)
+        else:
+          self.assertEqual([], calls)
+          self.assertIsNone(patches[0][2])
+    finally:
+      blockimgdiff.compute_transfer_patch = orig_compute_transfer_patch
+
+  def test_GetReopenableImagePath(self):
+    image_path = construct_sparse_image([(0xCAC2, 4, b'\0' * 4)],
+                                        append_footer=False)
+    self.assertEqual(image_path,
+                     GetReopenableImagePath(SparseImage(image_path)))
+    self.assertEqual('', GetReopenableImagePath(EmptyImage()))
+    self.assertIsNone(GetReopenableImagePath(DataImage(b'\0' * 4096)))
+
+
+class PatchCacheTest(ReleaseToolsTestCase):
+
+  def setUp(self):
+    # A fake bsdiff that records each invocation.
+    self.tool_dir = common.MakeTempDir()
+    self.tool_log = os.path.join(self.tool_dir, 'bsdiff.log')
+    tool = os.path.join(self.tool_dir, 'bsdiff')
+    with open(tool, 'w') as f:
+      f.write('#!/bin/sh\necho "$2" >> {}\necho patch > "$3"\n'.format(
+          self.tool_log))
+    os.chmod(tool, 0o755)
+    self.orig_path = os.environ['PATH']
+    os.environ['PATH'] = self.tool_dir + os.pathsep + self.orig_path
+
+    self.cache_dir = common.MakeTempDir()
+
+  def tearDown(self):
+    os.environ['PATH'] = self.orig_path
+    super(PatchCacheTest, self).tearDown()
+
+  def _ComputePatches(self, patch_cache, disable_imgdiff=False):
+    src = DataImage(os.urandom(4096 * 10))
+    tgt = DataImage(os.urandom(4096 * 10))
+    block_image_diff = BlockImageDiff(tgt, src, threads=2,
+                                      disable_imgdiff=disable_imgdiff,
+                                      patch_cache=patch_cache)
+    transfers = block_image_diff.transfers
+    diff_queue = []
+    for i in range(3):
+      Transfer("t%d" % i, "t%d" % i, RangeSet("%d-%d" % (i * 3, i * 3 + 2)),
+               RangeSet("%d-%d" % (i * 3, i * 3 + 2)), "tgthash%d" % i,
+               "srchash%d" % i, "diff", transfers)
+      diff_queue.append((i, False, i))
+    patches = block_image_diff.ComputePatchesForInputList(diff_queue, False)
+    return block_image_diff, patches
+
+  def _GetToolRuns(self):
+    if not os.path.exists(self.tool_log):
+      return 0
+    with open(self.tool_log) as f:
+      return len(f.readlines())
+
+  def test_ComputePatchesForInputList(self):
+    patch_cache = PatchCache(self.cache_dir, 1024 * 1024)
+    bid, patches = self._ComputePatches(patch_cache)
+    self.assertEqual(3, self._GetToolRuns())
+    self.assertEqual((0, 3), (bid.patch_cache_hits, bid.patch_cache_misses))
+
+    # The same (src, tgt) pairs should be served from the cache.
+    bid, cached_patches = self._ComputePatches(
+        PatchCache(self.cache_dir, 1024 * 1024))
+    self.assertEqual(3, self._GetToolRuns())
+    self.assertEqual((3, 0), (bid.patch_cache_hits, bid.patch_cache_misses))
+    self.assertEqual(patches, cached_patches)
+    self.assertEqual(PatchInfo(False, b'patch\n'), cached_patches[0][1])
+
+  def test_ComputePatchesForInputList_imgdiffDisabled(self):
+    # Like for non-A/B incrementals, which always disable imgdiff.
+    self._ComputePatches(PatchCache(self.cache_dir, 1024 * 1024),
+                         disable_imgdiff=True)
+    bid, _ = self._ComputePatches(PatchCache(self.cache_dir, 1024 * 1024),
+                                  disable_imgdiff=True)
+    self.assertEqual(3, self._GetToolRuns())
+    self.assertEqual((3, 0), (bid.patch_cache_hits, bid.patch_cache_misses))
+
+  def test_GetPut(self):
+    patch_cache = PatchCache(self.cache_dir, 1024 * 1024)
+    self.assertIsNone(patch_cache.Get('src', 'tgt', False))
+
+    patch_cache.Put('src', 'tgt', PatchInfo(False, b'bsdiff patch'))
+    self.assertEqual(PatchInfo(False, b'bsdiff patch'),
+                     patch_cache.Get('src', 'tgt', False))
+    # Keyed by the patch style and the direction.
+    self.assertIsNone(patch_cache.Get('tgt', 'src', False))
+    self.assertIsNone(patch_cache.Get('src', 'tgt', True))
+
+  def test_Trim(self):
+    patch_cache = PatchCache(self.cache_dir, 250)
+    for i in range(3):
+      patch_cache.Put('src%d' % i, 'tgt', PatchInfo(False, b'x' * 100))
+
+    # Make src0 the oldest entry, and src1 the most recently used one.
+    for i, name in enumerate(('src0', 'src2', 'src1')):
+      path = patch_cache._GetEntryPath(name, 'tgt', False)
+      os.utime(path, (1000 + i, 1000 + i))
+
+    patch_cache.Trim()
+    self.assertIsNone(patch_cache.Get('src0', 'tgt', False))
+    self.assertIsNotNone(patch_cache.Get('src1', 'tgt', False))
+    self.assertIsNotNone(patch_cache.Get('src2', 'tgt', False))
+
+  def test_Trim_keepsRunningSize(self):
+    patch_cache = PatchCache(self.cache_dir, 250)
+    patch_cache.Put('src0', 'tgt', PatchInfo(False, b'x' * 100))
+    patch_cache.Trim()
+
+    # Entries added behind the back of the PatchCache aren't seen until the
+    # entries put through it may exceed max_size.
+    other_cache = PatchCache(self.cache_dir, 250)
+    for i in (1, 2):
+      other_cache.Put('src%d' % i, 'tgt', PatchInfo(False, b'x' * 100))
+    patch_cache.Trim()
+    self.assertEqual(3, len(os.listdir(self.cache_dir)))
+
+    patch_cache.Put('src3', 'tgt', PatchInfo(False, b'x' * 100))
+    patch_cache.Put('src4', 'tgt', PatchInfo(False, b'x' * 100))
+    patch_cache.Trim()
+    self.assertEqual(2, len(os.listdir(self.cache_dir)))
+
 
 class ImgdiffStatsTest(ReleaseToolsTestCase):
 
@@ -308,3 +564,162 @@ class FileImageTest(ReleaseToolsTestCase):
   def test_read_all(self):
     data = b''.join(self.file.ReadRangeSet(self.file.care_map))
     self.assertEqual(self.data, data)
+
+  def test_file_map(self):
+    self.assertEqual({'__NONZERO': RangeSet("0-3")}, self.file.file_map)
+
+    # A zero block in a buffer with nonzero blocks, followed by a buffer of
+    # zero blocks.
+    file_path = common.MakeTempFile()
+    with open(file_path, 'wb') as f:
+      f.write(os.urandom(4096) + b'\0' * 4096 + os.urandom(4096 * 254))
+      f.write(b'\0' * 4096 * 300 + os.urandom(4))
+      f.write(b'\0' * (4096 - 4))
+    for use_mmap in (False, True):
+      image = FileImage(file_path, use_mmap=use_mmap)
+      self.assertEqual({'__ZERO': RangeSet("1 256-555"),
+                        '__NONZERO': RangeSet("0 2-255 556")}, image.file_map)
+
+  def test_ranges_mmap(self):
+    mapped_file = FileImage(self.file_path, use_mmap=True)
+    self.assertEqual(self.file.file_map, mapped_file.file_map)
+    for rs in (RangeSet("0"), RangeSet("1-2"), RangeSet("0 2-3"),
+               self.file.care_map):
+      self.assertEqual(b''.join(self.file.ReadRangeSet(rs)),
+                       b''.join(mapped_file.ReadRangeSet(rs)))
+      self.assertEqual(self.file.RangeSha1(rs), mapped_file.RangeSha1(rs))
+    self.assertEqual(self.file.TotalSha1(), mapped_file.TotalSha1())
+
+  def test_Close(self):
+    for use_mmap in (False, True):
+      image = FileImage(self.file_path, use_mmap=use_mmap)
+      data = image.ReadRangeSet(RangeSet("1-2"))
+      image.Close()
+      # The image can't be read any more, but the data already returned stays
+      # valid.
+      self.assertRaises(ValueError, image.ReadRangeSet, RangeSet("1-2"))
+      self.assertEqual(self.data[4096:4096 * 3], b''.join(data))
+
+    rs = RangeSet("1-2")
+    expected = sha1(self.data[4096:4096 * 3]).hexdigest()
+    self.assertEqual(expected, self.file.RangeSha1(rs))
+    # The same ranges hit the cache, whether or not given as a RangeSet.
+    self.assertEqual(expected, self.file.RangeSha1(RangeSet("1-2")))
+    self.assertEqual(expected, self.file.RangeSha1([(1, 3)]))
+    self.assertEqual((2, 1), (self.file.range_sha1_hits,
+                              self.file.range_sha1_misses))
+
+    # The hashes are recomputed from the file without the cache.
+    with open(self.file_path, 'r+b') as f:
+      f.seek(4096)
+      f.write(b'\0' * 4096)
+    self.assertEqual(expected, self.file.RangeSha1(rs))
+    self.assertNotEqual(expected, self.file.RangeSha1(rs, use_cache=False))
+    self.file.ClearRangeSha1Cache()
+    self.assertNotEqual(expected, self.file.RangeSha1(rs))
+
+  def test_RangeSha1_evictsLeastRecentlyUsed(self):
+    self.file.RANGE_SHA1_CACHE_SIZE = 2
+    for rs in (RangeSet("0"), RangeSet("1"), RangeSet("0"), RangeSet("2")):
+      self.file.RangeSha1(rs)
+    self.assertEqual([(0, 1), (2, 3)], list(self.file.range_sha1_cache))
+    self.assertEqual((1, 3), (self.file.range_sha1_hits,
+                              self.file.range_sha1_misses))
+
+
+class SparseImageTest(ReleaseToolsTestCase):
+
+  def setUp(self):
+    self.image_path = construct_sparse_image([
+        (0xCAC1, 6, os.urandom(4096 * 6)),
+        (0xCAC3, 3, b''),
+        (0xCAC2, 300, os.urandom(4)),
+        (0xCAC1, 4, os.urandom(4096 * 4))], append_footer=False)
+
+  def test_ranges_mmap(self):
+    image = SparseImage(self.image_path)
+    mapped_image = SparseImage(self.image_path, use_mmap=True)
+    self.assertEqual(image.care_map, mapped_image.care_map)
+
+    for rs in (RangeSet("0-5"), RangeSet("2-4 9-20"), RangeSet("5-9 300-312"),
+               image.care_map):
+      expected_data = b''.join(image.ReadRangeSet(rs))
+      self.assertEqual(
+          expected_data, b''.join(mapped_image.ReadRangeSet(rs)))
+      self.assertEqual(image.RangeSha1(rs), mapped_image.RangeSha1(rs))
+
+      tmpfile = common.MakeTempFile()
+      with open(tmpfile, 'wb') as f:
+        mapped_image.WriteRangeDataToFd(rs, f)
+      with open(tmpfile, 'rb') as f:
+        self.assertEqual(expected_data, f.read())
+
+    self.assertEqual(image.TotalSha1(), mapped_image.TotalSha1())
+
+  def test_ranges_mmap_readOnly(self):
+    self.assertRaises(AssertionError, SparseImage, self.image_path,
+                      mode="r+b", use_mmap=True)
+
+  def test_Close_mmap(self):
+    mapped_image = SparseImage(self.image_path, use_mmap=True)
+    mapping = mapped_image.simg_mmap.obj
+    self.assertEqual(
+        b''.join(SparseImage(self.image_path).ReadRangeSet(RangeSet("0-5"))),
+        b''.join(mapped_image.ReadRangeSet(RangeSet("0-5"))))
+    mapped_image.Close()
+    self.assertIsNone(mapped_image.simg_mmap)
+    self.assertTrue(mapping.closed)
+    self.assertTrue(mapped_image.simg_f.closed)
+
+  def test_Close_mmapDataInUse(self):
+    mapped_image = SparseImage(self.image_path, use_mmap=True)
+    mapping = mapped_image.simg_mmap.obj
+    data = mapped_image.ReadRangeSet(RangeSet("0-5"))
+    expected = b''.join(data)
+    # The mapping is left open for the data still in use.
+    mapped_image.Close()
+    self.assertIsNone(mapped_image.simg_mmap)
+    self.assertFalse(mapping.closed)
+    self.assertTrue(mapped_image.simg_f.closed)
+    self.assertEqual(expected, b''.join(data))
+
+  def test_LoadFileBlockMap_zeroBlocks(self):
+    zero_block = b'\0' * 4096
+    nonzero_block = b'\0' * 4095 + b'\1'
+    image_path = construct_sparse_image([
+        (0xCAC1, 4, os.urandom(4096 * 4)),
+        (0xCAC1, 6, zero_block * 2 + nonzero_block + zero_block * 3),
+        (0xCAC3, 2, b''),
+        (0xCAC2, 300, b'\0' * 4),
+        (0xCAC2, 3, b'\0\0\0\1'),
+        (0xCAC1, 1000, zero_block * 400 + nonzero_block * 600),
+    ], append_footer=False)
+
+    block_map = common.MakeTempFile(suffix='.map')
+    with open(block_map, 'w') as f:
+      f.write('/system/file1 1-3\n')
+
+    image = SparseImage(image_path, block_map, "0")
+    self.assertDictEqual(
+        {
+            '/system/file1': RangeSet("1-3"),
+            '__ZERO': RangeSet("4-5 7-9 12-311 315-714"),
+            '__NONZERO-0': RangeSet("6 312-314 715-1222"),
+            '__NONZERO-1': RangeSet("1223-1314"),
+            '__COPY': RangeSet("0"),
+        },
+        image.file_map)
+
+  def test_LoadFileBlockMap_truncatedImage(self):
+    image_path = construct_sparse_image([
+        (0xCAC1, 4, os.urandom(4096 * 4)),
+        (0xCAC1, 6, b'\0' * 4096 * 6)], append_footer=False)
+    # Drop the last 3 blocks, which would otherwise be taken as zeros.
+    with open(image_path, 'r+b') as f:
+      f.truncate(os.path.getsize(image_path) - 4096 * 3)
+
+    block_map = common.MakeTempFile(suffix='.map')
+    with open(block_map, 'w') as f:
+      f.write('/system/file1 0-3\n')
+
+    self.assertRaises(ValueError, SparseImage, image_path, block_map)
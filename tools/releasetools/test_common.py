@@ -16,6 +16,8 @@
 
 import copy
 import os
+import stat
+import struct
 import subprocess
 import tempfile
 import unittest
@@ -679,7 +681,6 @@ class CommonZipTest(test_utils.ReleaseToolsTestCase):
     finally:
       os.remove(zip_file_name)
 
-  @test_utils.SkipIfExternalToolsUnavailable()
   def test_ZipDelete(self):
     zip_file = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
     output_zip = zipfile.ZipFile(zip_file.name, 'w',
@@ -724,6 +725,109 @@ class CommonZipTest(test_utils.ReleaseToolsTestCase):
     finally:
       os.remove(zip_file.name)
 
+  def test_ZipRewrite(self):
+    zip_file = common.MakeTempFile(suffix='.zip')
+    stored_data = os.urandom(4096)
+    with zipfile.ZipFile(zip_file, 'w', allowZip64=True) as output_zip:
+      output_zip.comment = b'comment'
+      common.ZipWriteStr(output_zip, 'Stored', stored_data,
+                         compress_type=zipfile.ZIP_STORED)
+      common.ZipWriteStr(output_zip, 'Deflated', b'deflated' * 1024,
+                         compress_type=zipfile.ZIP_DEFLATED)
+      common.ZipWriteStr(output_zip, 'Deleted', b'deleted')
+      common.ZipWriteStr(output_zip, 'Replaced', b'replaced')
+      # An entry with a zip64 local header.
+      with output_zip.open('Zip64', 'w', force_zip64=True) as entry_fp:
+        entry_fp.write(b'zip64')
+    with zipfile.ZipFile(zip_file) as check_zip:
+      deflated_info = check_zip.getinfo('Deflated')
+
+    replacement = common.MakeTempFile()
+    with open(replacement, 'wb') as f:
+      f.write(b'replacement')
+    added = common.MakeTempFile()
+    with open(added, 'wb') as f:
+      f.write(b'added')
+    output_file = common.MakeTempFile(suffix='.zip')
+    common.ZipRewrite(
+        zip_file, output_file, entries_to_delete=['Deleted'],
+        entries_to_replace={'Replaced': replacement, 'Added': added},
+        compress_types={'Stored': zipfile.ZIP_DEFLATED})
+
+    with zipfile.ZipFile(output_file) as check_zip:
+      self.assertIsNone(check_zip.testzip())
+      self.assertEqual(
+          ['Stored', 'Deflated', 'Replaced', 'Zip64', 'Added'],
+          check_zip.namelist())
+      self.assertEqual(b'comment', check_zip.comment)
+      self.assertEqual(stored_data, check_zip.read('Stored'))
+      self.assertEqual(zipfile.ZIP_DEFLATED,
+                       check_zip.getinfo('Stored').compress_type)
+      # The untouched entries are copied as is.
+      info = check_zip.getinfo('Deflated')
+      self.assertEqual(deflated_info.compress_size, info.compress_size)
+      self.assertEqual(deflated_info.CRC, info.CRC)
+      self.assertEqual(b'deflated' * 1024, check_zip.read('Deflated'))
+      self.assertEqual(b'replacement', check_zip.read('Replaced'))
+      self.assertEqual(b'zip64', check_zip.read('Zip64'))
+      self.assertEqual(b'added', check_zip.read('Added'))
+
+    # Rewriting in place.
+    common.ZipRewrite(output_file, output_file,
+                      compress_types={'Stored': zipfile.ZIP_STORED})
+    with zipfile.ZipFile(output_file) as check_zip:
+      self.assertIsNone(check_zip.testzip())
+      self.assertEqual(zipfile.ZIP_STORED,
+                       check_zip.getinfo('Stored').compress_type)
+      self.assertEqual(stored_data, check_zip.read('Stored'))
+
+  def test_ZipRewrite_keepsAlignment(self):
+    zip_file = common.MakeTempFile(suffix='.zip')
+    aligned_data = os.urandom(4096)
+    with zipfile.ZipFile(zip_file, 'w', allowZip64=True) as output_zip:
+      common.ZipWriteStr(output_zip, 'Deleted', os.urandom(100),
+                         compress_type=zipfile.ZIP_STORED)
+      # Align the data of the stored entry to 4096 bytes, like signapk.jar.
+      zinfo = zipfile.ZipInfo('lib/libfoo.so', date_time=(2009, 1, 1, 0, 0, 0))
+      zinfo.compress_type = zipfile.ZIP_STORED
+      # After the local header and the data of 'Deleted'.
+      header_offset = 30 + len('Deleted') + 100
+      padding = -(header_offset + 30 + len(zinfo.filename) + 6) % 4096
+      zinfo.extra = struct.pack(
+          '<HHH', 0xd935, 2 + padding, 4096) + b'\0' * padding
+      output_zip.writestr(zinfo, aligned_data)
+
+    def GetDataOffset(zip_path):
+      with zipfile.ZipFile(zip_path) as check_zip, \
+              open(zip_path, 'rb') as check_fp:
+        info = check_zip.getinfo('lib/libfoo.so')
+        return common.ReadZipEntryDataOffset(check_fp, info)
+
+    self.assertEqual(0, GetDataOffset(zip_file) % 4096)
+    common.ZipDelete(zip_file, ['Deleted'])
+    self.assertEqual(0, GetDataOffset(zip_file) % 4096)
+    with zipfile.ZipFile(zip_file) as check_zip:
+      self.assertIsNone(check_zip.testzip())
+      self.assertEqual(aligned_data, check_zip.read('lib/libfoo.so'))
+
+  def test_ZipRewrite_keepsMode(self):
+    zip_file = common.MakeTempFile(suffix='.zip')
+    with zipfile.ZipFile(zip_file, 'w', allowZip64=True) as output_zip:
+      common.ZipWriteStr(output_zip, 'Test1', b'test1')
+      common.ZipWriteStr(output_zip, 'Test2', b'test2')
+    os.chmod(zip_file, 0o644)
+    common.ZipDelete(zip_file, ['Test1'])
+    self.assertEqual(0o644, stat.S_IMODE(os.stat(zip_file).st_mode))
+
+    # A new output gets the default mode of a new file.
+    umask = os.umask(0o022)
+    try:
+      output_file = os.path.join(common.MakeTempDir(), 'output.zip')
+      common.ZipExclude(zip_file, output_file, ['Test2'])
+    finally:
+      os.umask(umask)
+    self.assertEqual(0o644, stat.S_IMODE(os.stat(output_file).st_mode))
+
   @staticmethod
   def _test_UnzipTemp_createZipFile():
     zip_file = common.MakeTempFile(suffix='.zip')
@@ -811,6 +915,108 @@ class CommonZipTest(test_utils.ReleaseToolsTestCase):
     self.assertFalse(os.path.exists(os.path.join(unzipped_dir, 'Bar4')))
     self.assertFalse(os.path.exists(os.path.join(unzipped_dir, 'Dir5/Baz5')))
 
+  def test_UnzipToDir(self):
+    zip_file = common.MakeTempFile(suffix='.zip')
+    stored_data = os.urandom(4096 * 3)
+    deflated_data = b'deflated' * 1024
+    with zipfile.ZipFile(zip_file, 'w', allowZip64=True) as output_zip:
+      info = zipfile.ZipInfo('IMAGES/system.img')
+      info.external_attr = (stat.S_IFREG | 0o600) << 16
+      output_zip.writestr(info, stored_data, compress_type=zipfile.ZIP_STORED)
+      info = zipfile.ZipInfo('SYSTEM/bin/tool')
+      info.external_attr = (stat.S_IFREG | 0o755) << 16
+      output_zip.writestr(info, deflated_data,
+                          compress_type=zipfile.ZIP_DEFLATED)
+      info = zipfile.ZipInfo('SYSTEM/bin/link')
+      info.external_attr = (stat.S_IFLNK | 0o777) << 16
+      output_zip.writestr(info, 'tool')
+      info = zipfile.ZipInfo('SYSTEM/empty/')
+      info.external_attr = (stat.S_IFDIR | 0o700) << 16
+      output_zip.writestr(info, '')
+
+    for num_workers in (1, 4):
+      unzipped_dir = common.MakeTempDir()
+      common.UnzipToDir(zip_file, unzipped_dir, num_workers=num_workers)
+
+      with open(os.path.join(unzipped_dir, 'IMAGES/system.img'), 'rb') as f:
+        self.assertEqual(stored_data, f.read())
+      tool = os.path.join(unzipped_dir, 'SYSTEM/bin/tool')
+      with open(tool, 'rb') as f:
+        self.assertEqual(deflated_data, f.read())
+      self.assertEqual(
+          0o644, os.stat(os.path.join(
+              unzipped_dir, 'IMAGES/system.img')).st_mode & 0o777)
+      self.assertEqual(0o755, os.stat(tool).st_mode & 0o777)
+      self.assertEqual(
+          'tool', os.readlink(os.path.join(unzipped_dir, 'SYSTEM/bin/link')))
+      self.assertEqual(
+          0o755, os.stat(os.path.join(
+              unzipped_dir, 'SYSTEM/empty')).st_mode & 0o777)
+
+    unzipped_dir = common.MakeTempDir()
+    common.UnzipToDir(zip_file, unzipped_dir, ['IMAGES/*', 'SYSTEM/bin/t*'])
+    self.assertEqual(
+        ['IMAGES/system.img', 'SYSTEM/bin/tool'],
+        sorted(os.path.relpath(os.path.join(root, f), unzipped_dir)
+               for root, _, files in os.walk(unzipped_dir) for f in files))
+
+    unzipped_dir = common.MakeTempDir()
+    common.UnzipToDir(zip_file, unzipped_dir,
+                      names={'SYSTEM/bin/tool', 'SYSTEM/bin/t*'})
+    self.assertEqual(
+        ['SYSTEM/bin/tool'],
+        sorted(os.path.relpath(os.path.join(root, f), unzipped_dir)
+               for root, _, files in os.walk(unzipped_dir) for f in files))
+
+  def test_UnzipToDir_badCrc(self):
+    zip_file = common.MakeTempFile(suffix='.zip')
+    with zipfile.ZipFile(zip_file, 'w', allowZip64=True) as output_zip:
+      output_zip.writestr('IMAGES/system.img', os.urandom(4096),
+                          compress_type=zipfile.ZIP_STORED)
+    with zipfile.ZipFile(zip_file) as input_zip:
+      info = input_zip.getinfo('IMAGES/system.img')
+    # Flip a byte of the stored data, which is copied in the kernel.
+    with open(zip_file, 'r+b') as f:
+      data_offset = common.ReadZipEntryDataOffset(f, info)
+      f.seek(data_offset)
+      byte = f.read(1)
+      f.seek(data_offset)
+      f.write(bytes([byte[0] ^ 0xff]))
+
+    self.assertRaises(zipfile.BadZipFile, common.UnzipToDir, zip_file,
+                      common.MakeTempDir())
+
+  def test_CopyFileRange(self):
+    src_file = common.MakeTempFile()
+    data = os.urandom(8192)
+    with open(src_file, 'wb') as f:
+      f.write(data)
+    dst_file = common.MakeTempFile()
+    with open(src_file, 'rb') as src, open(dst_file, 'wb') as dst:
+      dst.write(b'head')
+      dst.flush()
+      common.CopyFileRange(src.fileno(), dst.fileno(), 100, 5000)
+    with open(dst_file, 'rb') as f:
+      self.assertEqual(b'head' + data[100:5100], f.read())
+
+    with open(src_file, 'rb') as src, open(dst_file, 'wb') as dst:
+      self.assertRaises(common.ExternalError, common.CopyFileRange,
+                        src.fileno(), dst.fileno(), 8000, 1000)
+
+  def test_LazyTargetFiles_Extract(self):
+    zip_file = self._test_UnzipTemp_createZipFile()
+    with common.LazyTargetFiles(zip_file) as input_zip:
+      extracted = input_zip.Extract('Dir5/Baz5')
+      with open(extracted, 'rb') as f:
+        self.assertEqual(input_zip.read('Dir5/Baz5'), f.read())
+      # Only the requested entry gets extracted, and only once.
+      extract_dir = os.path.dirname(os.path.dirname(extracted))
+      self.assertEqual(['Dir5'], os.listdir(extract_dir))
+      self.assertEqual(extracted, input_zip.Extract('Dir5/Baz5'))
+      self.assertEqual(
+          extracted, common.ExtractFromInputFile(input_zip, 'Dir5/Baz5'))
+      self.assertRaises(KeyError, input_zip.Extract, 'Nonexistent')
+
 
 class CommonApkUtilsTest(test_utils.ReleaseToolsTestCase):
   """Tests the APK utils related functions."""
@@ -1020,6 +1226,32 @@ class CommonUtilsTest(test_utils.ReleaseToolsTestCase):
   def setUp(self):
     self.testdata_dir = test_utils.get_testdata_dir()
 
+  def test_GetTreeUsage(self):
+    tree = common.MakeTempDir()
+    for subdir in ('app/Foo', 'bin', 'etc/empty'):
+      os.makedirs(os.path.join(tree, subdir))
+    for name, size in (('app/Foo/Foo.apk', 5000), ('bin/foo', 1),
+                       ('build.prop', 1023)):
+      with open(os.path.join(tree, name), 'wb') as f:
+        f.write(b'\0' * size)
+    # Hard links are counted once for the size, but once each for the inodes.
+    os.link(os.path.join(tree, 'app/Foo/Foo.apk'),
+            os.path.join(tree, 'bin/Foo.apk'))
+    os.symlink('../bin/foo', os.path.join(tree, 'etc/foo'))
+    os.symlink('app', os.path.join(tree, 'priv-app'))
+
+    for num_workers in (1, 4):
+      usage = common.GetTreeUsage(tree, num_workers)
+      du = common.RunAndCheckOutput(['du', '-b', '-k', '-s', tree])
+      self.assertEqual(int(du.split()[0]) * 1024, usage.disk_usage)
+      self.assertEqual(
+          common.RunAndCheckOutput(['find', tree, '-print']).count('\n'),
+          usage.inodes)
+      self.assertLessEqual(usage.disk_usage - 1024, usage.size)
+
+    build_prop = common.GetTreeUsage(os.path.join(tree, 'build.prop'))
+    self.assertEqual(common.TreeUsage(1023, 1024, 1), build_prop)
+
   @test_utils.SkipIfExternalToolsUnavailable()
   def test_GetSparseImage_emptyBlockMapFile(self):
     target_files = common.MakeTempFile(prefix='target_files-', suffix='.zip')
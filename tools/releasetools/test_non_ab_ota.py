@@ -15,12 +15,17 @@
 #
 
 import copy
+import os
+import threading
+import time
 import zipfile
 
 import common
 import test_utils
 
-from non_ab_ota import NonAbOtaPropertyFiles, WriteFingerprintAssertion
+from non_ab_ota import (
+    GetBlockDifferences, NonAbOtaPropertyFiles, SplitThreads,
+    WriteFingerprintAssertion)
 from test_utils import PropertyFilesTestCase
 
 
@@ -170,3 +175,121 @@ class NonAbOTATest(test_utils.ReleaseToolsTestCase):
         [('AssertSomeThumbprint', 'build-thumbprint',
           'source-build-thumbprint')],
         script_writer.lines)
+
+  def test_SplitThreads(self):
+    self.assertEqual([3, 1], SplitThreads([40, 8], 4))
+    self.assertEqual([3, 3, 2], SplitThreads([3, 3, 3], 8))
+    # Each partition gets at least one thread, within the number of threads.
+    self.assertEqual([2, 1, 1], SplitThreads([10, 0, 0], 4))
+    self.assertEqual([1, 1, 1], SplitThreads([10, 0, 0], 3))
+    self.assertEqual([2, 1], SplitThreads([0, 0], 3))
+
+  def _GetBlockDifferencesForFullOta(self):
+    input_tmp = common.MakeTempDir()
+    os.mkdir(os.path.join(input_tmp, 'IMAGES'))
+    # The partitions are in the order of the generic script, regardless of
+    # when their block differences are done.
+    for partition, blocks in (('vendor', 8), ('system', 40), ('odm', 1)):
+      with open(os.path.join(input_tmp, 'IMAGES', partition + '.img'),
+                'wb') as image_file:
+        for i in range(blocks):
+          image_file.write(bytes([i]) * 4096)
+      with open(os.path.join(input_tmp, 'IMAGES', partition + '.map'), 'w'):
+        pass
+    target_files = common.MakeTempFile(suffix='.zip')
+    with zipfile.ZipFile(target_files, 'w', allowZip64=True) as target_zip:
+      for partition in ('ODM', 'SYSTEM', 'VENDOR'):
+        target_zip.writestr(partition + '/', '')
+
+    common.OPTIONS.input_tmp = input_tmp
+    common.OPTIONS.info_dict = {
+        'blockimgdiff_versions': '3,4',
+        'use_dynamic_partitions': 'true',
+        'dynamic_partition_list': 'system vendor odm',
+    }
+    common.OPTIONS.cache_size = 4096 * 1024
+    device_specific = common.DeviceSpecificParams()
+    with zipfile.ZipFile(target_files, allowZip64=True) as target_zip:
+      return GetBlockDifferences(
+          target_zip, None, common.OPTIONS.info_dict, None, device_specific)
+
+  def test_GetBlockDifferences_fullOta(self):
+    common.OPTIONS.worker_threads = 4
+    block_diffs = self._GetBlockDifferencesForFullOta()
+    self.assertEqual(['system', 'vendor', 'odm'], list(block_diffs))
+    self.assertEqual([40, 8, 1], [block_diff.tgt.total_blocks
+                                  for block_diff in block_diffs.values()])
+
+  def test_GetBlockDifferences_withinWorkerThreads(self):
+    lock = threading.Lock()
+    running = []
+    calls = []
+
+    class FakeBlockDifference(object):
+      def __init__(self, partition, tgt, src=None, threads=None,
+                   process_pool=None):
+        with lock:
+          running.append(partition)
+          calls.append((partition, threads, len(running)))
+        time.sleep(0.1)
+        with lock:
+          running.remove(partition)
+        self.tgt = tgt
+        self.src = src
+        self.process_pool = process_pool
+
+    block_difference = common.BlockDifference
+    common.BlockDifference = FakeBlockDifference
+    try:
+      common.OPTIONS.worker_threads = 1
+      block_diffs = self._GetBlockDifferencesForFullOta()
+      self.assertEqual(['system', 'vendor', 'odm'], list(block_diffs))
+      # One at a time, from the largest.
+      self.assertEqual([('system', 1, 1), ('vendor', 1, 1), ('odm', 1, 1)],
+                       calls)
+
+      # Two at a time, and odm takes over the thread of the one that is done.
+      del calls[:]
+      common.OPTIONS.worker_threads = 2
+      self._GetBlockDifferencesForFullOta()
+      self.assertCountEqual([('system', 1), ('vendor', 1)],
+                            [call[:2] for call in calls[:2]])
+      self.assertEqual(('odm', 1), calls[2][:2])
+      self.assertEqual(2, max(call[2] for call in calls))
+    finally:
+      common.BlockDifference = block_difference
+
+  def test_GetBlockDifferences_workerProcesses(self):
+    pools = []
+
+    class FakeBlockDifference(object):
+      def __init__(self, partition, tgt, src=None, threads=None,
+                   process_pool=None):
+        # The pool computes the patches in its worker processes.
+        del partition, threads
+        self.tgt = tgt
+        self.src = src
+        pools.append(process_pool)
+        self.pid = process_pool.apply(os.getpid) if process_pool else None
+
+    block_difference = common.BlockDifference
+    common.BlockDifference = FakeBlockDifference
+    try:
+      common.OPTIONS.worker_threads = 2
+      block_diffs = self._GetBlockDifferencesForFullOta()
+      self.assertEqual([None] * 3, pools)
+      self.assertEqual([None] * 3,
+                       [block_diff.pid for block_diff in block_diffs.values()])
+
+      # One pool is shared by all the partitions.
+      del pools[:]
+      common.OPTIONS.use_worker_processes = True
+      block_diffs = self._GetBlockDifferencesForFullOta()
+      self.assertEqual(3, len(pools))
+      self.assertIsNotNone(pools[0])
+      self.assertTrue(all(pool is pools[0] for pool in pools))
+      for block_diff in block_diffs.values():
+        self.assertNotEqual(os.getpid(), block_diff.pid)
+    finally:
+      common.OPTIONS.use_worker_processes = False
+      common.BlockDifference = block_difference
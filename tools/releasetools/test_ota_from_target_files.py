@@ -15,19 +15,28 @@
 #
 
 import copy
+import json
+import multiprocessing
 import os
 import os.path
 import tempfile
 import zipfile
 
 import common
+import ota_from_target_files
 import ota_metadata_pb2
 import test_utils
 from ota_utils import (
     BuildLegacyOtaMetadata, CalculateRuntimeDevicesAndFingerprints,
-    ConstructOtaApexInfo, FinalizeMetadata, GetPackageMetadata, PropertyFiles, AbOtaPropertyFiles, PayloadGenerator, StreamingPropertyFiles)
+    ConstructOtaApexInfo, FinalizeMetadata, FinalizeMetadataInOnePass,
+    GetPackageMetadata, PropertyFiles, AbOtaPropertyFiles, PayloadGenerator, StreamingPropertyFiles,
+    TargetFilesOverlay)
 from ota_from_target_files import (
     _LoadOemDicts,
+    ExtractBatchInput,
+    GenerateOtaPackagesInBatch,
+    GetTargetFilesDigest,
+    LoadBatchManifest,
     GetTargetFilesZipForCustomImagesUpdates,
     GetTargetFilesZipForPartialUpdates,
     GetTargetFilesZipForSecondaryImages,
@@ -89,6 +98,12 @@ def construct_target_files(secondary=False, compressedApex=False):
   return target_files
 
 
+def get_target_files_entries(target_dir):
+  """Returns the entry names of an extracted target-files directory."""
+  return [os.path.relpath(os.path.join(root, name), target_dir)
+          for root, _, files in os.walk(target_dir) for name in files]
+
+
 class LoadOemDictsTest(test_utils.ReleaseToolsTestCase):
 
   def test_NoneDict(self):
@@ -122,6 +137,83 @@ class LoadOemDictsTest(test_utils.ReleaseToolsTestCase):
       self.assertEqual('{}'.format(i), oem_dict['ro.build.index'])
 
 
+class BatchTest(test_utils.ReleaseToolsTestCase):
+
+  def test_GetTargetFilesDigest(self):
+    target_files = construct_target_files()
+    target_files_copy = common.MakeTempFile(suffix='.zip')
+    with open(target_files, 'rb') as src, open(target_files_copy, 'wb') as dst:
+      dst.write(src.read())
+    self.assertEqual(GetTargetFilesDigest(target_files),
+                     GetTargetFilesDigest(target_files_copy))
+
+    with zipfile.ZipFile(target_files_copy, 'a', allowZip64=True) as append_zip:
+      common.ZipWriteStr(append_zip, 'IMAGES/oem.img', 'oem')
+    self.assertNotEqual(GetTargetFilesDigest(target_files),
+                        GetTargetFilesDigest(target_files_copy))
+
+  def test_ExtractBatchInput(self):
+    workspace = common.MakeTempDir()
+    target_files = construct_target_files()
+    extracted_dir = ExtractBatchInput(target_files, workspace)
+    self.assertEqual([os.path.basename(extracted_dir)], os.listdir(workspace))
+    self.assertTrue(
+        os.path.exists(os.path.join(extracted_dir, 'IMAGES', 'system.img')))
+
+    # The same build at another path is extracted only once.
+    target_files_copy = common.MakeTempFile(suffix='.zip')
+    with open(target_files, 'rb') as src, open(target_files_copy, 'wb') as dst:
+      dst.write(src.read())
+    self.assertEqual(extracted_dir,
+                     ExtractBatchInput(target_files_copy, workspace))
+    self.assertEqual([os.path.basename(extracted_dir)], os.listdir(workspace))
+
+  def test_LoadBatchManifest(self):
+    manifest = common.MakeTempFile(suffix='.json')
+    with open(manifest, 'w') as f:
+      f.write('[{"target": "t.zip", "output": "ota.zip"},'
+              ' {"target": "t.zip", "source": "s.zip", "output": "inc.zip",'
+              '  "args": ["--partial", "system"]}]')
+    jobs = LoadBatchManifest(manifest)
+    self.assertEqual(2, len(jobs))
+    self.assertEqual(['--partial', 'system'], jobs[1]['args'])
+
+  def test_LoadBatchManifest_missingOutput(self):
+    manifest = common.MakeTempFile(suffix='.json')
+    with open(manifest, 'w') as f:
+      f.write('[{"target": "t.zip"}]')
+    self.assertRaises(ValueError, LoadBatchManifest, manifest)
+
+  def test_GenerateOtaPackagesInBatch_jobsWithWorkerProcesses(self):
+    def GenerateOtaPackage(argv):
+      # Like a job with --use_worker_processes, which starts a Pool.
+      with multiprocessing.get_context('fork').Pool(2) as pool:
+        results = pool.map(abs, [-1, -2])
+      with open(argv[-1], 'w') as f:
+        f.write(' '.join(argv[:4] + [str(sum(results))]))
+
+    target_files = common.MakeTempFile(suffix='.zip')
+    with zipfile.ZipFile(target_files, 'w', allowZip64=True) as target_zip:
+      target_zip.writestr('META/misc_info.txt',
+                          'recovery_api_version=3\nfstab_version=2\n')
+    outputs = [common.MakeTempFile(suffix='.zip') for _ in range(3)]
+    manifest = common.MakeTempFile(suffix='.json')
+    with open(manifest, 'w') as f:
+      json.dump([{'target': target_files, 'output': output}
+                 for output in outputs], f)
+    common.OPTIONS.batch_cpu_budget = 2
+
+    main = ota_from_target_files.main
+    ota_from_target_files.main = GenerateOtaPackage
+    try:
+      GenerateOtaPackagesInBatch(manifest)
+    finally:
+      ota_from_target_files.main = main
+    for output in outputs:
+      with open(output) as f:
+        self.assertEqual('--max_threads 1 --worker_threads 1 3', f.read())
+
+
 class OtaFromTargetFilesTest(test_utils.ReleaseToolsTestCase):
   TEST_TARGET_INFO_DICT = {
       'build.prop': common.PartitionBuildProps.FromDictionary(
@@ -601,10 +693,11 @@ class OtaFromTargetFilesTest(test_utils.ReleaseToolsTestCase):
     with zipfile.ZipFile(input_file, 'a', allowZip64=True) as append_zip:
       common.ZipWriteStr(append_zip, 'IMAGES/system.map', 'fake map')
 
-    target_file = GetTargetFilesZipForPartialUpdates(input_file, ['system'])
-    with zipfile.ZipFile(target_file) as verify_zip:
-      namelist = verify_zip.namelist()
-      ab_partitions = verify_zip.read('META/ab_partitions.txt').decode()
+    target_dir = GetTargetFilesZipForPartialUpdates(
+        TargetFilesOverlay(input_file), ['system']).Materialize()
+    namelist = get_target_files_entries(target_dir)
+    ab_partitions = common.ReadFromInputFile(target_dir,
+                                             'META/ab_partitions.txt')
 
     self.assertIn('META/ab_partitions.txt', namelist)
     self.assertIn('META/update_engine_config.txt', namelist)
@@ -622,7 +715,7 @@ class OtaFromTargetFilesTest(test_utils.ReleaseToolsTestCase):
   def test_GetTargetFilesZipForPartialUpdates_unrecognizedPartition(self):
     input_file = construct_target_files()
     self.assertRaises(ValueError, GetTargetFilesZipForPartialUpdates,
-                      input_file, ['product'])
+                      TargetFilesOverlay(input_file), ['product'])
 
   @test_utils.SkipIfExternalToolsUnavailable()
   def test_GetTargetFilesZipForPartialUpdates_dynamicPartitions(self):
@@ -646,14 +739,15 @@ class OtaFromTargetFilesTest(test_utils.ReleaseToolsTestCase):
       common.ZipWriteStr(append_zip, 'META/dynamic_partitions_info.txt',
                          dynamic_partitions_info)
 
-    target_file = GetTargetFilesZipForPartialUpdates(input_file,
-                                                     ['boot', 'system'])
-    with zipfile.ZipFile(target_file) as verify_zip:
-      namelist = verify_zip.namelist()
-      ab_partitions = verify_zip.read('META/ab_partitions.txt').decode()
-      updated_misc_info = verify_zip.read('META/misc_info.txt').decode()
-      updated_dynamic_partitions_info = verify_zip.read(
-          'META/dynamic_partitions_info.txt').decode()
+    target_dir = GetTargetFilesZipForPartialUpdates(
+        TargetFilesOverlay(input_file), ['boot', 'system']).Materialize()
+    namelist = get_target_files_entries(target_dir)
+    ab_partitions = common.ReadFromInputFile(target_dir,
+                                             'META/ab_partitions.txt')
+    updated_misc_info = common.ReadFromInputFile(target_dir,
+                                                 'META/misc_info.txt')
+    updated_dynamic_partitions_info = common.ReadFromInputFile(
+        target_dir, 'META/dynamic_partitions_info.txt')
 
     self.assertIn('META/ab_partitions.txt', namelist)
     self.assertIn('IMAGES/boot.img', namelist)
@@ -678,17 +772,17 @@ class OtaFromTargetFilesTest(test_utils.ReleaseToolsTestCase):
   @test_utils.SkipIfExternalToolsUnavailable()
   def test_GetTargetFilesZipWithoutPostinstallConfig(self):
     input_file = construct_target_files()
-    target_file = GetTargetFilesZipWithoutPostinstallConfig(input_file)
-    with zipfile.ZipFile(target_file) as verify_zip:
-      self.assertNotIn(POSTINSTALL_CONFIG, verify_zip.namelist())
+    target_dir = GetTargetFilesZipWithoutPostinstallConfig(
+        TargetFilesOverlay(input_file)).Materialize()
+    self.assertNotIn(POSTINSTALL_CONFIG, get_target_files_entries(target_dir))
 
   @test_utils.SkipIfExternalToolsUnavailable()
   def test_GetTargetFilesZipWithoutPostinstallConfig_missingEntry(self):
     input_file = construct_target_files()
     common.ZipDelete(input_file, POSTINSTALL_CONFIG)
-    target_file = GetTargetFilesZipWithoutPostinstallConfig(input_file)
-    with zipfile.ZipFile(target_file) as verify_zip:
-      self.assertNotIn(POSTINSTALL_CONFIG, verify_zip.namelist())
+    target_dir = GetTargetFilesZipWithoutPostinstallConfig(
+        TargetFilesOverlay(input_file)).Materialize()
+    self.assertNotIn(POSTINSTALL_CONFIG, get_target_files_entries(target_dir))
 
   @test_utils.SkipIfExternalToolsUnavailable()
   def test_GetTargetFilesZipForCustomImagesUpdates_oemDefaultImage(self):
@@ -697,13 +791,13 @@ class OtaFromTargetFilesTest(test_utils.ReleaseToolsTestCase):
       common.ZipWriteStr(append_zip, 'IMAGES/oem.img', 'oem')
       common.ZipWriteStr(append_zip, 'IMAGES/oem_test.img', 'oem_test')
 
-    target_file = GetTargetFilesZipForCustomImagesUpdates(
-        input_file, {'oem': 'oem.img'})
+    target_dir = GetTargetFilesZipForCustomImagesUpdates(
+        TargetFilesOverlay(input_file), {'oem': 'oem.img'}).Materialize()
 
-    with zipfile.ZipFile(target_file) as verify_zip:
-      namelist = verify_zip.namelist()
-      ab_partitions = verify_zip.read('META/ab_partitions.txt').decode()
-      oem_image = verify_zip.read('IMAGES/oem.img').decode()
+    namelist = get_target_files_entries(target_dir)
+    ab_partitions = common.ReadFromInputFile(target_dir,
+                                             'META/ab_partitions.txt')
+    oem_image = common.ReadFromInputFile(target_dir, 'IMAGES/oem.img')
 
     self.assertIn('META/ab_partitions.txt', namelist)
     self.assertEqual('boot\nsystem\nvendor\nbootloader\nmodem', ab_partitions)
@@ -717,13 +811,13 @@ class OtaFromTargetFilesTest(test_utils.ReleaseToolsTestCase):
       common.ZipWriteStr(append_zip, 'IMAGES/oem.img', 'oem')
       common.ZipWriteStr(append_zip, 'IMAGES/oem_test.img', 'oem_test')
 
-    target_file = GetTargetFilesZipForCustomImagesUpdates(
-        input_file, {'oem': 'oem_test.img'})
+    target_dir = GetTargetFilesZipForCustomImagesUpdates(
+        TargetFilesOverlay(input_file), {'oem': 'oem_test.img'}).Materialize()
 
-    with zipfile.ZipFile(target_file) as verify_zip:
-      namelist = verify_zip.namelist()
-      ab_partitions = verify_zip.read('META/ab_partitions.txt').decode()
-      oem_image = verify_zip.read('IMAGES/oem.img').decode()
+    namelist = get_target_files_entries(target_dir)
+    ab_partitions = common.ReadFromInputFile(target_dir,
+                                             'META/ab_partitions.txt')
+    oem_image = common.ReadFromInputFile(target_dir, 'IMAGES/oem.img')
 
     self.assertIn('META/ab_partitions.txt', namelist)
     self.assertEqual('boot\nsystem\nvendor\nbootloader\nmodem', ab_partitions)
@@ -771,6 +865,29 @@ class OtaFromTargetFilesTest(test_utils.ReleaseToolsTestCase):
     common.OPTIONS.no_signing = True
     self._test_FinalizeMetadata(large_entry=True)
 
+  def test_FinalizeMetadataInOnePass_withNoSigning(self):
+    entries = [
+        'required-entry1',
+        'required-entry2',
+        'optional-entry1',
+    ]
+    zip_file = PropertyFilesTest.construct_zip_package(entries)
+    metadata = ota_metadata_pb2.OtaMetadata()
+    output_file = common.MakeTempFile(suffix='.zip')
+    needed_property_files = (
+        TestPropertyFiles(),
+    )
+    FinalizeMetadataInOnePass(metadata, zip_file, output_file,
+                              needed_property_files)
+
+    property_files_string = metadata.property_files['ota-test-property-files']
+    with zipfile.ZipFile(output_file, allowZip64=True) as output_zip:
+      self.assertEqual(
+          needed_property_files[0].GetPropertyFilesString(output_zip),
+          property_files_string.strip())
+      self.assertIn('ota-test-property-files=' + property_files_string,
+                    output_zip.read('META-INF/com/android/metadata').decode())
+
   @test_utils.SkipIfExternalToolsUnavailable()
   def test_FinalizeMetadata_insufficientSpace(self):
     entries = [
@@ -15,9 +15,13 @@
 
 import unittest
 import io
+import os
 import ota_utils
 import zipfile
 
+import common
+import test_utils
+
 
 class TestZipEntryOffset(unittest.TestCase):
   def test_extra_length_differ(self):
@@ -54,3 +58,144 @@ class TestZipEntryOffset(unittest.TestCase):
       (offset, size) = ota_utils.GetZipEntryOffset(zfp, zinfo)
       self.assertEqual(size, zinfo.file_size)
       self.assertEqual(offset, zipfile.sizeFileHeader+len(zinfo.filename) + 28)
+
+
+class PackageZipLayoutTest(test_utils.ReleaseToolsTestCase):
+
+  def setUp(self):
+    self.zip_file = common.MakeTempFile(suffix='.zip')
+    with zipfile.ZipFile(self.zip_file, 'w', allowZip64=True) as zip_fp:
+      zip_fp.writestr('payload.bin', b'A' * 10, zipfile.ZIP_STORED)
+      zip_fp.writestr('META-INF/CERT.RSA', b'B' * 3, zipfile.ZIP_STORED)
+      zip_fp.writestr('dir/', b'')
+      zip_fp.writestr('compressed', b'C' * 100, zipfile.ZIP_DEFLATED)
+      zip_fp.writestr('care_map.pb', b'D' * 5, zipfile.ZIP_STORED)
+    self.appended_entries = [('META-INF/com/android/metadata.pb', 7),
+                             ('META-INF/com/android/metadata', 9)]
+
+  def test_Unsigned(self):
+    with zipfile.ZipFile(self.zip_file, allowZip64=True) as zip_fp:
+      layout = ota_utils.PackageZipLayout(
+          zip_fp, self.appended_entries, signed=False)
+      expected = {name: ota_utils.GetZipEntryOffset(zip_fp, info)
+                  for name, info in zip(zip_fp.namelist(), zip_fp.infolist())}
+      for name in expected:
+        self.assertEqual(expected[name], layout.GetEntryOffset(name))
+
+    with zipfile.ZipFile(self.zip_file, 'a', allowZip64=True) as zip_fp:
+      for name, size in self.appended_entries:
+        common.ZipWriteStr(zip_fp, name, b'E' * size,
+                           compress_type=zipfile.ZIP_STORED)
+    with zipfile.ZipFile(self.zip_file, allowZip64=True) as zip_fp:
+      for name, _ in self.appended_entries:
+        self.assertEqual(
+            ota_utils.GetZipEntryOffset(zip_fp, zip_fp.getinfo(name)),
+            layout.GetEntryOffset(name))
+
+  def test_Signed(self):
+    with zipfile.ZipFile(self.zip_file, allowZip64=True) as zip_fp:
+      layout = ota_utils.PackageZipLayout(
+          zip_fp, self.appended_entries, signed=True)
+      # The ZIP_STORED entries come first in the order of their names. Each
+      # local file header has a 6-byte extra field, and the first one has
+      # the 4-byte JAR magic in addition.
+      self.assertEqual((4 + 30 + 29 + 6, 9), layout.GetEntryOffset(
+          'META-INF/com/android/metadata'))
+      self.assertEqual((78 + 30 + 32 + 6, 7), layout.GetEntryOffset(
+          'META-INF/com/android/metadata.pb'))
+      self.assertEqual((153 + 30 + 11 + 6, 5), layout.GetEntryOffset(
+          'care_map.pb'))
+      self.assertEqual((205 + 30 + 11 + 6, 10), layout.GetEntryOffset(
+          'payload.bin'))
+      self.assertRaises(ota_utils.PackageZipLayout.UnplannedEntryException,
+                        layout.GetEntryOffset, 'compressed')
+      # The signature entries are stripped by signapk.jar.
+      self.assertRaises(KeyError, layout.GetEntryOffset, 'META-INF/CERT.RSA')
+      self.assertNotIn('dir/', layout.namelist())
+
+
+class TargetFilesOverlayTest(test_utils.ReleaseToolsTestCase):
+
+  def setUp(self):
+    self.target_files = common.MakeTempFile(suffix='.zip')
+    with zipfile.ZipFile(self.target_files, 'w',
+                         allowZip64=True) as target_files_zip:
+      target_files_zip.writestr('META/ab_partitions.txt', 'boot\nsystem')
+      target_files_zip.writestr('META/misc_info.txt', 'foo=bar')
+      target_files_zip.writestr('IMAGES/boot.img', 'boot')
+      target_files_zip.writestr('IMAGES/system.img', 'system')
+      target_files_zip.writestr('META/file_contexts[1].bin', 'contexts')
+      target_files_zip.writestr('PREBUILT_IMAGES/dtbo.img', 'dtbo')
+      target_files_zip.writestr('OTA/super_system.img', 'super_system')
+      target_files_zip.writestr('SYSTEM/build.prop', 'ro.foo=bar')
+      target_files_zip.writestr('SYSTEM/bin/foo', 'foo')
+    self.target_files_dir = common.MakeTempDir()
+    common.UnzipToDir(self.target_files, self.target_files_dir)
+
+  def _EditOverlay(self, base):
+    overlay = ota_utils.TargetFilesOverlay(base)
+    overlay.Write('META/ab_partitions.txt', 'system')
+    overlay.Delete('IMAGES/boot.img')
+    overlay.Rename('OTA/super_system.img', 'IMAGES/system.img')
+    return overlay
+
+  def _AssertEdited(self, overlay):
+    self.assertEqual('system', overlay.Read('META/ab_partitions.txt'))
+    self.assertFalse(overlay.Exists('IMAGES/boot.img'))
+    self.assertEqual(['system.img'], overlay.List('IMAGES'))
+    self.assertEqual(b'super_system', overlay.ReadBytes('IMAGES/system.img'))
+    self.assertEqual('foo=bar', overlay.Read('META/misc_info.txt'))
+
+  def _AssertMaterialized(self, target_dir, extra_entries=()):
+    entries = sorted(
+        os.path.relpath(os.path.join(root, name), target_dir)
+        for root, _, files in os.walk(target_dir) for name in files)
+    self.assertEqual(sorted(['IMAGES/system.img', 'META/ab_partitions.txt',
+                             'META/file_contexts[1].bin', 'META/misc_info.txt',
+                             'SYSTEM/build.prop'] + list(extra_entries)),
+                     entries)
+    self.assertEqual('super_system', common.ReadFromInputFile(
+        target_dir, 'IMAGES/system.img'))
+    self.assertEqual('system', common.ReadFromInputFile(
+        target_dir, 'META/ab_partitions.txt'))
+
+  def test_Zip(self):
+    overlay = self._EditOverlay(self.target_files)
+    self._AssertEdited(overlay)
+    self._AssertMaterialized(overlay.Materialize())
+    self._AssertEdited(overlay)
+    with zipfile.ZipFile(self.target_files) as verify_zip:
+      self.assertEqual(b'boot\nsystem',
+                       verify_zip.read('META/ab_partitions.txt'))
+
+  def test_Dir(self):
+    overlay = self._EditOverlay(self.target_files_dir)
+    self._AssertEdited(overlay)
+    target_dir = overlay.Materialize()
+    # PREBUILT_IMAGES are only copied from an extracted directory, as by
+    # CopyTargetFilesDir().
+    self._AssertMaterialized(target_dir, ['PREBUILT_IMAGES/dtbo.img'])
+    self._AssertEdited(overlay)
+    # The images that aren't edited are linked to, and never written through.
+    self.assertTrue(
+        os.path.islink(os.path.join(target_dir, 'PREBUILT_IMAGES', 'dtbo.img')))
+    # The other entries are copied, as common.ZipWrite() would change the
+    # permissions of the base through a link.
+    self.assertFalse(
+        os.path.islink(os.path.join(target_dir, 'META', 'misc_info.txt')))
+    overlay.Write('META/misc_info.txt', 'foo=baz')
+    self.assertEqual('foo=baz', overlay.Read('META/misc_info.txt'))
+    self.assertEqual('foo=bar', common.ReadFromInputFile(
+        self.target_files_dir, 'META/misc_info.txt'))
+    self.assertTrue(os.path.exists(
+        os.path.join(self.target_files_dir, 'IMAGES', 'boot.img')))
+
+  def test_MissingEntry(self):
+    overlay = ota_utils.TargetFilesOverlay(self.target_files)
+    self.assertRaises(KeyError, overlay.Read, 'META/care_map.pb')
+    self.assertRaises(KeyError, overlay.Delete, 'IMAGES/vendor.img')
+    self.assertRaises(KeyError, overlay.Rename, 'IMAGES/vendor.img',
+                      'IMAGES/system.img')
+    # Entries that OTA generation doesn't read aren't visible.
+    self.assertFalse(overlay.Exists('SYSTEM/bin/foo'))
+    self.assertFalse(overlay.Exists('PREBUILT_IMAGES/dtbo.img'))
@@ -25,22 +25,42 @@ class RangeSetTest(ReleaseToolsTestCase):
                      RangeSet("10-34"))
     self.assertEqual(RangeSet("10-19 30-34").union(RangeSet("22 32")),
                      RangeSet("10-19 22 30-34"))
+    # Adjacent and nested ranges should be coalesced.
+    self.assertEqual(RangeSet("10-19 30-34").union(RangeSet("20-29 31")),
+                     RangeSet("10-34"))
+    self.assertEqual(RangeSet("0-99").union(RangeSet("5 10-19 50-60")),
+                     RangeSet("0-99"))
+    self.assertEqual(RangeSet("").union(RangeSet("5-9")), RangeSet("5-9"))
 
   def test_intersect(self):
     self.assertEqual(RangeSet("10-19 30-34").intersect(RangeSet("18-32")),
                      RangeSet("18-19 30-32"))
     self.assertEqual(RangeSet("10-19 30-34").intersect(RangeSet("22-28")),
                      RangeSet(""))
+    self.assertEqual(RangeSet("10-19 30-34").intersect(RangeSet("20-29")),
+                     RangeSet(""))
+    self.assertEqual(RangeSet("0-99").intersect(RangeSet("5 10-19 99-120")),
+                     RangeSet("5 10-19 99"))
+    self.assertEqual(RangeSet("").intersect(RangeSet("5-9")), RangeSet(""))
 
   def test_subtract(self):
     self.assertEqual(RangeSet("10-19 30-34").subtract(RangeSet("18-32")),
                      RangeSet("10-17 33-34"))
     self.assertEqual(RangeSet("10-19 30-34").subtract(RangeSet("22-28")),
                      RangeSet("10-19 30-34"))
+    self.assertEqual(RangeSet("0-99").subtract(RangeSet("0 10-19 50-60 99")),
+                     RangeSet("1-9 20-49 61-98"))
+    self.assertEqual(RangeSet("10-19 30-34").subtract(RangeSet("0-40")),
+                     RangeSet(""))
+    self.assertEqual(RangeSet("10-19").subtract(RangeSet("")),
+                     RangeSet("10-19"))
 
   def test_overlaps(self):
     self.assertTrue(RangeSet("10-19 30-34").overlaps(RangeSet("18-32")))
     self.assertFalse(RangeSet("10-19 30-34").overlaps(RangeSet("22-28")))
+    self.assertFalse(RangeSet("10-19 30-34").overlaps(RangeSet("20-29 35")))
+    self.assertTrue(RangeSet("10-19 30-34").overlaps(RangeSet("0-5 34")))
+    self.assertFalse(RangeSet("").overlaps(RangeSet("0-5")))
 
   def test_size(self):
     self.assertEqual(RangeSet("10-19 30-34").size(), 15)
@@ -74,6 +94,8 @@ class RangeSetTest(ReleaseToolsTestCase):
     self.assertEqual(RangeSet("10-19").extend(15), RangeSet("0-34"))
     self.assertEqual(RangeSet("10-19 30-39").extend(4), RangeSet("6-23 26-43"))
     self.assertEqual(RangeSet("10-19 30-39").extend(10), RangeSet("0-49"))
+    self.assertEqual(RangeSet("2 10-19 30-39 60").extend(5),
+                     RangeSet("0-44 55-65"))
 
   def test_equality(self):
     self.assertTrue(RangeSet("") == RangeSet(""))
@@ -23,8 +23,8 @@ import common
 import test_utils
 from sign_target_files_apks import (
     CheckApkAndApexKeysAvailable, EditTags, GetApkFileInfo, ParseAvbInfo,
-    ReadApexKeysInfo, ReplaceCerts, RewriteAvbProps, RewriteProps,
-    WriteOtacerts)
+    ReadAheadSignings, ReadApexKeysInfo, ReplaceCerts, RewriteAvbProps,
+    RewriteProps, WriteOtacerts)
 
 
 class SignTargetFilesApksTest(test_utils.ReleaseToolsTestCase):
@@ -537,6 +537,31 @@ name="apex.apexd_test_different_app.apex" public_key="system/apex/apexd/apexd_te
             'build/make/target/product/security/testkey', None),
         }, keys_info)
 
+  def test_ReadAheadSignings(self):
+    submitted = []
+
+    def SubmitSigning(executor, entry):
+      submitted.append(entry)
+      if entry % 3:
+        return entry % 3, None
+      return 0, executor.submit(lambda: entry * 10)
+
+    processed = []
+    for entry, decision, signing in ReadAheadSignings(
+        range(20), SubmitSigning, 2, 1):
+      # At most num_workers + max_queued_signings signings are started ahead of
+      # this entry.
+      self.assertLessEqual(
+          len([e for e in submitted if e > entry and e % 3 == 0]), 3)
+      self.assertEqual(entry % 3, decision)
+      if signing is None:
+        processed.append(entry)
+      else:
+        processed.append(signing.result())
+
+    self.assertEqual(
+        [e * 10 if e % 3 == 0 else e for e in range(20)], processed)
+
   def test_ParseAvbInfo(self):
     avb_info_string = """
     Footer version:           1.0
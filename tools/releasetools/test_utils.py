@@ -112,7 +112,8 @@ def erase_avb_footer(file_path: str):
     raise ValueError(f"Failed to erase hashtree footer {args}")
 
 
-def construct_sparse_image(chunks, partition_name: str = ""):
+def construct_sparse_image(chunks, partition_name: str = "",
+                           append_footer: bool = True):
   """Returns a sparse image file constructed from the given chunks.
 
   From system/core/libsparse/sparse_format.h.
@@ -141,7 +142,10 @@ def construct_sparse_image(chunks, partition_name: str = ""):
 
   Args:
     chunks: A list of chunks to be written. Each entry should be a tuple of
-        (chunk_type, block_number).
+        (chunk_type, block_number), or (chunk_type, block_number, data) to
+        write the given chunk data instead of random bytes.
+    partition_name: The partition name of the AVB hashtree footer.
+    append_footer: Whether to append an AVB hashtree footer to the image.
 
   Returns:
     Filename of the created sparse image.
@@ -168,12 +172,19 @@ def construct_sparse_image(chunks, partition_name: str = ""):
       else:
         assert False, "Unsupported chunk type: {}".format(chunk[0])
 
+      if len(chunk) > 2:
+        data = chunk[2]
+        assert len(data) == data_size, \
+            "Chunk data should be {} bytes".format(data_size)
+      else:
+        data = os.urandom(data_size)
+
       fp.write(struct.pack(
           CHUNK_HEADER_FORMAT, chunk[0], 0, chunk[1], data_size + 12))
-      if data_size != 0:
-        fp.write(os.urandom(data_size))
+      fp.write(data)
 
-  append_avb_footer(sparse_image, partition_name)
+  if append_footer:
+    append_avb_footer(sparse_image, partition_name)
   return sparse_image
 
 
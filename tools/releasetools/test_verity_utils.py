@@ -17,17 +17,20 @@
 """Unittests for verity_utils.py."""
 
 import copy
+import functools
 import math
 import os.path
 import random
 
 import common
 import sparse_img
+import verity_utils
 from rangelib import RangeSet
 from test_utils import (
     get_testdata_dir, ReleaseToolsTestCase, SkipIfExternalToolsUnavailable)
 from verity_utils import (
-    CalculateVbmetaDigest, CreateVerityImageBuilder)
+    CalculateAvbMaxImageSize, CalculateVbmetaDigest, CreateVerityImageBuilder,
+    VerifiedBootVersion2VerityImageBuilder)
 
 BLOCK_SIZE = common.BLOCK_SIZE
 
@@ -42,6 +45,14 @@ class VerifiedBootVersion2VerityImageBuilderTest(ReleaseToolsTestCase):
       'avb_add_hashtree_footer_args': '',
   }
 
+  def setUp(self):
+    # Don't reuse the max image sizes calculated by the other tests.
+    verity_utils._max_image_sizes.clear()
+
+  def tearDown(self):
+    verity_utils._max_image_sizes.clear()
+    super(VerifiedBootVersion2VerityImageBuilderTest, self).tearDown()
+
   def test_init(self):
     prop_dict = copy.deepcopy(self.DEFAULT_PROP_DICT)
     verity_image_builder = CreateVerityImageBuilder(prop_dict)
@@ -152,6 +163,72 @@ class VerifiedBootVersion2VerityImageBuilderTest(ReleaseToolsTestCase):
           _SizeCalculator(min_partition_size - BLOCK_SIZE),
           image_size)
 
+  def test_CalculateAvbMaxImageSize_HashFooter(self):
+    self.assertEqual(
+        4096 * 1024 - 64 * 1024 - 4096,
+        CalculateAvbMaxImageSize(
+            VerifiedBootVersion2VerityImageBuilder.AVB_HASH_FOOTER,
+            '--prop com.android.build.boot.os_version:15', 4096 * 1024))
+
+  def test_CalculateAvbMaxImageSize_HashtreeFooter(self):
+    hashtree_footer = VerifiedBootVersion2VerityImageBuilder.AVB_HASHTREE_FOOTER
+    # With the default sha1 digests padded to 32 bytes, the hashtree of 1024
+    # blocks has 8 blocks at level 0 and 1 block at level 1. The FEC data has 5
+    # rounds of 2 roots, plus the header block.
+    self.assertEqual(
+        4096 * 1024 - (8 + 1) * 4096 - (5 * 2 + 1) * 4096 - 64 * 1024 - 4096,
+        CalculateAvbMaxImageSize(hashtree_footer, None, 4096 * 1024))
+    self.assertEqual(
+        4096 * 1024 - (8 + 1) * 4096 - 64 * 1024 - 4096,
+        CalculateAvbMaxImageSize(
+            hashtree_footer, '--hash_algorithm=sha256 --do_not_generate_fec',
+            4096 * 1024))
+    self.assertEqual(
+        4096 * 1024 - 64 * 1024 - 4096,
+        CalculateAvbMaxImageSize(hashtree_footer, '--no_hashtree',
+                                 4096 * 1024))
+
+  def test_CalculateAvbMaxImageSize_UnsupportedArgs(self):
+    hashtree_footer = VerifiedBootVersion2VerityImageBuilder.AVB_HASHTREE_FOOTER
+    for signing_args in ('--hash_algorithm md5', '--hash_alg sha256',
+                         '--partition_size 8192', '--block_size'):
+      self.assertIsNone(
+          CalculateAvbMaxImageSize(hashtree_footer, signing_args, 4096 * 1024))
+
+  def test_CalculateMaxImageSize_InProcess(self):
+    prop_dict = copy.deepcopy(self.DEFAULT_PROP_DICT)
+    prop_dict['avb_avbtool'] = 'non-existent-avbtool'
+    builder = CreateVerityImageBuilder(prop_dict)
+    self.assertEqual(
+        CalculateAvbMaxImageSize(builder.footer_type, '', 4096 * 1024),
+        builder.CalculateMaxImageSize())
+    self.assertEqual(builder.image_size, builder.CalculateMaxImageSize())
+
+  @SkipIfExternalToolsUnavailable()
+  def test_CalculateMaxImageSize_CheckedWithAvbtool(self):
+    def CalculateWithAvbtool(calculate_with_avbtool, avbtool_calls,
+                             partition_size):
+      avbtool_calls.append(partition_size)
+      return calculate_with_avbtool(partition_size)
+
+    common.OPTIONS.check_avb_max_image_size = True
+    try:
+      for footer_args in ('', '--hash_algorithm sha256',
+                          '--do_not_generate_fec', '--fec_num_roots 8'):
+        prop_dict = copy.deepcopy(self.DEFAULT_PROP_DICT)
+        prop_dict['avb_add_hashtree_footer_args'] = footer_args
+        builder = CreateVerityImageBuilder(prop_dict)
+        avbtool_calls = []
+        builder._CalculateMaxImageSizeWithAvbtool = functools.partial(
+            CalculateWithAvbtool, builder._CalculateMaxImageSizeWithAvbtool,
+            avbtool_calls)
+        partition_sizes = [BLOCK_SIZE * 1024, BLOCK_SIZE * 262145]
+        for partition_size in partition_sizes:
+          builder.CalculateMaxImageSize(partition_size)
+        self.assertEqual(partition_sizes, avbtool_calls)
+    finally:
+      common.OPTIONS.check_avb_max_image_size = False
+
   @SkipIfExternalToolsUnavailable()
   def test_CalculateVbmetaDigest(self):
     prop_dict = copy.deepcopy(self.DEFAULT_PROP_DICT)
@@ -23,6 +23,7 @@ Usage:  verity_utils properties_file output_image
 from __future__ import print_function
 
 import logging
+import os
 import os.path
 import shlex
 import struct
@@ -42,6 +43,25 @@ FIXED_SALT = "aee087a5be3b982978c923f566a94613496b417f2af592639bc80d141e34dfe7"
 # From external/avb/avbtool.py
 MAX_VBMETA_SIZE = 64 * 1024
 MAX_FOOTER_SIZE = 4096
+AVB_HASHTREE_DIGEST_SIZES = {
+    "sha1": 20,
+    "sha256": 32,
+    "sha512": 64,
+    "blake2b-256": 32,
+}
+
+# From system/extras/libfec/include/fec/io.h
+FEC_BLOCK_SIZE = 4096
+FEC_RSM = 255
+
+# Whether to check the max image sizes calculated in-process against the ones
+# given by avbtool.
+OPTIONS.check_avb_max_image_size = (
+    os.environ.get("CHECK_AVB_MAX_IMAGE_SIZE") == "true")
+
+# The max image sizes calculated so far, keyed by (footer type, signing args,
+# partition size).
+_max_image_sizes = {}
 
 
 class BuildVerityImageError(Exception):
@@ -224,6 +244,10 @@ class VerifiedBootVersion2VerityImageBuilder(VerityImageBuilder):
   def CalculateMaxImageSize(self, partition_size=None):
     """Calculates max image size for a given partition size.
 
+    The size is calculated in-process if possible, or by avbtool otherwise.
+    The sizes are memoized, and checked against avbtool if
+    OPTIONS.check_avb_max_image_size is set.
+
     Args:
       partition_size: The partition size, which defaults to self.partition_size
           if unspecified.
@@ -239,6 +263,30 @@ class VerifiedBootVersion2VerityImageBuilder(VerityImageBuilder):
     assert partition_size > 0, \
         "Invalid partition size: {}".format(partition_size)
 
+    key = (self.footer_type, self.signing_args, partition_size)
+    image_size = _max_image_sizes.get(key)
+    if image_size is None:
+      image_size = CalculateAvbMaxImageSize(
+          self.footer_type, self.signing_args, partition_size)
+      if image_size is None:
+        image_size = self._CalculateMaxImageSizeWithAvbtool(partition_size)
+      elif OPTIONS.check_avb_max_image_size:
+        avbtool_image_size = self._CalculateMaxImageSizeWithAvbtool(
+            partition_size)
+        if image_size != avbtool_image_size:
+          raise BuildVerityImageError(
+              "Mismatching max image size for partition size {}: {} vs {} "
+              "by avbtool".format(partition_size, image_size,
+                                  avbtool_image_size))
+      if image_size <= 0:
+        raise BuildVerityImageError(
+            "Invalid max image size: {}".format(image_size))
+      _max_image_sizes[key] = image_size
+    self.image_size = image_size
+    return image_size
+
+  def _CalculateMaxImageSizeWithAvbtool(self, partition_size):
+    """Runs avbtool to calculate the max image size for a partition size."""
     add_footer = ("add_hash_footer" if self.footer_type == self.AVB_HASH_FOOTER
                   else "add_hashtree_footer")
     cmd = [self.avbtool, add_footer, "--partition_size",
@@ -254,7 +302,6 @@ class VerifiedBootVersion2VerityImageBuilder(VerityImageBuilder):
     if image_size <= 0:
       raise BuildVerityImageError(
           "Invalid max image size: {}".format(output))
-    self.image_size = image_size
     return image_size
 
   def PadSparseImage(self, out_file):
@@ -304,6 +351,132 @@ def CreateCustomImageBuilder(info_dict, partition_name, partition_size,
   return builder
 
 
+def CalculateHashtreeSize(image_size, block_size, digest_size):
+  """Calculates the size of the hashtree for an image, as avbtool does.
+
+  Args:
+    image_size: The size of the image.
+    block_size: The block size of the hashtree.
+    digest_size: The size of each digest, including its padding.
+
+  Returns:
+    The total size of all the levels of the hashtree.
+  """
+  tree_size = 0
+  size = image_size
+  while size > block_size:
+    num_blocks = (size + block_size - 1) // block_size
+    level_size = ((num_blocks * digest_size + block_size - 1) // block_size *
+                  block_size)
+    tree_size += level_size
+    size = level_size
+  return tree_size
+
+
+def CalculateFecSize(image_size, num_roots):
+  """Calculates the size of the FEC data for an image, as fec does.
+
+  Args:
+    image_size: The size of the image.
+    num_roots: The number of Reed-Solomon roots.
+
+  Returns:
+    The size of the FEC data, including its header block.
+  """
+  num_blocks = (image_size + FEC_BLOCK_SIZE - 1) // FEC_BLOCK_SIZE
+  num_rounds = (num_blocks + FEC_RSM - num_roots - 1) // (FEC_RSM - num_roots)
+  return num_rounds * num_roots * FEC_BLOCK_SIZE + FEC_BLOCK_SIZE
+
+
+def ParseAvbSizeArgs(signing_args):
+  """Parses the avbtool arguments that affect the max image size.
+
+  Args:
+    signing_args: The arguments to avbtool add_hash_footer or
+        add_hashtree_footer, as a string.
+
+  Returns:
+    A dict of the parsed arguments, with the avbtool defaults for the missing
+    ones; or None if the arguments can't be parsed.
+  """
+  options = ("--hash_algorithm", "--block_size", "--fec_num_roots")
+  flags = ("--do_not_generate_fec", "--generate_fec", "--no_hashtree")
+  # These arguments override the ones from the caller, or the calculation.
+  unsupported = ("--partition_size", "--dynamic_partition_size",
+                 "--calc_max_image_size")
+
+  args = {
+      "--hash_algorithm": "sha1",
+      "--block_size": "4096",
+      "--fec_num_roots": "2",
+  }
+  tokens = shlex.split(signing_args or "")
+  i = 0
+  while i < len(tokens):
+    name, has_value, value = tokens[i].partition("=")
+    i += 1
+    if name in options:
+      if not has_value:
+        if i == len(tokens):
+          return None
+        value = tokens[i]
+        i += 1
+      args[name] = value
+    elif name in flags and not has_value:
+      args[name] = True
+    elif name.startswith("--") and any(
+        option.startswith(name) for option in options + flags + unsupported):
+      # An unsupported argument, or an abbreviated one that avbtool accepts.
+      return None
+
+  if args["--hash_algorithm"] not in AVB_HASHTREE_DIGEST_SIZES:
+    return None
+  try:
+    args["--block_size"] = int(args["--block_size"])
+    args["--fec_num_roots"] = int(args["--fec_num_roots"])
+  except ValueError:
+    return None
+  if args["--block_size"] <= 0 or not 0 < args["--fec_num_roots"] < FEC_RSM:
+    return None
+  return args
+
+
+def CalculateAvbMaxImageSize(footer_type, signing_args, partition_size):
+  """Calculates the max image size for a partition size in-process.
+
+  This gives the same result as running avbtool add_hash_footer or
+  add_hashtree_footer with --calc_max_image_size. It reserves the space for
+  the hashtree and the FEC data of the whole partition, as well as the max
+  sizes of the vbmeta struct and the footer.
+
+  Args:
+    footer_type: VerifiedBootVersion2VerityImageBuilder.AVB_HASH_FOOTER or
+        AVB_HASHTREE_FOOTER.
+    signing_args: The arguments to avbtool, as a string.
+    partition_size: The partition size.
+
+  Returns:
+    The max image size, or None if it can't be calculated in-process.
+  """
+  args = ParseAvbSizeArgs(signing_args)
+  if args is None:
+    return None
+  max_metadata_size = MAX_VBMETA_SIZE + MAX_FOOTER_SIZE
+  if footer_type == VerifiedBootVersion2VerityImageBuilder.AVB_HASH_FOOTER:
+    return partition_size - max_metadata_size
+
+  if not args.get("--no_hashtree"):
+    # avbtool pads each digest to a power of two.
+    digest_size = AVB_HASHTREE_DIGEST_SIZES[args["--hash_algorithm"]]
+    padded_digest_size = 1 << (digest_size - 1).bit_length()
+    max_metadata_size += CalculateHashtreeSize(
+        partition_size, args["--block_size"], padded_digest_size)
+    if not args.get("--do_not_generate_fec"):
+      max_metadata_size += CalculateFecSize(
+          partition_size, args["--fec_num_roots"])
+  return partition_size - max_metadata_size
+
+
 def GetDiskUsage(path):
   """Returns the number of bytes that "path" occupies on host.
 
@@ -313,9 +486,7 @@ def GetDiskUsage(path):
   Returns:
     The number of bytes based on a 1K block_size.
   """
-  cmd = ["du", "-b", "-k", "-s", path]
-  output = common.RunAndCheckOutput(cmd, verbose=False)
-  return int(output.split()[0]) * 1024
+  return common.GetTreeUsage(path).disk_usage
 
 
 def CalculateVbmetaDigest(extracted_dir, avbtool):
@@ -27,10 +27,10 @@ import argparse
 import csv
 import datetime
 import google.protobuf.text_format as text_format
-import hashlib
 import os
 import metadata_file_pb2
 import sbom_data
+from sbom_checksums import ChecksumCache, checksum, compute_checksums
 import sbom_writers
 
 
@@ -134,6 +134,11 @@ def get_args():
   parser.add_argument('--json', action='store_true', default=False, help='Generated SBOM file in SPDX JSON format')
   parser.add_argument('--unbundled_apk', action='store_true', default=False, help='Generate SBOM for unbundled APKs')
   parser.add_argument('--unbundled_apex', action='store_true', default=False, help='Generate SBOM for unbundled APEXs')
+  parser.add_argument('--checksum_cache',
+                      help='The file to cache the checksums of installed files in across runs. Files whose path, size, '
+                           'mtime and inode are unchanged are not hashed again.')
+  parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                      help='The number of threads to hash installed files with.')
 
   return parser.parse_args()
 
@@ -152,16 +157,6 @@ def new_file_id(file_path):
   return f'SPDXRef-{sbom_data.encode_for_spdxid(file_path)}'
 
 
-def checksum(file_path):
-  h = hashlib.sha1()
-  if os.path.islink(file_path):
-    h.update(os.readlink(file_path).encode('utf-8'))
-  else:
-    with open(file_path, 'rb') as f:
-      h.update(f.read())
-  return f'SHA1: {h.hexdigest()}'
-
-
 def is_soong_prebuilt_module(file_metadata):
   return (file_metadata['soong_module_type'] and
           file_metadata['soong_module_type'] in SOONG_PREBUILT_MODULE_TYPES)
@@ -525,7 +520,16 @@ def main():
   # Scan the metadata in CSV file and create the corresponding package and file records in SPDX
   with open(args.metadata, newline='') as sbom_metadata_file:
     reader = csv.DictReader(sbom_metadata_file)
-    for installed_file_metadata in reader:
+    installed_files_metadata = list(reader)
+    checksum_cache = ChecksumCache(args.checksum_cache)
+    if checksum_cache.load_error:
+      log(checksum_cache.load_error)
+    checksums = compute_checksums(
+        [m['build_output_path'] for m in installed_files_metadata
+         if os.path.islink(m['build_output_path']) or os.path.isfile(m['build_output_path'])],
+        checksum_cache, args.jobs, log)
+    checksum_cache.save()
+    for installed_file_metadata in installed_files_metadata:
       installed_file = installed_file_metadata['installed_file']
       module_path = installed_file_metadata['module_path']
       product_copy_files = installed_file_metadata['product_copy_files']
@@ -547,7 +551,7 @@ def main():
       # located correctly because Soong doesn't report the information to Make.
       sha1 = 'SHA1: da39a3ee5e6b4b0d3255bfef95601890afd80709'  # SHA1 of empty string
       if os.path.islink(build_output_path) or os.path.isfile(build_output_path):
-        sha1 = checksum(build_output_path)
+        sha1 = checksums[build_output_path]
       doc.files.append(sbom_data.File(id=file_id,
                                       name=installed_file,
                                       checksum=sha1))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2023 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compute the checksums of the files in an SBOM, with a cache across runs.
+"""
+
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Files are hashed in chunks of this size, to bound the memory used for large prebuilts.
+CHECKSUM_CHUNK_SIZE = 1024 * 1024
+
+
+def checksum(file_path):
+  h = hashlib.sha1()
+  if os.path.islink(file_path):
+    h.update(os.readlink(file_path).encode('utf-8'))
+  else:
+    with open(file_path, 'rb') as f:
+      for chunk in iter(lambda: f.read(CHECKSUM_CHUNK_SIZE), b''):
+        h.update(chunk)
+  return f'SHA1: {h.hexdigest()}'
+
+
+class ChecksumCache:
+  """Checksums of files persisted in a JSON file, keyed by (path, size, mtime_ns, inode).
+
+  The file holds a JSON object {path: [size, mtime_ns, inode, checksum]}. An unreadable or malformed
+  file is treated as an empty cache, and load_error is set to the reason.
+  """
+
+  def __init__(self, cache_file):
+    self.cache_file = cache_file
+    self.entries = {}
+    self.used_entries = {}
+    self.load_error = None
+    if cache_file and os.path.exists(cache_file):
+      try:
+        with open(cache_file, 'r', encoding='utf-8') as f:
+          entries = json.load(f)
+        if not isinstance(entries, dict):
+          raise ValueError('not a JSON object')
+        self.entries = entries
+      except (OSError, ValueError) as e:
+        self.load_error = f'Ignoring invalid checksum cache {cache_file}: {e}'
+
+  @staticmethod
+  def file_key(file_path):
+    st = os.lstat(file_path)
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+  def get(self, file_path, key):
+    entry = self.entries.get(file_path)
+    if (isinstance(entry, list) and len(entry) == 4 and entry[:3] == key and
+        isinstance(entry[3], str)):
+      self.used_entries[file_path] = entry
+      return entry[3]
+    return None
+
+  def put(self, file_path, key, sha1):
+    self.used_entries[file_path] = key + [sha1]
+
+  def save(self):
+    """Writes the entries used in this run, dropping the ones of files that are gone."""
+    if not self.cache_file:
+      return
+    tmp_file = self.cache_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+      json.dump(self.used_entries, f)
+    os.replace(tmp_file, self.cache_file)
+
+
+def compute_checksums(file_paths, cache, jobs=None, log=lambda *info: None):
+  """Returns a dict of the checksums of the files, hashing the ones not in the cache concurrently.
+
+  The files are hashed by jobs threads, which defaults to the CPU count.
+  """
+  checksums = {}
+  keys = {}
+  for file_path in file_paths:
+    if file_path in checksums or file_path in keys:
+      continue
+    key = ChecksumCache.file_key(file_path)
+    sha1 = cache.get(file_path, key)
+    if sha1:
+      checksums[file_path] = sha1
+    else:
+      keys[file_path] = key
+  log(f'Checksums: {len(checksums)} cached, {len(keys)} to compute')
+
+  with ThreadPoolExecutor(max_workers=jobs) as executor:
+    for file_path, sha1 in zip(keys, executor.map(checksum, keys)):
+      checksums[file_path] = sha1
+      cache.put(file_path, keys[file_path], sha1)
+  return checksums
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2023 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+import tempfile
+import unittest
+import sbom_checksums
+
+
+class ChecksumCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(self.temp_dir.cleanup)
+    self.cache_file = os.path.join(self.temp_dir.name, 'sbom-checksum-cache.json')
+    self.file1 = self.write_file('file1', b'file1')
+    self.file2 = self.write_file('file2', b'file2')
+    self.hashed = []
+    orig_checksum = sbom_checksums.checksum
+
+    def checksum(file_path):
+      self.hashed.append(file_path)
+      return orig_checksum(file_path)
+
+    sbom_checksums.checksum = checksum
+    self.addCleanup(setattr, sbom_checksums, 'checksum', orig_checksum)
+
+  def write_file(self, name, data):
+    file_path = os.path.join(self.temp_dir.name, name)
+    with open(file_path, 'wb') as f:
+      f.write(data)
+    return file_path
+
+  def compute_checksums(self, file_paths):
+    self.hashed = []
+    cache = sbom_checksums.ChecksumCache(self.cache_file)
+    checksums = sbom_checksums.compute_checksums(file_paths, cache, jobs=2)
+    cache.save()
+    return checksums
+
+  def test_checksum(self):
+    self.assertEqual('SHA1: ' + hashlib.sha1(b'file1').hexdigest(),
+                     sbom_checksums.checksum(self.file1))
+    link = os.path.join(self.temp_dir.name, 'link')
+    os.symlink('file1', link)
+    self.assertEqual('SHA1: ' + hashlib.sha1(b'file1').hexdigest(),
+                     sbom_checksums.checksum(link))
+
+  def test_compute_checksums_cacheMiss(self):
+    checksums = self.compute_checksums([self.file1, self.file2, self.file1])
+    self.assertEqual([self.file1, self.file2], sorted(self.hashed))
+    self.assertEqual({self.file1: sbom_checksums.checksum(self.file1),
+                      self.file2: sbom_checksums.checksum(self.file2)},
+                     checksums)
+
+  def test_compute_checksums_cacheHit(self):
+    checksums = self.compute_checksums([self.file1, self.file2])
+    self.assertEqual(checksums, self.compute_checksums([self.file1, self.file2]))
+    self.assertEqual([], self.hashed)
+
+  def test_compute_checksums_invalidated(self):
+    self.compute_checksums([self.file1, self.file2])
+    with open(self.cache_file, encoding='utf-8') as f:
+      entries = json.load(f)
+
+    # A file is hashed again if any of its size, mtime or inode changes.
+    for i in range(3):
+      changed_entries = {path: list(entry) for path, entry in entries.items()}
+      changed_entries[self.file1][i] += 1
+      with open(self.cache_file, 'w', encoding='utf-8') as f:
+        json.dump(changed_entries, f)
+      self.compute_checksums([self.file1, self.file2])
+      self.assertEqual([self.file1], self.hashed)
+
+    # A rewritten file gets a new size and mtime.
+    self.write_file('file1', b'new file1')
+    checksums = self.compute_checksums([self.file1, self.file2])
+    self.assertEqual([self.file1], self.hashed)
+    self.assertEqual('SHA1: ' + hashlib.sha1(b'new file1').hexdigest(), checksums[self.file1])
+
+  def test_compute_checksums_corruptCache(self):
+    for content in ('{"truncated', '[]', '{"%s": "SHA1: 0"}' % self.file1,
+                    '{"%s": [1, 2]}' % self.file1):
+      with open(self.cache_file, 'w', encoding='utf-8') as f:
+        f.write(content)
+      checksums = self.compute_checksums([self.file1])
+      self.assertEqual([self.file1], self.hashed)
+      self.assertEqual({self.file1: 'SHA1: ' + hashlib.sha1(b'file1').hexdigest()}, checksums)
+
+    with open(self.cache_file, 'w', encoding='utf-8') as f:
+      f.write('{"truncated')
+    self.assertTrue(sbom_checksums.ChecksumCache(self.cache_file).load_error)
+
+  def test_save_dropsUnseenEntries(self):
+    self.compute_checksums([self.file1, self.file2])
+    os.remove(self.file2)
+    self.compute_checksums([self.file1])
+    with open(self.cache_file, encoding='utf-8') as f:
+      self.assertEqual([self.file1], list(json.load(f)))
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=2)
@@ -23,6 +23,7 @@ Rrefer to SPDX 2.3 spec: https://spdx.github.io/spdx-spec/v2.3/ and go/android-s
 fields in each data class.
 """
 
+from collections import defaultdict
 from dataclasses import dataclass, field
 from typing import List
 import hashlib
@@ -99,6 +100,31 @@ class DocumentExternalReference:
   checksum: str
 
 
+class _ListIndex:
+  """The set of keys of the items in a list, for O(1) duplicate checks.
+
+  The list may still be modified directly, e.g. doc.files.append(file), in which
+  case the index is rebuilt on its next use.
+  """
+
+  def __init__(self, key):
+    self._key = key
+    self._items = None
+    self._size = 0
+    self._keys = set()
+
+  def append_if_absent(self, items, item):
+    """Appends item to items, unless there is already an item with its key."""
+    if items is not self._items or len(items) != self._size:
+      self._items = items
+      self._keys = {self._key(i) for i in items}
+    key = self._key(item)
+    if key not in self._keys:
+      items.append(item)
+      self._keys.add(key)
+    self._size = len(items)
+
+
 @dataclass
 class Document:
   name: str
@@ -111,32 +137,41 @@ class Document:
   packages: List[Package] = field(default_factory=list)
   files: List[File] = field(default_factory=list)
   relationships: List[Relationship] = field(default_factory=list)
+  _external_ref_index: _ListIndex = field(
+      default_factory=lambda: _ListIndex(lambda ref: ref.uri), init=False, repr=False, compare=False)
+  _package_index: _ListIndex = field(
+      default_factory=lambda: _ListIndex(lambda p: p.id), init=False, repr=False, compare=False)
+  _relationship_index: _ListIndex = field(
+      default_factory=lambda: _ListIndex(lambda r: (r.id1, r.relationship, r.id2)),
+      init=False, repr=False, compare=False)
 
   def add_external_ref(self, external_ref):
-    if not any(external_ref.uri == ref.uri for ref in self.external_refs):
-      self.external_refs.append(external_ref)
+    self._external_ref_index.append_if_absent(self.external_refs, external_ref)
 
   def add_package(self, package):
-    if not any(package.id == p.id for p in self.packages):
-      self.packages.append(package)
+    self._package_index.append_if_absent(self.packages, package)
 
   def add_relationship(self, rel):
-    if not any(rel.id1 == r.id1 and rel.id2 == r.id2 and rel.relationship == r.relationship
-               for r in self.relationships):
-      self.relationships.append(rel)
+    self._relationship_index.append_if_absent(self.relationships, rel)
 
   def generate_packages_verification_code(self):
-    for package in self.packages:
+    # Collect the checksums of the files of all packages in a single pass over the files.
+    packages_of_file = defaultdict(list)
+    for i, package in enumerate(self.packages):
+      for file_id in set(package.file_ids):
+        packages_of_file[file_id].append(i)
+
+    checksums = defaultdict(list)
+    for file in self.files:
+      for i in packages_of_file.get(file.id, ()):
+        checksums[i].append(file.checksum.split(': ')[1])
+
+    for i, package in enumerate(self.packages):
       if not package.file_ids:
         continue
 
-      checksums = []
-      for file in self.files:
-        if file.id in package.file_ids:
-          checksums.append(file.checksum.split(': ')[1])
-      checksums.sort()
       h = hashlib.sha1()
-      h.update(''.join(checksums).encode(encoding='utf-8'))
+      h.update(''.join(sorted(checksums[i])).encode(encoding='utf-8'))
       package.verification_code = h.hexdigest()
 
 def encode_for_spdxid(s):
@@ -134,6 +134,54 @@ class SBOMDataTest(unittest.TestCase):
     self.sbom_doc.generate_packages_verification_code()
     self.assertEqual(expected_package_verification_code, self.sbom_doc.packages[0].verification_code)
 
+  def test_add_deduplicates(self):
+    num_packages = len(self.sbom_doc.packages)
+    num_relationships = len(self.sbom_doc.relationships)
+    self.sbom_doc.add_external_ref(
+        sbom_data.DocumentExternalReference(id='DocumentRef-other_id',
+                                            uri='external_doc_uri',
+                                            checksum='SHA1: 1234567890'))
+    self.sbom_doc.add_package(sbom_data.Package(id=SPDXID_PREBUILT_PACKAGE1, name='Duplicate'))
+    self.sbom_doc.add_relationship(sbom_data.Relationship(id1=SPDXID_FILE1,
+                                                          relationship=sbom_data.RelationshipType.STATIC_LINK,
+                                                          id2=SPDXID_FILE4))
+    self.assertEqual(1, len(self.sbom_doc.external_refs))
+    self.assertEqual(num_packages, len(self.sbom_doc.packages))
+    self.assertEqual(num_relationships, len(self.sbom_doc.relationships))
+
+    # Lists modified directly are taken into account.
+    self.sbom_doc.packages.append(sbom_data.Package(id='SPDXRef-direct', name='Direct'))
+    self.sbom_doc.add_package(sbom_data.Package(id='SPDXRef-direct', name='Duplicate'))
+    self.assertEqual(num_packages + 1, len(self.sbom_doc.packages))
+    self.sbom_doc.relationships = []
+    self.sbom_doc.add_relationship(sbom_data.Relationship(id1=SPDXID_FILE1,
+                                                          relationship=sbom_data.RelationshipType.STATIC_LINK,
+                                                          id2=SPDXID_FILE4))
+    self.assertEqual(1, len(self.sbom_doc.relationships))
+
+  def test_package_verification_code_large_document(self):
+    # 200k files in 2k packages, which used to take minutes.
+    doc = sbom_data.Document(name='large doc', namespace='http://www.google.com/sbom/spdx/android')
+    num_files = 200000
+    num_packages = 2000
+    for i in range(num_packages):
+      doc.add_package(sbom_data.Package(id=f'SPDXRef-package{i}', name=f'package{i}'))
+    for i in range(num_files):
+      file_id = f'SPDXRef-file{i}'
+      doc.files.append(sbom_data.File(id=file_id, name=f'/bin/file{i}',
+                                      checksum='SHA1: ' + hashlib.sha1(str(i).encode()).hexdigest()))
+      doc.packages[i % num_packages].file_ids.append(file_id)
+      doc.add_relationship(sbom_data.Relationship(id1=file_id,
+                                                  relationship=sbom_data.RelationshipType.GENERATED_FROM,
+                                                  id2=f'SPDXRef-package{i % num_packages}'))
+    self.assertEqual(num_files, len(doc.relationships))
+
+    doc.generate_packages_verification_code()
+    checksums = sorted(hashlib.sha1(str(i).encode()).hexdigest()
+                       for i in range(7, num_files, num_packages))
+    self.assertEqual(hashlib.sha1(''.join(checksums).encode()).hexdigest(),
+                     doc.packages[7].verification_code)
+
 
 if __name__ == '__main__':
   unittest.main(verbosity=2)
@@ -16,8 +16,12 @@
 
 """
 Serialize objects defined in package sbom_data to SPDX format: tagvalue, JSON.
+
+The writers stream the output one package, file or relationship at a time, so
+the memory used doesn't grow with the size of the document.
 """
 
+import itertools
 import json
 import sbom_data
 
@@ -113,16 +117,22 @@ class TagValueWriter:
           f'{Tags.RELATIONSHIP}: {sbom_doc.id} {sbom_data.RelationshipType.DESCRIBES} {sbom_doc.describes}')
       tagvalues.append('')
 
-    for file in sbom_doc.files:
-      if file.id in package.file_ids:
-        tagvalues += TagValueWriter.marshal_file(file)
+    yield from tagvalues
 
-    return tagvalues
+    if package.file_ids:
+      file_ids = set(package.file_ids)
+      for file in sbom_doc.files:
+        if file.id in file_ids:
+          yield from TagValueWriter.marshal_file(file)
 
   @staticmethod
-  def marshal_packages(sbom_doc, fragment):
-    tagvalues = []
-    marshaled_relationships = []
+  def marshal_packages(sbom_doc, fragment, marshaled_rels):
+    """Yields the tag-values of the packages, adding the relationships output with them to marshaled_rels."""
+    variant_of_rels = {}
+    for r in sbom_doc.relationships:
+      if r.relationship == sbom_data.RelationshipType.VARIANT_OF:
+        variant_of_rels.setdefault((r.id1, r.id2), r)
+
     i = 0
     packages = sbom_doc.packages
     while i < len(packages):
@@ -131,24 +141,19 @@ class TagValueWriter:
           and packages[i + 1].id.startswith('SPDXRef-UPSTREAM-')):
         # Output SOURCE, UPSTREAM packages and their VARIANT_OF relationship together, so they are close to each other
         # in SBOMs in tagvalue format.
-        tagvalues += TagValueWriter.marshal_package(sbom_doc, packages[i], fragment)
-        tagvalues += TagValueWriter.marshal_package(sbom_doc, packages[i + 1], fragment)
-        rel = next((r for r in sbom_doc.relationships if
-                    r.id1 == packages[i].id and
-                    r.id2 == packages[i + 1].id and
-                    r.relationship == sbom_data.RelationshipType.VARIANT_OF), None)
+        yield from TagValueWriter.marshal_package(sbom_doc, packages[i], fragment)
+        yield from TagValueWriter.marshal_package(sbom_doc, packages[i + 1], fragment)
+        rel = variant_of_rels.get((packages[i].id, packages[i + 1].id))
         if rel:
-          marshaled_relationships.append(rel)
-          tagvalues.append(TagValueWriter.marshal_relationship(rel))
-          tagvalues.append('')
+          marshaled_rels.add((rel.id1, rel.relationship, rel.id2))
+          yield TagValueWriter.marshal_relationship(rel)
+          yield ''
 
         i += 2
       else:
-        tagvalues += TagValueWriter.marshal_package(sbom_doc, packages[i], fragment)
+        yield from TagValueWriter.marshal_package(sbom_doc, packages[i], fragment)
         i += 1
 
-    return tagvalues, marshaled_relationships
-
   @staticmethod
   def marshal_file(file):
     tagvalues = [
@@ -162,20 +167,17 @@ class TagValueWriter:
 
   @staticmethod
   def marshal_files(sbom_doc, fragment):
-    tagvalues = []
-    files_in_packages = []
+    files_in_packages = set()
     for package in sbom_doc.packages:
-      files_in_packages += package.file_ids
+      files_in_packages.update(package.file_ids)
     for file in sbom_doc.files:
       if file.id in files_in_packages:
         continue
-      tagvalues += TagValueWriter.marshal_file(file)
+      yield from TagValueWriter.marshal_file(file)
       if file.id == sbom_doc.describes and not fragment:
         # Fragment is not a full SBOM document so the relationship DESCRIBES is not applicable.
-        tagvalues.append(
-            f'{Tags.RELATIONSHIP}: {sbom_doc.id} {sbom_data.RelationshipType.DESCRIBES} {sbom_doc.describes}')
-        tagvalues.append('')
-    return tagvalues
+        yield f'{Tags.RELATIONSHIP}: {sbom_doc.id} {sbom_data.RelationshipType.DESCRIBES} {sbom_doc.describes}'
+        yield ''
 
   @staticmethod
   def marshal_relationship(rel):
@@ -183,26 +185,26 @@ class TagValueWriter:
 
   @staticmethod
   def marshal_relationships(sbom_doc, marshaled_rels):
-    tagvalues = []
     sorted_rels = sorted(sbom_doc.relationships, key=lambda r: r.id2 + r.id1)
     for rel in sorted_rels:
-      if any(r.id1 == rel.id1 and r.id2 == rel.id2 and r.relationship == rel.relationship
-             for r in marshaled_rels):
+      if (rel.id1, rel.relationship, rel.id2) in marshaled_rels:
         continue
-      tagvalues.append(TagValueWriter.marshal_relationship(rel))
-    tagvalues.append('')
-    return tagvalues
+      yield TagValueWriter.marshal_relationship(rel)
+    yield ''
 
   @staticmethod
   def write(sbom_doc, file, fragment=False):
-    content = []
-    if not fragment:
-      content += TagValueWriter.marshal_doc_headers(sbom_doc)
-    content += TagValueWriter.marshal_files(sbom_doc, fragment)
-    tagvalues, marshaled_relationships = TagValueWriter.marshal_packages(sbom_doc, fragment)
-    content += tagvalues
-    content += TagValueWriter.marshal_relationships(sbom_doc, marshaled_relationships)
-    file.write('\n'.join(content))
+    marshaled_rels = set()
+    content = itertools.chain(
+        [] if fragment else TagValueWriter.marshal_doc_headers(sbom_doc),
+        TagValueWriter.marshal_files(sbom_doc, fragment),
+        TagValueWriter.marshal_packages(sbom_doc, fragment, marshaled_rels),
+        # Evaluated lazily, after marshal_packages() fills in marshaled_rels.
+        TagValueWriter.marshal_relationships(sbom_doc, marshaled_rels))
+    for i, line in enumerate(content):
+      if i:
+        file.write('\n')
+      file.write(line)
 
 
 class PropNames:
@@ -281,76 +283,93 @@ class JSONWriter:
     return headers
 
   @staticmethod
-  def marshal_packages(sbom_doc):
-    packages = []
-    for p in sbom_doc.packages:
-      package = {
-        PropNames.NAME: p.name,
-        PropNames.SPDXID: p.id,
-        PropNames.PACKAGE_DOWNLOAD_LOCATION: p.download_location if p.download_location else sbom_data.VALUE_NOASSERTION,
-        PropNames.FILES_ANALYZED: p.files_analyzed
+  def marshal_package(p):
+    package = {
+      PropNames.NAME: p.name,
+      PropNames.SPDXID: p.id,
+      PropNames.PACKAGE_DOWNLOAD_LOCATION: p.download_location if p.download_location else sbom_data.VALUE_NOASSERTION,
+      PropNames.FILES_ANALYZED: p.files_analyzed
+    }
+    if p.version:
+      package[PropNames.PACKAGE_VERSION] = p.version
+    if p.supplier:
+      package[PropNames.PACKAGE_SUPPLIER] = p.supplier
+    if p.verification_code:
+      package[PropNames.PACKAGE_VERIFICATION_CODE] = {
+        PropNames.PACKAGE_VERIFICATION_CODE_VALUE: p.verification_code
       }
-      if p.version:
-        package[PropNames.PACKAGE_VERSION] = p.version
-      if p.supplier:
-        package[PropNames.PACKAGE_SUPPLIER] = p.supplier
-      if p.verification_code:
-        package[PropNames.PACKAGE_VERIFICATION_CODE] = {
-          PropNames.PACKAGE_VERIFICATION_CODE_VALUE: p.verification_code
+    if p.external_refs:
+      package[PropNames.PACKAGE_EXTERNAL_REFS] = []
+      for ref in p.external_refs:
+        ext_ref = {
+          PropNames.PACKAGE_EXTERNAL_REF_CATEGORY: ref.category,
+          PropNames.PACKAGE_EXTERNAL_REF_TYPE: ref.type,
+          PropNames.PACKAGE_EXTERNAL_REF_LOCATOR: ref.locator,
         }
-      if p.external_refs:
-        package[PropNames.PACKAGE_EXTERNAL_REFS] = []
-        for ref in p.external_refs:
-          ext_ref = {
-            PropNames.PACKAGE_EXTERNAL_REF_CATEGORY: ref.category,
-            PropNames.PACKAGE_EXTERNAL_REF_TYPE: ref.type,
-            PropNames.PACKAGE_EXTERNAL_REF_LOCATOR: ref.locator,
-          }
-          package[PropNames.PACKAGE_EXTERNAL_REFS].append(ext_ref)
-      if p.file_ids:
-        package[PropNames.PACKAGE_HAS_FILES] = []
-        for file_id in p.file_ids:
-          package[PropNames.PACKAGE_HAS_FILES].append(file_id)
-
-      packages.append(package)
-
-    return {PropNames.PACKAGES: packages}
+        package[PropNames.PACKAGE_EXTERNAL_REFS].append(ext_ref)
+    if p.file_ids:
+      package[PropNames.PACKAGE_HAS_FILES] = []
+      for file_id in p.file_ids:
+        package[PropNames.PACKAGE_HAS_FILES].append(file_id)
 
-  @staticmethod
-  def marshal_files(sbom_doc):
-    files = []
-    for f in sbom_doc.files:
-      file = {
-        PropNames.FILE_NAME: f.name,
-        PropNames.SPDXID: f.id
-      }
-      checksum = f.checksum.split(': ')
-      file[PropNames.FILE_CHECKSUMS] = [{
-        PropNames.ALGORITHM: checksum[0],
-        PropNames.CHECKSUM_VALUE: checksum[1],
-      }]
-      files.append(file)
-    return {PropNames.FILES: files}
+    return package
 
   @staticmethod
-  def marshal_relationships(sbom_doc):
-    relationships = []
-    sorted_rels = sorted(sbom_doc.relationships, key=lambda r: r.relationship + r.id2 + r.id1)
-    for r in sorted_rels:
-      rel = {
-        PropNames.REL_ELEMENT_ID: r.id1,
-        PropNames.REL_RELATED_ELEMENT_ID: r.id2,
-        PropNames.REL_TYPE: r.relationship,
-      }
-      relationships.append(rel)
+  def marshal_file(f):
+    file = {
+      PropNames.FILE_NAME: f.name,
+      PropNames.SPDXID: f.id
+    }
+    checksum = f.checksum.split(': ')
+    file[PropNames.FILE_CHECKSUMS] = [{
+      PropNames.ALGORITHM: checksum[0],
+      PropNames.CHECKSUM_VALUE: checksum[1],
+    }]
+    return file
 
-    return {PropNames.RELATIONSHIPS: relationships}
+  @staticmethod
+  def marshal_relationship(r):
+    return {
+      PropNames.REL_ELEMENT_ID: r.id1,
+      PropNames.REL_RELATED_ELEMENT_ID: r.id2,
+      PropNames.REL_TYPE: r.relationship,
+    }
 
   @staticmethod
   def write(sbom_doc, file):
-    doc = {}
-    doc.update(JSONWriter.marshal_doc_headers(sbom_doc))
-    doc.update(JSONWriter.marshal_packages(sbom_doc))
-    doc.update(JSONWriter.marshal_files(sbom_doc))
-    doc.update(JSONWriter.marshal_relationships(sbom_doc))
-    file.write(json.dumps(doc, indent=4))
+    # Same output as json.dumps(doc, indent=4), but the packages, files and relationships are marshaled and written
+    # one at a time, in batches of chunks.
+    sorted_rels = sorted(sbom_doc.relationships, key=lambda r: r.relationship + r.id2 + r.id1)
+    fields = [(name, value, False) for name, value in JSONWriter.marshal_doc_headers(sbom_doc).items()]
+    fields += [
+      (PropNames.PACKAGES, map(JSONWriter.marshal_package, sbom_doc.packages), True),
+      (PropNames.FILES, map(JSONWriter.marshal_file, sbom_doc.files), True),
+      (PropNames.RELATIONSHIPS, map(JSONWriter.marshal_relationship, sorted_rels), True),
+    ]
+
+    chunks = []
+    def write_chunk(chunk):
+      nonlocal chunks
+      chunks.append(chunk)
+      if len(chunks) >= 4096:
+        file.write(''.join(chunks))
+        chunks = []
+
+    write_chunk('{')
+    for i, (name, value, is_array) in enumerate(fields):
+      write_chunk(('\n    ' if i == 0 else ',\n    ') + json.dumps(name) + ': ')
+      if not is_array:
+        write_chunk(_indent_json(json.dumps(value, indent=4), 1))
+        continue
+      empty = True
+      for item in value:
+        write_chunk(('[\n        ' if empty else ',\n        ') + _indent_json(json.dumps(item, indent=4), 2))
+        empty = False
+      write_chunk('[]' if empty else '\n    ]')
+    write_chunk('\n}' if fields else '}')
+    file.write(''.join(chunks))
+
+
+def _indent_json(text, level):
+  """Indents the lines of JSON text after the first by level * 4 spaces, to nest it in the document."""
+  return text.replace('\n', '\n' + '    ' * level)
@@ -15,6 +15,7 @@
 # limitations under the License.
 
 import io
+import json
 import pathlib
 import unittest
 import sbom_data
@@ -168,6 +169,17 @@ class SBOMWritersTest(unittest.TestCase):
       self.maxDiff = None
       self.assertEqual(expected_output, output.getvalue())
 
+  def test_json_writer_empty_lists(self):
+    self.sbom_doc.files = []
+    self.sbom_doc.relationships = []
+    with io.StringIO() as output:
+      sbom_writers.JSONWriter.write(self.sbom_doc, output)
+      doc = json.loads(output.getvalue())
+      self.assertEqual(json.dumps(doc, indent=4), output.getvalue())
+      self.assertEqual([], doc['files'])
+      self.assertEqual([], doc['relationships'])
+      self.assertEqual(len(self.sbom_doc.packages), len(doc['packages']))
+
 
 if __name__ == '__main__':
   unittest.main(verbosity=2)
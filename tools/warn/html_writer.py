@@ -19,7 +19,7 @@
 # pylint:disable=too-many-arguments,missing-function-docstring
 
 # To emit html page of warning messages:
-#   flags: --byproject, --url, --separator
+#   flags: --byproject, --url, --separator, --sidecar_path
 # Old stuff for static html components:
 #   html_script_style:  static html scripts and styles
 #   htmlbig:
@@ -45,6 +45,9 @@
 #   WarnPatternsDescription:  warn_patterns[*]['description']
 #   WarningMessages:          warning_messages
 #   Warnings:                 warning_records
+#   LazyLoading:           true if WarningMessages, Warnings and WarningLinks
+#                          are loaded from SidecarURL when they are shown
+#   SidecarURL:            file name of flags.sidecar_path
 #   StatsHeader:           warning count table header row
 #   StatsRows:             array of warning count table rows
 #
@@ -53,11 +56,18 @@
 # New dynamic HTML related function to emit data:
 #   escape_string, strip_escape_string, emit_warning_arrays
 #   emit_js_data():
+#   MessageTable:          warning_messages kept as in the sidecar file
+#   write_sidecar():       sidecar file with the warnings for LazyLoading
 
 from __future__ import print_function
+import array
 import csv
 import datetime
+import gzip
 import html
+import json
+import os
+import re
 import sys
 
 # pylint:disable=relative-beyond-top-level
@@ -71,6 +81,14 @@ LIMIT_PERCENT_WARNINGS = 1
 
 HTML_HEAD_SCRIPTS = """\
   <script type="text/javascript">
+  function generateContent(e) {
+    // The content of some elements is generated when it is first shown.
+    if (e.generate) {
+      var generate = e.generate;
+      e.generate = null;
+      generate();
+    }
+  };
   function expand(id) {
     var e = document.getElementById(id);
     var f = document.getElementById(id + "_mark");
@@ -79,6 +97,7 @@ HTML_HEAD_SCRIPTS = """\
        f.innerHTML = '&#x2295';
     }
     else {
+       generateContent(e);
        e.style.display = 'block';
        f.innerHTML = '&#x2296';
     }
@@ -88,6 +107,7 @@ HTML_HEAD_SCRIPTS = """\
       var e = document.getElementById(id + "");
       var f = document.getElementById(id + "_mark");
       if (!e || !f) break;
+      if (show) generateContent(e);
       e.style.display = (show ? 'block' : 'none');
       f.innerHTML = (show ? '&#x2296' : '&#x2295');
     }
@@ -394,12 +414,16 @@ def escape_string(line):
   return line.replace('\\', '\\\\').replace('"', '\\"')
 
 
+# Return line without trailing '\n'.
+def strip_newline(line):
+  return line[:-1] if line.endswith('\n') else line
+
+
 # Return line without trailing '\n' and escape the quotation characters.
 def strip_escape_string(line):
   if not line:
     return line
-  line = line[:-1] if line[-1] == '\n' else line
-  return escape_string(line)
+  return escape_string(strip_newline(line))
 
 
 def emit_warning_array(name, writer, warn_patterns):
@@ -485,7 +509,28 @@ SCRIPTS_FOR_WARNING_GROUPS = """
     }
     return groups;
   }
+  function createMessageTable(messages) {
+    var result = "<table class='t1'>";
+    var c = 0;
+    messages.sort(compareMessages);
+    if (FlagPlatform == "chrome") {
+      for (var i=0; i<messages.length; i++) {
+        result += "<tr><td class='c" + c + "'>" +
+                  addURLToLine(WarningMessages[messages[i][2]], WarningLinks[messages[i][3]]) + "</td></tr>";
+        c = 1 - c;
+      }
+    } else {
+      for (var i=0; i<messages.length; i++) {
+        result += "<tr><td class='c" + c + "'>" +
+                  addURL(WarningMessages[messages[i][2]]) + "</td></tr>";
+        c = 1 - c;
+      }
+    }
+    return result + "</table>";
+  }
   var GlobalAnchor = 0;
+  // [anchor, messages] of the warning groups to generate when expanded.
+  var LazyWarningGroups = [];
   function createWarningSection(header, color, group) {
     var result = "";
     var groupKeys = [];
@@ -509,24 +554,13 @@ SCRIPTS_FOR_WARNING_GROUPS = """
                 "' onclick='expand(\\"" + GlobalAnchor + "\\");'>" +
                 "&#x2295</button> " +
                 description + " (" + messages.length + ")</td></tr></table>";
-      result += "<div id='" + GlobalAnchor +
-                "' style='display:none;'><table class='t1'>";
-      var c = 0;
-      messages.sort(compareMessages);
-      if (FlagPlatform == "chrome") {
-        for (var i=0; i<messages.length; i++) {
-          result += "<tr><td class='c" + c + "'>" +
-                    addURLToLine(WarningMessages[messages[i][2]], WarningLinks[messages[i][3]]) + "</td></tr>";
-          c = 1 - c;
-        }
+      result += "<div id='" + GlobalAnchor + "' style='display:none;'>";
+      if (LazyLoading) {
+        LazyWarningGroups.push([GlobalAnchor, messages]);
       } else {
-        for (var i=0; i<messages.length; i++) {
-          result += "<tr><td class='c" + c + "'>" +
-                    addURL(WarningMessages[messages[i][2]]) + "</td></tr>";
-          c = 1 - c;
-        }
+        result += createMessageTable(messages);
       }
-      result += "</table></div>";
+      result += "</div>";
     }
     if (result.length > 0) {
       return "<br><span style='background-color:" + color + "'><b>" +
@@ -555,9 +589,20 @@ SCRIPTS_FOR_WARNING_GROUPS = """
     return result;
   }
   function groupWarnings(generator) {
-    GlobalAnchor = 0;
-    var e = document.getElementById("warning_groups");
-    e.innerHTML = generator();
+    loadWarnings().then(() => {
+      GlobalAnchor = 0;
+      LazyWarningGroups = [];
+      var e = document.getElementById("warning_groups");
+      e.innerHTML = generator();
+      for (const [anchor, messages] of LazyWarningGroups) {
+        var group = document.getElementById(anchor);
+        group.generate = () => {
+          document.getElementById(anchor).innerHTML =
+              createMessageTable(messages);
+        };
+      }
+      LazyWarningGroups = [];
+    });
   }
   function groupBySeverity() {
     groupWarnings(generateSectionsBySeverity);
@@ -632,12 +677,211 @@ def emit_js_data(writer, flags, warning_messages, warning_links,
   emit_const_html_string_array('WarnPatternsDescription',
                                [w['description'] for w in warn_patterns],
                                writer)
+  if get_sidecar_path(flags):
+    # The warnings are loaded from the sidecar file when they are shown.
+    emit_const_string('SidecarURL',
+                      os.path.basename(get_sidecar_path(flags)), writer)
+    writer('const LazyLoading = true;')
+    writer(SCRIPTS_FOR_SIDECAR)
+    return
+  writer('const LazyLoading = false;')
+  writer('function loadWarnings() { return Promise.resolve(); }')
   emit_const_html_string_array('WarningMessages', warning_messages, writer)
   emit_const_object_array('Warnings', warning_records, writer)
   if flags.platform == 'chrome':
     emit_const_html_string_array('WarningLinks', warning_links, writer)
 
 
+# The JavaScript data of a page with a sidecar file, loaded when needed.
+SCRIPTS_FOR_SIDECAR = """
+  var WarningMessages = [];
+  var Warnings = [];
+  var WarningLinks = [];
+  var WarningsLoaded = null;
+  function escapeHTML(text) {  // like Python html.escape
+    return text.replace(/&/g, "&amp;").replace(/</g, "&lt;")
+        .replace(/>/g, "&gt;").replace(/"/g, "&quot;")
+        .replace(/'/g, "&#x27;");
+  }
+  function readSidecar(response) {
+    if (!response.ok) {
+      throw new Error(response.status + " " + response.statusText);
+    }
+    return response.arrayBuffer().then((buffer) => {
+      var magic = new Uint8Array(buffer, 0, Math.min(2, buffer.byteLength));
+      if (magic.length == 2 && magic[0] == 0x1f && magic[1] == 0x8b) {
+        var stream = new Blob([buffer]).stream().pipeThrough(
+            new DecompressionStream("gzip"));
+        return new Response(stream).text();
+      }
+      return new TextDecoder().decode(buffer);
+    });
+  }
+  function loadWarnings() {
+    if (!WarningsLoaded) {
+      WarningsLoaded = fetch(SidecarURL).then(readSidecar).then((text) => {
+        var data = JSON.parse(text);
+        for (var i = 0; i < data.MessagePath.length; i++) {
+          WarningMessages.push(escapeHTML(
+              data.Paths[data.MessagePath[i]] +
+              data.Positions[data.MessagePosition[i]] +
+              data.Texts[data.MessageText[i]]));
+        }
+        for (var i = 0; i < data.LinkIndex.length; i++) {
+          WarningLinks.push(escapeHTML(data.Links[data.LinkIndex[i]]));
+        }
+        for (var i = 0; i < data.WarningPattern.length; i++) {
+          Warnings.push([data.WarningPattern[i], data.WarningProject[i],
+                         data.WarningMessage[i], data.WarningLink[i]]);
+        }
+      }).catch((error) => {
+        alert("Cannot load warnings from " + SidecarURL + ": " + error);
+      });
+    }
+    return WarningsLoaded;
+  }
+  var TopDirsFilesTables = null;
+  function generateTopDirsFilesTables() {
+    if (!TopDirsFilesTables) {
+      TopDirsFilesTables = loadWarnings().then(() => {
+        google.charts.setOnLoadCallback(() => {
+          if (WarningMessages.length > 1) {
+            genTopDirsFilesTables();
+          }
+        });
+      });
+    }
+  }
+"""
+
+
+# Split a warning message into its file path, line and column numbers, and
+# the rest of the message.
+WARNING_MESSAGE_PARTS = re.compile(r'([^:]*)((?::\d+)*)(.*)', re.DOTALL)
+
+# Number of integers of an array written to a sidecar file at a time.
+SIDECAR_CHUNK_SIZE = 65536
+
+
+def get_sidecar_path(flags):
+  return getattr(flags, 'sidecar_path', '')
+
+
+def add_string(table, string):
+  """Add a string to a dict {string: index}, and return its index."""
+  return table.setdefault(string, len(table))
+
+
+class MessageTable:
+  """A list of warning messages, kept as indexes to tables of unique strings.
+
+  Each message is split into its path, position and text, which are shared by
+  many messages, as in the sidecar file. A message is put together again when
+  it is indexed.
+  """
+
+  def __init__(self):
+    # dicts {string: index}, and the strings in the order of their indexes.
+    self.path_indexes = {}
+    self.position_indexes = {}
+    self.text_indexes = {}
+    self.paths = []
+    self.positions = []
+    self.texts = []
+    self.message_paths = array.array('i')
+    self.message_positions = array.array('i')
+    self.message_texts = array.array('i')
+
+  @staticmethod
+  def add_part(indexes, strings, string):
+    idx = add_string(indexes, string)
+    if idx == len(strings):
+      strings.append(string)
+    return idx
+
+  def append(self, message):
+    path, position, text = WARNING_MESSAGE_PARTS.match(message).groups()
+    self.message_paths.append(
+        self.add_part(self.path_indexes, self.paths, path))
+    self.message_positions.append(
+        self.add_part(self.position_indexes, self.positions, position))
+    self.message_texts.append(
+        self.add_part(self.text_indexes, self.texts, text))
+
+  def __len__(self):
+    return len(self.message_paths)
+
+  def __getitem__(self, idx):
+    return (self.paths[self.message_paths[idx]] +
+            self.positions[self.message_positions[idx]] +
+            self.texts[self.message_texts[idx]])
+
+  def __iter__(self):
+    for idx in range(len(self)):
+      yield self[idx]
+
+
+def write_sidecar_ints(outf, values):
+  outf.write('[')
+  for start in range(0, len(values), SIDECAR_CHUNK_SIZE):
+    if start:
+      outf.write(',')
+    outf.write(','.join(map(str, values[start:start + SIDECAR_CHUNK_SIZE])))
+  outf.write(']')
+
+
+def write_sidecar(sidecar_path, flags, warning_messages, warning_links,
+                  warning_records):
+  """Write the warnings to a JSON file, which is loaded by the HTML page.
+
+  The file has tables of unique strings, and arrays of indexes to them.
+  Each warning message is split into its path, position and text, which are
+  shared by many messages. The file is gzip compressed if sidecar_path ends
+  with '.gz'. warning_messages is a list, or a MessageTable.
+  """
+  if isinstance(warning_messages, MessageTable):
+    messages = warning_messages
+  else:
+    messages = MessageTable()
+    for message in warning_messages:
+      messages.append(strip_newline(message))
+  links = {}
+  link_indexes = array.array('i')
+  if flags.platform == 'chrome':
+    for link in warning_links:
+      link_indexes.append(add_string(links, strip_newline(link)))
+  columns = [array.array('i', (record[i] for record in warning_records))
+             for i in range(4)]
+
+  sidecar = [
+      ('Paths', messages.paths),
+      ('Positions', messages.positions),
+      ('Texts', messages.texts),
+      ('Links', list(links)),
+      ('MessagePath', messages.message_paths),
+      ('MessagePosition', messages.message_positions),
+      ('MessageText', messages.message_texts),
+      ('LinkIndex', link_indexes),
+      ('WarningPattern', columns[0]),
+      ('WarningProject', columns[1]),
+      ('WarningMessage', columns[2]),
+      ('WarningLink', columns[3]),
+  ]
+  if sidecar_path.endswith('.gz'):
+    outf = gzip.open(sidecar_path, 'wt', compresslevel=6, encoding='utf-8')
+  else:
+    outf = open(sidecar_path, 'w', encoding='utf-8')
+  with outf:
+    for idx, (name, values) in enumerate(sidecar):
+      outf.write('{' if idx == 0 else ',\n')
+      outf.write(json.dumps(name) + ':')
+      if isinstance(values, array.array):
+        write_sidecar_ints(outf, values)
+      else:
+        outf.write(json.dumps(values, separators=(',', ':')))
+    outf.write('}\n')
+
+
 DRAW_TABLE_JAVASCRIPT = """
 google.charts.load('current', {'packages':['table']});
 google.charts.setOnLoadCallback(genTables);
@@ -867,12 +1111,23 @@ def dump_html(flags, output_stream, warning_messages, warning_links,
     emit_buttons(writer)
     # Warning messages are grouped by severities or project names.
     writer('<br><div id="warning_groups"></div>')
-    if flags.byproject:
-      writer('<script>groupByProject();</script>')
-    else:
-      writer('<script>groupBySeverity();</script>')
+    group_warnings = 'groupByProject' if flags.byproject else 'groupBySeverity'
+    if not get_sidecar_path(flags):
+      writer('<script>' + group_warnings + '();</script>')
     dump_fixed(writer, warn_patterns)
     writer('</div>')
+    if get_sidecar_path(flags):
+      # Sections with warnings are generated when they are first shown.
+      writer('<script>')
+      for section in ['top_directory_section', 'top_file_section']:
+        writer('document.getElementById("' + section +
+               '").generate = generateTopDirsFilesTables;')
+      writer('document.getElementById("all_warnings_section").generate = ' +
+             group_warnings + ';')
+      writer('</script>')
+  if get_sidecar_path(flags):
+    write_sidecar(get_sidecar_path(flags), flags, warning_messages,
+                  warning_links, warning_records)
   dump_boxed_section(writer, section1)
   dump_boxed_section(writer, section2)
   dump_boxed_section(writer, section3)
@@ -16,15 +16,27 @@
 
 """Simple wrapper to run warn_common with Python standard Pool."""
 
+import functools
 import multiprocessing
 import signal
 import sys
+import threading
 
 # pylint:disable=relative-beyond-top-level,no-name-in-module
 # suppress false positive of no-name-in-module warnings
 from . import warn_common as common
 
 
+# Arguments shared by all classify_warnings calls in a pool worker process,
+# set once by init_worker instead of being sent with every group of warnings.
+_shared_args = {}
+
+
+def init_worker(shared_args):
+  """Save the arguments shared by all groups of warnings in a worker."""
+  _shared_args.update(shared_args)
+
+
 def classify_warnings(args):
   """Classify a list of warning lines.
 
@@ -33,14 +45,21 @@ def classify_warnings(args):
         'group': list of (warning, link),
         'project_patterns': re.compile(project_list[p][1]),
         'warn_patterns': list of warn_pattern,
+        'warn_index': optional common.make_warn_pattern_index(warn_patterns),
+        'project_index': optional
+            common.make_pattern_index(enumerate(project_patterns)),
         'num_processes': number of processes being used for multiprocessing }
+      Keys missing from args are taken from the shared arguments of the
+      worker, see init_worker.
   Returns:
     results: a list of the classified warnings.
   """
+  args = dict(_shared_args, **args)
   results = []
   for line, link in args['group']:
     common.classify_one_warning(line, link, results, args['project_patterns'],
-                                args['warn_patterns'])
+                                args['warn_patterns'], args.get('warn_index'),
+                                args.get('project_index'))
 
   # After the main work, ignore all other signals to a child process,
   # to avoid bad warning/error messages from the exit clean-up process.
@@ -49,15 +68,52 @@ def classify_warnings(args):
   return results
 
 
+def classify_indexed_warnings(classify_warnings_fn, indexed_args):
+  """Classify one group of warnings, and return it with the group index."""
+  idx, args = indexed_args
+  return idx, classify_warnings_fn(args)
+
+
+@common.takes_shared_args
 def create_and_launch_subprocesses(num_cpu, classify_warnings_fn, arg_groups,
-                                   group_results):
-  """Fork num_cpu processes to classify warnings."""
-  pool = multiprocessing.Pool(num_cpu)
-  for cpu in range(num_cpu):
-    proc_result = pool.map(classify_warnings_fn, arg_groups[cpu])
-    if proc_result is not None:
-      group_results.append(proc_result)
-  return group_results
+                                   shared_args):
+  """Classify groups of warnings with a pool of num_cpu processes.
+
+  The pool workers are initialized once with shared_args, and the groups are
+  classified in whichever worker is free, so the results are put back into
+  the order of arg_groups. arg_groups can be an iterator, from which at most
+  common.GROUPS_PER_PROCESS groups per process are taken ahead of their
+  classification.
+
+  Returns:
+    A list of one list, with the result of each group in arg_groups.
+  """
+  pending_groups = threading.Semaphore(num_cpu * common.GROUPS_PER_PROCESS)
+  stop_reading = threading.Event()
+
+  def read_ahead(arg_groups):
+    # The pool takes the groups in its own thread, which waits here until
+    # enough pending groups are classified.
+    for indexed_args in enumerate(arg_groups):
+      pending_groups.acquire()
+      if stop_reading.is_set():
+        return
+      yield indexed_args
+
+  results = {}
+  with multiprocessing.Pool(num_cpu, initializer=init_worker,
+                            initargs=(shared_args,)) as pool:
+    try:
+      for idx, result in pool.imap_unordered(
+          functools.partial(classify_indexed_warnings, classify_warnings_fn),
+          read_ahead(arg_groups)):
+        pending_groups.release()
+        results[idx] = result
+    finally:
+      # Do not leave the pool thread waiting, so that the pool can stop.
+      stop_reading.set()
+      pending_groups.release()
+  return [[results[idx] for idx in range(len(results))]]
 
 
 def main():
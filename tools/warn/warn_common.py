@@ -20,6 +20,7 @@ Use option --byproject to output tables grouped by source file projects.
 Use option --gencsv to output warning counts in CSV format.
 
 Default input file is build.log, which can be changed with the --log flag.
+The input file can be gzip compressed.
 """
 
 # List of important data structures and functions in this script.
@@ -29,7 +30,7 @@ Default input file is build.log, which can be changed with the --log flag.
 #   warn_patterns:
 #   warn_patterns[w]['category']     tool that issued the warning, not used now
 #   warn_patterns[w]['description']  table heading
-#   warn_patterns[w]['members']      matched warnings from input
+#   warn_patterns[w]['members']      idx to warning_messages of its warnings
 #   warn_patterns[w]['patterns']     regular expressions to match warnings
 #   warn_patterns[w]['projects'][p]  number of warnings of pattern w in p
 #   warn_patterns[w]['severity']     severity tuple
@@ -37,21 +38,32 @@ Default input file is build.log, which can be changed with the --log flag.
 #   project_list[p][1]               regular expression to match a project path
 #   project_patterns[p]              re.compile(project_list[p][1])
 #   project_names[p]                 project_list[p][0]
-#   warning_messages     array of each warning message, without source url
+#   warning_messages     array of each warning message, without source url;
+#                        a html_writer.MessageTable with --sidecar_path
 #   warning_links        array of each warning code search link; for 'chrome'
 #   warning_records      array of [idx to warn_patterns,
 #                                  idx to project_names,
 #                                  idx to warning_messages,
 #                                  idx to warning_links]
-#   parse_input_file
+#   stream_input_file
 #
 import argparse
+import collections
+import contextlib
+import gzip
+import hashlib
 import io
+import itertools
 import multiprocessing
 import os
 import re
 import sys
 
+try:
+  from re import _parser as sre_parse  # Python 3.11+
+except ImportError:
+  import sre_parse
+
 # pylint:disable=relative-beyond-top-level,no-name-in-module
 # suppress false positive of no-name-in-module warnings
 from . import android_project_list
@@ -67,6 +79,18 @@ from . import tidy_warn_patterns as tidy_patterns
 # Location of this file is used to guess the root of Android source tree.
 THIS_FILE_PATH = 'build/make/tools/warn/warn_common.py'
 
+# Warnings are classified in parallel in groups of GROUP_SIZE lines, with up to
+# GROUPS_PER_PROCESS groups for each process parsed ahead of classification.
+GROUP_SIZE = 1000
+GROUPS_PER_PROCESS = 4
+
+# The lines read ahead to find the android root are recorded to be parsed
+# again, up to MAX_RECORDED_LINES lines if the log can be read again instead.
+MAX_RECORDED_LINES = 100000
+
+# A word in a line, for looking up the patterns indexed by make_pattern_index.
+WORD_PATTERN = re.compile(r'\w+')
+
 
 def parse_args(use_google3):
   """Define and parse the args. Return the parse_args() result."""
@@ -79,6 +103,11 @@ def parse_args(use_google3):
   # original Android script used csvpath, so other scripts rely on it
   parser.add_argument('--csvpath', default='',
                       help='Save CSV warning file to the passed path')
+  parser.add_argument('--sidecar_path', default='',
+                      help='Save warning messages to the passed path as a JSON'
+                      ' file, gzip compressed if the path ends with .gz, which'
+                      ' the HTML output loads from the same directory when'
+                      ' they are shown')
   parser.add_argument('--gencsv', action='store_true',
                       help='Generate CSV file with number of various warnings')
   parser.add_argument('--csvwithdescription', default='',
@@ -118,8 +147,116 @@ def get_project_names(project_list):
   return [p[0] for p in project_list]
 
 
-def find_project_index(line, project_patterns):
-  """Return the index to the project pattern array."""
+def _ends_with_non_word(pattern_items):
+  """Return True if a parsed pattern always ends at the end of a word.
+
+  That is, with a non-word character or the start of the line.
+  """
+  if not pattern_items:
+    return False
+  op, arg = pattern_items[-1]
+  if op == sre_parse.LITERAL:
+    return not WORD_PATTERN.match(chr(arg))
+  if op == sre_parse.AT:
+    return arg in (sre_parse.AT_BEGINNING, sre_parse.AT_BEGINNING_STRING)
+  if op == sre_parse.SUBPATTERN:
+    return _ends_with_non_word(arg[-1].data)
+  if op == sre_parse.BRANCH:
+    return all(_ends_with_non_word(branch.data) for branch in arg[1])
+  return False
+
+
+def get_required_words(compiled_pattern):
+  """Return words that are whole words of every line matched by a pattern.
+
+  The words are taken from the literal strings in the top level sequence of
+  the pattern. A word at either end of a literal string is only a whole word
+  if the pattern has a non-word character or the start or end of the line
+  next to it.
+  """
+  if compiled_pattern.flags & re.IGNORECASE:
+    return []
+  words = []
+  literal = ''
+  # The start of the line, like a non-word character, ends any word.
+  bounded_before = True
+  items = sre_parse.parse(compiled_pattern.pattern, compiled_pattern.flags)
+  for op, arg in list(items) + [(None, None)]:
+    if op == sre_parse.LITERAL:
+      literal += chr(arg)
+      continue
+    bounded_after = op == sre_parse.AT and arg in (sre_parse.AT_END,
+                                                   sre_parse.AT_END_STRING)
+    words.extend(m.group() for m in WORD_PATTERN.finditer(literal)
+                 if (m.start() > 0 or bounded_before) and
+                 (m.end() < len(literal) or bounded_after))
+    literal = ''
+    bounded_before = op is not None and _ends_with_non_word([(op, arg)])
+  return words
+
+
+def make_pattern_index(patterns):
+  """Index compiled patterns by a word they require.
+
+  Each compiled pattern is indexed by its required word that the fewest
+  other patterns require, or left unindexed if it requires no whole word.
+
+  Args:
+    patterns: list of (index, compiled pattern), in the order to try them.
+  Returns:
+    (dict {word: list of candidates}, list of unindexed candidates), where
+    a candidate is an (order, index, compiled pattern) tuple, and order is
+    the position of the compiled pattern in patterns.
+  """
+  candidates = [(order, idx, cpat)
+                for order, (idx, cpat) in enumerate(patterns)]
+  candidate_words = [get_required_words(c[2]) for c in candidates]
+  word_counts = {}
+  for words in candidate_words:
+    for word in set(words):
+      word_counts[word] = word_counts.get(word, 0) + 1
+
+  index = {}
+  unindexed = []
+  for candidate, words in zip(candidates, candidate_words):
+    if words:
+      word = min(words, key=lambda w: (word_counts[w], -len(w)))
+      index.setdefault(word, []).append(candidate)
+    else:
+      unindexed.append(candidate)
+  return index, unindexed
+
+
+def make_warn_pattern_index(warn_patterns):
+  """Return the pattern index of the compiled patterns of warn_patterns."""
+  return make_pattern_index([(idx, cpat)
+                             for idx, pattern in enumerate(warn_patterns)
+                             for cpat in pattern['compiled_patterns']])
+
+
+def find_candidate_patterns(line, pattern_index):
+  """Return the candidates of a pattern index that may match line.
+
+  Every pattern that matches line is a candidate, and the candidates are in
+  the order of the indexed patterns.
+  """
+  index, unindexed = pattern_index
+  candidate_lists = [index[word] for word in set(WORD_PATTERN.findall(line))
+                     if word in index]
+  return sorted(itertools.chain(unindexed, *candidate_lists))
+
+
+def find_project_index(line, project_patterns, project_index=None):
+  """Return the index to the project pattern array.
+
+  project_index is an optional make_pattern_index(enumerate(project_patterns))
+  to find the same project faster.
+  """
+  if project_index is not None:
+    for _, idx, pattern in find_candidate_patterns(line, project_index):
+      if pattern.match(line):
+        return idx
+    return -1
   for idx, pattern in enumerate(project_patterns):
     if pattern.match(line):
       return idx
@@ -127,14 +264,26 @@ def find_project_index(line, project_patterns):
 
 
 def classify_one_warning(warning, link, results, project_patterns,
-                         warn_patterns):
-  """Classify one warning line."""
-  for idx, pattern in enumerate(warn_patterns):
-    for cpat in pattern['compiled_patterns']:
-      if cpat.match(warning):
-        project_idx = find_project_index(warning, project_patterns)
-        results.append([warning, link, idx, project_idx])
-        return
+                         warn_patterns, warn_index=None, project_index=None):
+  """Classify one warning line.
+
+  warn_index and project_index are optional make_warn_pattern_index
+  (warn_patterns) and make_pattern_index(enumerate(project_patterns)), to
+  find the same first matching patterns with fewer regular expression
+  matches.
+  """
+  if warn_index is None:
+    candidates = ((None, idx, cpat)
+                  for idx, pattern in enumerate(warn_patterns)
+                  for cpat in pattern['compiled_patterns'])
+  else:
+    candidates = find_candidate_patterns(warning, warn_index)
+  for _, idx, cpat in candidates:
+    if cpat.match(warning):
+      project_idx = find_project_index(warning, project_patterns,
+                                       project_index)
+      results.append([warning, link, idx, project_idx])
+      return
   # If we end up here, there was a problem parsing the log
   # probably caused by 'make -j' mixing the output from
   # 2 or more concurrent compiles
@@ -149,7 +298,7 @@ def remove_prefix(src, sub):
 
 
 # TODO(emmavukelj): Don't have any generate_*_cs_link functions call
-# normalize_path a second time (the first time being in parse_input_file)
+# normalize_path a second time (the first time being in stream_input_file)
 def generate_cs_link(warning_line, flags, android_root=None):
   """Try to add code search HTTP URL prefix."""
   if flags.platform == 'chrome':
@@ -320,8 +469,35 @@ def normalize_warning_line(line, flags, android_root=None):
                         android_root) + line[first_column:]
 
 
-def parse_input_file_chrome(infile, flags):
-  """Parse Chrome input file, collect parameters and warning lines."""
+def get_line_digest(line):
+  """Return a fixed-size digest of a line, to remember lines in less memory."""
+  return hashlib.blake2b(line.encode('utf-8'), digest_size=16).digest()
+
+
+def generate_new_warning(line, flags, android_root, seen_warnings):
+  """Normalize a warning line, and yield it with its link if it is new.
+
+  seen_warnings is the set of the digests of the warnings seen so far.
+  """
+  normalized_line = normalize_warning_line(line, flags, android_root)
+  digest = get_line_digest(normalized_line)
+  if digest in seen_warnings:
+    return
+  seen_warnings.add(digest)
+  if android_root:
+    # The link of a warning line with a known android_root is generated from
+    # its normalized line, so it does not depend on which duplicate is first.
+    yield normalized_line, generate_android_cs_link(normalized_line, flags,
+                                                    android_root)
+  else:
+    yield normalized_line, generate_cs_link(line, flags, android_root)
+
+
+def stream_input_file_chrome(infile, flags, build_info):
+  """Parse Chrome input file, and yield unique warning lines with links.
+
+  build_info['header_str'] is set after the last warning line.
+  """
   platform_version = 'unknown'
   board_name = 'unknown'
   architecture = 'unknown'
@@ -333,12 +509,10 @@ def parse_input_file_chrome(infile, flags):
   warning_pattern = re.compile(chrome_warning_pattern)
 
   # Collect all unique warning lines
-  unique_warnings = dict()
+  seen_warnings = set()
   for line in infile:
     if warning_pattern.match(line):
-      normalized_line = normalize_warning_line(line, flags)
-      if normalized_line not in unique_warnings:
-        unique_warnings[normalized_line] = generate_cs_link(line, flags)
+      yield from generate_new_warning(line, flags, None, seen_warnings)
     elif (platform_version == 'unknown' or board_name == 'unknown' or
           architecture == 'unknown'):
       result = re.match(r'.+Package:.+chromeos-base/chromeos-chrome-', line)
@@ -354,28 +528,83 @@ def parse_input_file_chrome(infile, flags):
         architecture = result.group(1)
         continue
 
-  header_str = '%s - %s - %s' % (platform_version, board_name, architecture)
-  return unique_warnings, header_str
+  build_info['header_str'] = '%s - %s - %s' % (platform_version, board_name,
+                                               architecture)
 
 
-def add_normalized_line_to_warnings(line, flags, android_root, unique_warnings):
-  """Parse/normalize path, updating warning line and add to warnings dict."""
-  normalized_line = normalize_warning_line(line, flags, android_root)
-  if normalized_line not in unique_warnings:
-    unique_warnings[normalized_line] = generate_cs_link(line, flags,
-                                                        android_root)
-  return unique_warnings
+def record_android_lines(numbered_lines, recorded_lines,
+                         max_recorded_lines=None):
+  """Yield the lines of numbered_lines, and record those to parse later.
+
+  The recorded (line number, line) pairs are the first 100 lines, and the
+  lines that may be, or continue, a new warning. Each run of other lines is
+  recorded as one empty line, which is parsed like them: it only ends the
+  previous warning line.
+  If max_recorded_lines is set, the recording stops when that many lines are
+  recorded, with a (line number, None) pair to mark the first line that has
+  to be read again from the input.
+  """
+  recorded = True
+  recorded_warning_lines = set()
+  for line_number, line in numbered_lines:
+    if (max_recorded_lines is not None and
+        len(recorded_lines) >= max_recorded_lines):
+      recorded_lines.append((line_number, None))
+      yield line
+      yield from (line for _, line in numbered_lines)
+      return
+    if 'warning: ' in line and line_number > 100 and '--> ' not in line:
+      digest = get_line_digest(line)
+      new_line = digest not in recorded_warning_lines
+      recorded_warning_lines.add(digest)
+    else:
+      new_line = line_number <= 100 or '--> ' in line
+    if new_line:
+      recorded_lines.append((line_number, line))
+      recorded = True
+    elif recorded:
+      recorded_lines.append((line_number, ''))
+      recorded = False
+    yield line
 
 
-def parse_input_file_android(infile, flags):
-  """Parse Android input file, collect parameters and warning lines."""
+def replay_lines(recorded_lines, infile, numbered_lines):
+  """Yield and forget the recorded lines, followed by the rest of the input.
+
+  If the recording was stopped, infile is read again from the first line that
+  wasn't recorded, instead of going on with numbered_lines.
+  """
+  while recorded_lines:
+    line_number, line = recorded_lines.popleft()
+    if line is None:
+      infile.seek(0)
+      yield from itertools.islice(enumerate(infile, 1), line_number - 1, None)
+      return
+    yield line_number, line
+  yield from numbered_lines
+
+
+def stream_input_file_android(infile, flags, build_info):
+  """Parse Android input file, and yield unique warning lines with links.
+
+  The lines read to find the android root are recorded, and parsed again from
+  memory. If infile is seekable, at most MAX_RECORDED_LINES of them are kept,
+  and the rest is read again from infile. Otherwise infile is read once.
+  build_info['header_str'] is set after the last warning line.
+  """
   # pylint:disable=too-many-locals,too-many-branches
   platform_version = 'unknown'
   target_product = 'unknown'
   target_variant = 'unknown'
   build_id = 'unknown'
-  android_root, root_top_dirs = find_android_root(infile)
-  infile.seek(0)
+  numbered_lines = enumerate(infile, 1)
+  recorded_lines = collections.deque()
+  if hasattr(infile, 'seekable') and infile.seekable():
+    max_recorded_lines = MAX_RECORDED_LINES
+  else:
+    max_recorded_lines = None
+  android_root, root_top_dirs = find_android_root(
+      record_android_lines(numbered_lines, recorded_lines, max_recorded_lines))
 
   # rustc warning messages have two lines that should be combined:
   #     warning: description
@@ -413,25 +642,25 @@ def parse_input_file_android(infile, flags):
   else:
     extra_warning_pattern = re.compile('^[^/]* ([^ /]*/[^ ]*: warning: .*)')
 
-  # Collect all unique warning lines
-  unique_warnings = dict()
-  checked_warning_lines = dict()
-  line_counter = 0
+  # Yield all unique warning lines. Lines and warnings seen before are
+  # remembered by their digests.
+  seen_warnings = set()
+  checked_warning_lines = set()
   prev_warning = ''
-  for line in infile:
-    line_counter += 1
+  for line_counter, line in replay_lines(recorded_lines, infile,
+                                        numbered_lines):
     if prev_warning:
       if rustc_file_position.match(line):
         # must be a rustc warning, combine 2 lines into one warning
         line = line.strip().replace('--> ', '') + ': ' + prev_warning
-        unique_warnings = add_normalized_line_to_warnings(
-            line, flags, android_root, unique_warnings)
+        yield from generate_new_warning(line, flags, android_root,
+                                        seen_warnings)
         prev_warning = ''
         continue
       # add prev_warning, and then process the current line
       prev_warning = 'unknown_source_file: ' + prev_warning
-      unique_warnings = add_normalized_line_to_warnings(
-          prev_warning, flags, android_root, unique_warnings)
+      yield from generate_new_warning(prev_warning, flags, android_root,
+                                      seen_warnings)
       prev_warning = ''
 
     # re.match is slow, with several warning line patterns and
@@ -445,9 +674,10 @@ def parse_input_file_android(infile, flags):
     # A large clean build output can contain up to 90% of duplicated
     # "warning:" lines. If we can skip them quickly, we can
     # speed up this for-loop 3X to 5X.
-    if line in checked_warning_lines:
+    line_digest = get_line_digest(line)
+    if line_digest in checked_warning_lines:
       continue
-    checked_warning_lines[line] = True
+    checked_warning_lines.add(line_digest)
 
     # Clean up extra prefix that could be introduced when RBE was used.
     if '/b/f/w/' in line:
@@ -462,8 +692,8 @@ def parse_input_file_android(infile, flags):
         # save this line and combine it with the next line
         prev_warning = line
       else:
-        unique_warnings = add_normalized_line_to_warnings(
-            line, flags, android_root, unique_warnings)
+        yield from generate_new_warning(line, flags, android_root,
+                                        seen_warnings)
       continue
 
     if line_counter < 100:
@@ -485,30 +715,41 @@ def parse_input_file_android(infile, flags):
         build_id = result.group(0)
         continue
 
-  if android_root:
-    new_unique_warnings = dict()
-    for warning_line in unique_warnings:
-      normalized_line = normalize_warning_line(warning_line, flags,
-                                               android_root)
-      new_unique_warnings[normalized_line] = generate_android_cs_link(
-          warning_line, flags, android_root)
-    unique_warnings = new_unique_warnings
-
-  header_str = '%s - %s - %s (%s)' % (
+  build_info['header_str'] = '%s - %s - %s (%s)' % (
       platform_version, target_product, target_variant, build_id)
-  return unique_warnings, header_str
 
 
-def parse_input_file(infile, flags):
-  """Parse one input file for chrome or android."""
+def stream_input_file(infile, flags, build_info):
+  """Parse one input file for chrome or android, and yield its warnings.
+
+  Yields:
+    (warning line, link) of each unique warning line in infile.
+    build_info['header_str'] is set after the last one.
+  """
   if flags.platform == 'chrome':
-    return parse_input_file_chrome(infile, flags)
+    return stream_input_file_chrome(infile, flags, build_info)
   if flags.platform == 'android':
-    return parse_input_file_android(infile, flags)
-  raise RuntimeError('parse_input_file not defined for platform %s' %
+    return stream_input_file_android(infile, flags, build_info)
+  raise RuntimeError('stream_input_file not defined for platform %s' %
                      flags.platform)
 
 
+def parse_input_file(infile, flags):
+  """Parse one input file for chrome or android."""
+  build_info = {}
+  unique_warnings = dict(stream_input_file(infile, flags, build_info))
+  return unique_warnings, build_info['header_str']
+
+
+def open_log(logfile):
+  """Open a plain or gzip compressed log file to read text lines."""
+  with open(logfile, 'rb') as log:
+    compressed = log.read(2) == b'\x1f\x8b'
+  if compressed:
+    return gzip.open(logfile, 'rt', encoding='utf-8')
+  return io.open(logfile, encoding='utf-8')
+
+
 def parse_compiler_output(compiler_output):
   """Parse compiler output for relevant info."""
   split_output = compiler_output.split(':', 3)  # 3 = max splits
@@ -547,53 +788,96 @@ def get_project_list(platform):
   raise Exception('platform name %s is not valid' % platform)
 
 
+def takes_shared_args(create_launch_subprocs_fn):
+  """Mark a create_launch_subprocs_fn that takes the shared arguments.
+
+  Such a function is called as create_launch_subprocs_fn(num_cpu,
+  classify_warnings_fn, arg_groups, shared_args), where arg_groups is an
+  iterator of {'group': list of (warning, link)} in the order of the log, and
+  shared_args holds the other arguments of classify_warnings_fn for all
+  groups. It returns a list of one list, with the result of each group.
+
+  An unmarked function is called as create_launch_subprocs_fn(num_cpu,
+  classify_warnings_fn, arg_groups, group_results), where arg_groups is a list
+  of num_cpu lists of complete classify_warnings_fn arguments, and it returns
+  group_results with the list of results of each process appended.
+  """
+  create_launch_subprocs_fn.takes_shared_args = True
+  return create_launch_subprocs_fn
+
+
 def parallel_classify_warnings(warning_data, args, project_names,
                                project_patterns, warn_patterns,
                                use_google3, create_launch_subprocs_fn,
                                classify_warnings_fn):
-  """Classify all warning lines with num_cpu parallel processes."""
+  """Classify all warning lines with num_cpu parallel processes.
+
+  warning_data is a dict {warning line: link}, or an iterable of
+  (warning line, link), which is consumed while the lines are classified.
+  With a sidecar file, the lines are only kept split as in that file.
+  See takes_shared_args for how create_launch_subprocs_fn is called.
+  """
   # pylint:disable=too-many-arguments,too-many-locals
   num_cpu = args.processes
   group_results = []
+  warn_index = make_warn_pattern_index(warn_patterns)
+  project_index = make_pattern_index(list(enumerate(project_patterns)))
+  if isinstance(warning_data, dict):
+    warning_data = warning_data.items()
 
   if num_cpu > 1:
-    # set up parallel processing for this...
-    warning_groups = [[] for _ in range(num_cpu)]
-    i = 0
-    for warning, link in warning_data.items():
-      warning_groups[i].append((warning, link))
-      i = (i + 1) % num_cpu
-    arg_groups = [[] for _ in range(num_cpu)]
-    for i, group in enumerate(warning_groups):
-      arg_groups[i] = [{
-          'group': group,
-          'project_patterns': project_patterns,
-          'warn_patterns': warn_patterns,
-          'num_processes': num_cpu
-      }]
-
-    group_results = create_launch_subprocs_fn(num_cpu,
-                                              classify_warnings_fn,
-                                              arg_groups,
-                                              group_results)
+    shared_args = {
+        'project_patterns': project_patterns,
+        'warn_patterns': warn_patterns,
+        'warn_index': warn_index,
+        'project_index': project_index,
+        'num_processes': num_cpu
+    }
+    if getattr(create_launch_subprocs_fn, 'takes_shared_args', False):
+      # Split the warnings into groups of consecutive lines, which are made
+      # while the processes classify the previous groups. The patterns are
+      # passed once to each process, not with every group.
+      warnings = iter(warning_data)
+      arg_groups = ({'group': group} for group in iter(
+          lambda: list(itertools.islice(warnings, GROUP_SIZE)), []))
+      group_results = create_launch_subprocs_fn(num_cpu,
+                                                classify_warnings_fn,
+                                                arg_groups,
+                                                shared_args)
+    else:
+      # Give each process one group of consecutive lines, with all the
+      # arguments, so that the results of the processes stay in order.
+      warnings = list(warning_data)
+      group_size = -(-len(warnings) // num_cpu)
+      arg_groups = [[dict(shared_args,
+                          group=warnings[i * group_size:(i + 1) * group_size])]
+                    for i in range(num_cpu)]
+      group_results = create_launch_subprocs_fn(num_cpu,
+                                                classify_warnings_fn,
+                                                arg_groups,
+                                                group_results)
+    if use_google3:
+      group_results = [group_results]
   else:
     group_results = []
-    for warning, link in warning_data.items():
+    for warning, link in warning_data:
       classify_one_warning(warning, link, group_results,
-                           project_patterns, warn_patterns)
-    group_results = [group_results]
+                           project_patterns, warn_patterns, warn_index,
+                           project_index)
+    group_results = [[group_results]]
 
-  warning_messages = []
+  if html_writer.get_sidecar_path(args):
+    warning_messages = html_writer.MessageTable()
+  else:
+    warning_messages = []
   warning_links = []
   warning_records = []
-  if use_google3:
-    group_results = [group_results]
   for group_result in group_results:
     for result in group_result:
       for line, link, pattern_idx, project_idx in result:
         pattern = warn_patterns[pattern_idx]
-        pattern['members'].append(line)
         message_idx = len(warning_messages)
+        pattern['members'].append(message_idx)
         warning_messages.append(line)
         link_idx = len(warning_links)
         warning_links.append(link)
@@ -621,18 +905,24 @@ def process_log(logfile, flags, project_names, project_patterns, warn_patterns,
   so that it can be used by both warn.py and the borg job process_gs_logs.py, to
   avoid duplication of code.
   Note that if the arguments to this function change, process_gs_logs.py must
-  be updated accordingly.
+  be updated accordingly. See takes_shared_args for the arguments passed to
+  create_launch_subprocs_fn.
   """
+  # The warnings are classified while the log is parsed.
+  build_info = {}
   if logfile_object is None:
-    with io.open(logfile, encoding='utf-8') as log:
-      warning_lines_and_links, header_str = parse_input_file(log, flags)
+    log = open_log(logfile)
   else:
-    warning_lines_and_links, header_str = parse_input_file(
-        logfile_object, flags)
-  warning_messages, warning_links, warning_records = parallel_classify_warnings(
-      warning_lines_and_links, flags, project_names, project_patterns,
-      warn_patterns, use_google3, create_launch_subprocs_fn,
-      classify_warnings_fn)
+    log = contextlib.nullcontext(logfile_object)
+  with log as infile:
+    warning_lines_and_links = stream_input_file(infile, flags, build_info)
+    warning_messages, warning_links, warning_records = (
+        parallel_classify_warnings(warning_lines_and_links, flags,
+                                   project_names, project_patterns,
+                                   warn_patterns, use_google3,
+                                   create_launch_subprocs_fn,
+                                   classify_warnings_fn))
+  header_str = build_info['header_str']
 
   html_writer.write_html(flags, project_names, warn_patterns, html_path,
                          warning_messages, warning_links, warning_records,
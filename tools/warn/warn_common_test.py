@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2024 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests that the pattern indexes of warn_common classify lines as before."""
+
+import re
+import unittest
+
+try:
+  from re import _parser as sre_parse  # Python 3.11+
+except ImportError:
+  import sre_parse
+
+from warn import warn_common as common
+
+# Characters to try for a character set, after the filler character.
+SET_CHARS = 'a 0/_:-.xA'
+
+CATEGORY_PATTERNS = {
+    sre_parse.CATEGORY_DIGIT: re.compile(r'\d'),
+    sre_parse.CATEGORY_NOT_DIGIT: re.compile(r'\D'),
+    sre_parse.CATEGORY_SPACE: re.compile(r'\s'),
+    sre_parse.CATEGORY_NOT_SPACE: re.compile(r'\S'),
+    sre_parse.CATEGORY_WORD: re.compile(r'\w'),
+    sre_parse.CATEGORY_NOT_WORD: re.compile(r'\W'),
+}
+
+REPEATS = [sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT]
+if hasattr(sre_parse, 'POSSESSIVE_REPEAT'):
+  REPEATS.append(sre_parse.POSSESSIVE_REPEAT)
+
+
+def in_set(items, char):
+  """Return True if char is in the parsed character set items."""
+  negate = False
+  found = False
+  for op, arg in items:
+    if op == sre_parse.NEGATE:
+      negate = True
+    elif op == sre_parse.LITERAL:
+      found = found or char == chr(arg)
+    elif op == sre_parse.RANGE:
+      found = found or arg[0] <= ord(char) <= arg[1]
+    elif op == sre_parse.CATEGORY:
+      found = found or bool(CATEGORY_PATTERNS[arg].match(char))
+  return found != negate
+
+
+def make_sample(items, filler, shortest, branch):
+  """Return a string that should match the parsed pattern items.
+
+  filler is used for any character, repeats are as short as possible if
+  shortest, and the branch-th alternative of each branch is used.
+  """
+  sample = ''
+  for op, arg in items:
+    if op == sre_parse.LITERAL:
+      sample += chr(arg)
+    elif op == sre_parse.NOT_LITERAL:
+      sample += next(c for c in filler + SET_CHARS if c != chr(arg))
+    elif op == sre_parse.ANY:
+      sample += filler
+    elif op == sre_parse.IN:
+      sample += next((c for c in filler + SET_CHARS if in_set(arg, c)), '')
+    elif op in REPEATS:
+      count = arg[0] if shortest else max(arg[0], 1)
+      sample += make_sample(arg[2], filler, shortest, branch) * count
+    elif op == sre_parse.SUBPATTERN:
+      sample += make_sample(arg[-1], filler, shortest, branch)
+    elif op == sre_parse.BRANCH:
+      alternatives = arg[1]
+      sample += make_sample(alternatives[min(branch, len(alternatives) - 1)],
+                            filler, shortest, branch)
+  return sample
+
+
+def make_matching_samples(compiled_pattern):
+  """Return some strings that match a compiled pattern."""
+  items = sre_parse.parse(compiled_pattern.pattern, compiled_pattern.flags)
+  samples = set()
+  for filler in 'a ':
+    for shortest in (True, False):
+      for branch in range(3):
+        sample = make_sample(items, filler, shortest, branch)
+        if compiled_pattern.match(sample):
+          samples.add(sample)
+  return sorted(samples)
+
+
+class WarnCommonTest(unittest.TestCase):
+
+  def assertSameClassification(self, lines, warn_patterns, project_patterns):
+    warn_index = common.make_warn_pattern_index(warn_patterns)
+    project_index = common.make_pattern_index(
+        list(enumerate(project_patterns)))
+    for line in lines:
+      results = []
+      indexed_results = []
+      common.classify_one_warning(line, 'link', results, project_patterns,
+                                  warn_patterns)
+      common.classify_one_warning(line, 'link', indexed_results,
+                                  project_patterns, warn_patterns, warn_index,
+                                  project_index)
+      self.assertEqual(results, indexed_results, line)
+
+  def assertSameProject(self, lines, project_patterns):
+    project_index = common.make_pattern_index(
+        list(enumerate(project_patterns)))
+    for line in lines:
+      self.assertEqual(
+          common.find_project_index(line, project_patterns),
+          common.find_project_index(line, project_patterns, project_index),
+          line)
+
+  def check_platform(self, platform):
+    warn_patterns = common.get_warn_patterns(platform)
+    project_patterns = [re.compile(p[1])
+                        for p in common.get_project_list(platform)]
+    warn_lines = []
+    for pattern in warn_patterns:
+      for cpat in pattern['compiled_patterns']:
+        samples = make_matching_samples(cpat)
+        self.assertTrue(samples, cpat.pattern)
+        warn_lines.extend(samples)
+    project_lines = []
+    for cpat in project_patterns:
+      samples = make_matching_samples(cpat)
+      self.assertTrue(samples, cpat.pattern)
+      project_lines.extend(samples)
+    # Also put the warnings in the projects, and the projects in other words.
+    warn_lines.extend(project_line + warn_line
+                      for project_line in project_lines[::29]
+                      for warn_line in warn_lines[::47])
+    project_lines += ['/x' + line for line in project_lines]
+    project_lines += [line.replace('/', 'a') for line in project_lines]
+    self.assertSameClassification(warn_lines, warn_patterns, project_patterns)
+    self.assertSameProject(project_lines, project_patterns)
+
+  def test_android_patterns(self):
+    self.check_platform('android')
+
+  def test_chrome_patterns(self):
+    self.check_platform('chrome')
+
+  def test_get_required_words(self):
+    for pattern, flags, words in [
+        (r'.*: warning: unused variable', 0, ['warning', 'unused']),
+        (r'.*: warning: unused variable$', 0,
+         ['warning', 'unused', 'variable']),
+        (r'Warning: foo bar ', re.IGNORECASE, []),
+        (r'.*\bfoo bar\b', 0, []),
+        (r'.*: (warning|error): foo bar', 0, ['foo']),
+        (r'(^|.*/)art/.*: warning:', 0, ['art', 'warning']),
+        (r'foo(bar)? baz', 0, []),
+        (r'foo bar', 0, ['foo']),
+    ]:
+      self.assertEqual(common.get_required_words(re.compile(pattern, flags)),
+                       words, pattern)
+
+  def test_find_candidate_patterns(self):
+    patterns = [re.compile(p, f) for p, f in [
+        (r'.*: warning: unused variable', 0),
+        (r'.*: WARNING: unused', re.IGNORECASE),
+        (r'.*\bunused variable\b', 0),
+        (r'.*: (warning|error): unused', 0),
+        (r'(^|.*/)art/.*: warning:', 0),
+        (r'unused(var)? variable', 0),
+    ]]
+    pattern_index = common.make_pattern_index(list(enumerate(patterns)))
+    for line in [
+        'a.c: warning: unused variable',
+        'a.c: Warning: unused variable',
+        'a.c: error: unused',
+        'art/a.c: warning: unused variables',
+        'xart/a.c: warning: unused',
+        'unusedvar variable',
+        'unused variable',
+        'a.c:warning:unused',
+        'a.c: warnings: unused',
+    ]:
+      candidates = [idx for _, idx, _ in
+                    common.find_candidate_patterns(line, pattern_index)]
+      self.assertEqual(candidates, sorted(candidates), line)
+      matches = [idx for idx, cpat in enumerate(patterns) if cpat.match(line)]
+      self.assertTrue(set(matches) <= set(candidates), line)
+      self.assertEqual(
+          common.find_project_index(line, patterns),
+          common.find_project_index(line, patterns, pattern_index), line)
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=2)